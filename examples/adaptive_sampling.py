@@ -0,0 +1,64 @@
+"""Poll sensors of a simulated vehicle as fast as their values change.
+
+The engine of the simulated vehicle revs up for the first seconds and then
+idles, while the coolant temperature holds. The number of reads of each
+sensor per second shows polling speed up and back off.
+"""
+import collections
+import threading
+import time
+
+from obd.io import OBDDevice
+from obd.scheduler import PollingScheduler
+from obd.simulator import PtySimulator
+from obd.simulator import VehicleProfile
+
+
+_DURATION = 12
+
+_REV_DURATION = 4
+
+
+def _rev_engine(profile):
+    start_time = time.time()
+    while time.time() - start_time < _REV_DURATION:
+        rpm = 800 + int((time.time() - start_time) * 1000)
+        profile.pids[0x0C] = bytearray([rpm * 4 >> 8, rpm * 4 & 0xFF])
+        time.sleep(0.05)
+
+
+def _main():
+    profile = VehicleProfile(protocol="6")
+    simulator = PtySimulator(profile)
+    simulator.start()
+    device = OBDDevice(simulator.port_name, 2, protocol="6")
+
+    scheduler = PollingScheduler(device)
+    scheduler.add_adaptive("rpm", min_interval=0.05, max_interval=2)
+    scheduler.add_adaptive("temp", min_interval=0.5, max_interval=30)
+
+    reads = collections.defaultdict(collections.Counter)
+    start_time = time.time()
+
+    def count_read(shortname, _value, timestamp):
+        reads[int(timestamp - start_time)][shortname] += 1
+
+    engine = threading.Thread(target=_rev_engine, args=(profile,))
+    engine.start()
+    scheduler.run(_DURATION, callback=count_read)
+    engine.join()
+
+    print '{:>6} {:>10} {:>10}'.format('second', 'rpm reads', 'temp reads')
+    for second in range(_DURATION):
+        print '{:>6} {:>10} {:>10}'.format(
+            second,
+            reads[second]['rpm'],
+            reads[second]['temp'],
+            )
+
+    device.close()
+    simulator.close()
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,54 @@
+"""Measure PIDs per second at each serial baud rate against the simulator.
+
+The simulated adapter and vehicle answer with realistic timings on a CAN bus,
+so the time the replies spend on the serial line is what changes with the
+baud rate.
+"""
+import time
+
+from obd.io import OBDDevice
+from obd.simulator import PtySimulator
+from obd.simulator import VehicleProfile
+
+
+_BAUDRATES = (38400, 57600, 115200, 230400, 500000, 1000000, 2000000)
+
+_SENSOR_INDEXES = (4, 5, 12, 13, 15, 16, 17)
+
+_ROUNDS = 30
+
+
+def _measure(baudrate):
+    simulator = PtySimulator(VehicleProfile(protocol="6"))
+    simulator.emulator.max_baudrate = max(_BAUDRATES)
+    simulator.emulator.stn = True
+    simulator.start()
+
+    device = OBDDevice(simulator.port_name, 2, protocol="6")
+    achieved_baudrate = device.negotiate_baudrate([baudrate])
+    # learn the number of responses of each PID before measuring
+    for sensor_index in _SENSOR_INDEXES:
+        device.sensor(sensor_index)
+
+    start = time.time()
+    for _ in range(_ROUNDS):
+        for sensor_index in _SENSOR_INDEXES:
+            device.sensor(sensor_index)
+    pids_per_second = _ROUNDS * len(_SENSOR_INDEXES) / (time.time() - start)
+
+    device.close()
+    simulator.close()
+    return achieved_baudrate, pids_per_second
+
+
+def _main():
+    for baudrate in _BAUDRATES:
+        achieved_baudrate, pids_per_second = _measure(baudrate)
+        print '{:>8} bps: {:.0f} PIDs/s'.format(
+            achieved_baudrate,
+            pids_per_second,
+            )
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,108 @@
+"""Measure the time to decode a sample of every sensor in the SENSORS table,
+and to load the sensor definitions.
+
+Each sensor is handed data bytes of the size of its PID, as OBDDevice does
+after parsing a reply. The compiled decoders of the table are compared
+against the conversion functions they replace.
+"""
+import shutil
+import tempfile
+import time
+
+from obd import conversion
+from obd.sensors import SENSORS
+from obd.sensors import STANDARD_SENSORS_PATH
+from obd.sensors import load_sensors
+
+
+_REPEAT_COUNT = 2000
+
+# Measurements to take the best of, to leave out other load
+_MEASUREMENT_COUNT = 5
+
+# Conversion functions the compiled formulas replace, by sensor short name
+_LEGACY_CONVERSIONS = {
+    "load": conversion.to_percent_scale,
+    "temp": conversion.to_temp_c,
+    "short_term_fuel_trim_1": conversion.to_fuel_trim_percent,
+    "long_term_fuel_trim_1": conversion.to_fuel_trim_percent,
+    "short_term_fuel_trim_2": conversion.to_fuel_trim_percent,
+    "long_term_fuel_trim_2": conversion.to_fuel_trim_percent,
+    "fuel_pressure": conversion.to_kpa_gauge,
+    "manifold_pressure": conversion.to_int,
+    "rpm": conversion.to_rpm,
+    "speed": conversion.to_int,
+    "timing_advance": conversion.to_timing_advance,
+    "intake_air_temp": conversion.to_temp_c,
+    "maf": conversion.to_maf_grams_sec,
+    "throttle_pos": conversion.to_percent_scale,
+    "engine_time": conversion.to_int,
+    }
+
+_LOAD_COUNT = 20
+
+
+def _get_samples():
+    samples = []
+    for index, sensor in enumerate(SENSORS):
+        data = bytearray((index + offset) % 256 for offset in range(sensor.size))
+        samples.append((sensor, memoryview(data)))
+    return samples
+
+
+def _measure(decoders):
+    times = []
+    for _ in range(_MEASUREMENT_COUNT):
+        start = time.time()
+        for _ in range(_REPEAT_COUNT):
+            for decode, data in decoders:
+                decode(data)
+        times.append(time.time() - start)
+    return min(times) / (_REPEAT_COUNT * len(decoders))
+
+
+def _compare(samples, title):
+    compiled = [(sensor.value, data) for sensor, data in samples]
+    legacy = [
+        (_LEGACY_CONVERSIONS.get(sensor.shortname, sensor.value), data)
+        for sensor, data in samples
+        ]
+    legacy_time = _measure(legacy)
+    compiled_time = _measure(compiled)
+    print '{} ({} sensors):'.format(title, len(samples))
+    print '  conversion functions: {:.0f} ns/sample'.format(legacy_time * 1e9)
+    print '  compiled decoders:    {:.0f} ns/sample'.format(compiled_time * 1e9)
+
+
+def _measure_loading():
+    compiled_directory = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        load_sensors(STANDARD_SENSORS_PATH, compiled_directory)
+        compile_time = time.time() - start
+        start = time.time()
+        for _ in range(_LOAD_COUNT):
+            load_sensors(STANDARD_SENSORS_PATH, compiled_directory)
+        load_time = (time.time() - start) / _LOAD_COUNT
+    finally:
+        shutil.rmtree(compiled_directory)
+    print 'sensor definitions:'
+    print '  compiling:     {:.1f} ms'.format(compile_time * 1e3)
+    print '  from compiled: {:.1f} ms'.format(load_time * 1e3)
+
+
+def _main():
+    samples = _get_samples()
+    table_time = _measure([(sensor.value, data) for sensor, data in samples])
+    print 'whole table ({} sensors): {:.0f} ns/sample'.format(
+        len(samples), table_time * 1e9)
+    _compare(
+        [(sensor, data) for sensor, data in samples
+         if sensor.shortname in _LEGACY_CONVERSIONS],
+        'formerly converted by functions',
+        )
+    _measure_loading()
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,58 @@
+"""Measure commands per second of a fleet of simulated adapters.
+
+Simulated vehicles on pseudo-terminals are polled from one event loop, each
+with the same schedule. The metrics of each adapter and of the whole fleet
+are printed at the end.
+"""
+import sys
+
+from obd.fleet import LATENCY_PERCENTILES
+from obd.fleet import DeviceFleet
+from obd.simulator import PtySimulator
+from obd.simulator import VehicleProfile
+
+
+_DEVICE_COUNT = 16
+
+_DURATION = 20
+
+_RATES = {"rpm": 10, "speed": 10, "temp": 1}
+
+
+def _format_metrics(metrics):
+    latencies = ' '.join(
+        'p{}={:.1f}ms'.format(percentile, metrics.latency_percentiles[percentile] * 1000)
+        for percentile in LATENCY_PERCENTILES
+        if metrics.latency_percentiles[percentile] is not None
+        )
+    return '{:>6} commands {:>4} errors {:>7.1f} commands/s {}'.format(
+        metrics.commands,
+        metrics.errors,
+        metrics.commands_per_second,
+        latencies,
+        )
+
+
+def _main():
+    device_count = int(sys.argv[1]) if len(sys.argv) > 1 else _DEVICE_COUNT
+    simulators = [
+        PtySimulator(VehicleProfile(protocol="6")) for _ in range(device_count)
+        ]
+    fleet = DeviceFleet(2)
+    for simulator in simulators:
+        simulator.start()
+        fleet.add(simulator.port_name, _RATES)
+
+    fleet.run(_DURATION)
+    device_metrics, fleet_metrics = fleet.get_metrics()
+    for port in fleet.ports:
+        print '{:<12} {}'.format(port, _format_metrics(device_metrics[port]))
+    print '{:<12} {}'.format('fleet', _format_metrics(fleet_metrics))
+
+    fleet.close()
+    for simulator in simulators:
+        simulator.close()
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,53 @@
+"""Measure the frames per second read while monitoring a simulated CAN bus.
+
+The simulated vehicle broadcasts more frames than a 38400 bps link carries,
+so the adapter soon runs out of buffer and the baud rate is raised. Each
+second, the number of frames read is printed with the baud rate in use.
+"""
+import time
+
+from obd.io import OBDDevice
+from obd.simulator import DEFAULT_TRAFFIC
+from obd.simulator import PtySimulator
+from obd.simulator import VehicleProfile
+
+
+_DURATION = 10
+
+
+def _main():
+    simulator = PtySimulator(VehicleProfile(protocol="6"))
+    simulator.start()
+    device = OBDDevice(simulator.port_name, 2, protocol="6")
+
+    bus_rate = sum(1 / period for _can_id, period, _data in DEFAULT_TRAFFIC)
+    print 'Frames broadcast on the bus: {:.0f}/s'.format(bus_rate)
+
+    frames = device.monitor()
+    start_time = second_start_time = time.time()
+    frame_count = second_frame_count = 0
+    for frame in frames:
+        # None: no frame for a while
+        if frame is not None:
+            frame_count += 1
+            second_frame_count += 1
+        now = time.time()
+        if now - second_start_time >= 1:
+            print '{:>6.0f} frames/s at {} bps'.format(
+                second_frame_count / (now - second_start_time),
+                device.port.baudrate,
+                )
+            second_start_time = now
+            second_frame_count = 0
+        if now - start_time >= _DURATION:
+            break
+    frames.close()
+    print 'Overall: {:.0f} frames/s'.format(
+        frame_count / (time.time() - start_time))
+
+    device.close()
+    simulator.close()
+
+
+if __name__ == '__main__':
+    _main()
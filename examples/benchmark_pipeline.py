@@ -0,0 +1,70 @@
+"""Measure requests per second with many threads sharing one adapter.
+
+Callers either share the device through a CommandQueue or take turns on it
+with a lock held across each round trip. The simulated adapter answers with
+realistic timings on a CAN bus.
+"""
+import threading
+import time
+
+from obd.io import OBDDevice
+from obd.pipeline import CommandQueue
+from obd.simulator import PtySimulator
+from obd.simulator import VehicleProfile
+
+
+_THREAD_COUNTS = (1, 2, 4, 8, 16)
+
+_REQUESTS_PER_THREAD = 40
+
+_SENSOR_INDEXES = (4, 5, 12, 13)
+
+
+def _run_threads(thread_count, read_sensor):
+    def poll():
+        for request_index in range(_REQUESTS_PER_THREAD):
+            read_sensor(_SENSOR_INDEXES[request_index % len(_SENSOR_INDEXES)])
+
+    threads = [threading.Thread(target=poll) for _ in range(thread_count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return thread_count * _REQUESTS_PER_THREAD / (time.time() - start)
+
+
+def _main():
+    simulator = PtySimulator(VehicleProfile(protocol="6"))
+    simulator.start()
+    device = OBDDevice(simulator.port_name, 2, protocol="6")
+    for sensor_index in _SENSOR_INDEXES:
+        device.sensor(sensor_index)
+
+    lock = threading.Lock()
+
+    def read_with_lock(sensor_index):
+        with lock:
+            return device.sensor(sensor_index)
+
+    queue = CommandQueue(device)
+
+    def read_with_queue(sensor_index):
+        return queue.sensor(sensor_index).result()
+
+    for thread_count in _THREAD_COUNTS:
+        locked_rate = _run_threads(thread_count, read_with_lock)
+        queued_rate = _run_threads(thread_count, read_with_queue)
+        print '{:>2} threads: lock {:.0f} requests/s, queue {:.0f} requests/s'.format(
+            thread_count,
+            locked_rate,
+            queued_rate,
+            )
+
+    queue.close()
+    device.close()
+    simulator.close()
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,88 @@
+"""Measure commands per second of the reply reader against a pty stand-in.
+
+A thread on the master side of a pseudo-terminal answers every command with a
+canned multi-line mode 03 reply, so the numbers reflect the cost of reading
+and framing replies rather than the speed of a real vehicle bus.
+"""
+import os
+import sys
+import threading
+import time
+import tty
+
+from obd.io import OBDDevice
+
+
+_REPLY = "\r".join(["43 01 33 01 34 01 35"] * 8) + "\r\r>"
+
+_COMMAND_COUNT = 2000
+
+
+def _answer_commands(master_fd):
+    pending = ""
+    while True:
+        try:
+            data = os.read(master_fd, 1024)
+        except OSError:
+            return
+        if not data:
+            return
+        pending += data
+        while "\r" in pending:
+            _command, pending = pending.split("\r", 1)
+            os.write(master_fd, _REPLY)
+
+
+def _legacy_get_result(device):
+    """The byte-at-a-time reader this benchmark compares against"""
+    repeat_count = 0
+    buffer = ""
+    while 1:
+        c = device.port.read(1)
+        if len(c) == 0:
+            if(repeat_count == 5):
+                break
+            repeat_count = repeat_count + 1
+            continue
+
+        if c == '\r':
+            continue
+
+        if c == ">":
+            break
+
+        buffer = buffer + c
+    return buffer
+
+
+def _measure(device, read_reply):
+    start = time.time()
+    for _ in range(_COMMAND_COUNT):
+        device.send_command("03")
+        read_reply()
+    return _COMMAND_COUNT / (time.time() - start)
+
+
+def _main():
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(slave_fd)
+    responder = threading.Thread(target=_answer_commands, args=(master_fd,))
+    responder.daemon = True
+    responder.start()
+
+    device = OBDDevice(os.ttyname(slave_fd), 2)
+    if device.state == 0:
+        sys.exit('Could not open the pty stand-in')
+
+    legacy_rate = _measure(device, lambda: _legacy_get_result(device))
+    buffered_rate = _measure(device, device.get_result)
+    print 'byte-at-a-time reader: {:.0f} commands/s'.format(legacy_rate)
+    print 'buffered reader:       {:.0f} commands/s'.format(buffered_rate)
+
+    device.close()
+    os.close(slave_fd)
+    os.close(master_fd)
+
+
+if __name__ == '__main__':
+    _main()
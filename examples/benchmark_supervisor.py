@@ -0,0 +1,90 @@
+"""Measure readings per second of simulated adapters sharded across workers.
+
+Simulated vehicles are served from processes of their own, with shortened
+latencies so that the bus is not the bottleneck. They are polled first by a
+single worker process and then by a pool of them, and the readings collected
+per second once all adapters are connected are printed for each.
+"""
+import multiprocessing
+import sys
+import time
+
+from obd.simulator import PtySimulator
+from obd.simulator import VehicleProfile
+from obd.supervisor import FleetSupervisor
+
+
+_DEVICE_COUNT = 64
+
+_WORKER_COUNT = multiprocessing.cpu_count()
+
+_SIMULATORS_PER_PROCESS = 16
+
+_LATENCY_SCALE = 0.05
+
+_RATES = {"rpm": 20, "speed": 20, "temp": 5}
+
+# Seconds given to the adapters to connect, then seconds measured
+_WARM_UP = 10
+_DURATION = 15
+
+
+def _serve_simulators(count, connection):
+    simulators = [
+        PtySimulator(VehicleProfile(protocol="6"), _LATENCY_SCALE)
+        for _ in range(count)
+        ]
+    for simulator in simulators:
+        simulator.start()
+    connection.send([simulator.port_name for simulator in simulators])
+    # serve until the benchmark is over
+    connection.recv()
+
+
+def _start_simulators(device_count):
+    ports = []
+    connections = []
+    for start in range(0, device_count, _SIMULATORS_PER_PROCESS):
+        count = min(_SIMULATORS_PER_PROCESS, device_count - start)
+        connection, host_connection = multiprocessing.Pipe()
+        host = multiprocessing.Process(
+            target=_serve_simulators,
+            args=(count, host_connection),
+            )
+        host.daemon = True
+        host.start()
+        ports.extend(connection.recv())
+        connections.append(connection)
+    return ports, connections
+
+
+def _measure(ports, worker_count):
+    supervisor = FleetSupervisor(worker_count, 2)
+    for port in ports:
+        supervisor.add(port, _RATES)
+    supervisor.run(_WARM_UP)
+    reading_count = sum(supervisor.reading_counts.values())
+    supervisor.run(_DURATION)
+    reading_count = sum(supervisor.reading_counts.values()) - reading_count
+    supervisor.close()
+    return reading_count / float(_DURATION)
+
+
+def _main():
+    device_count = int(sys.argv[1]) if len(sys.argv) > 1 else _DEVICE_COUNT
+    worker_count = int(sys.argv[2]) if len(sys.argv) > 2 else _WORKER_COUNT
+    ports, connections = _start_simulators(device_count)
+
+    target_rate = device_count * sum(_RATES.values())
+    print 'Readings scheduled: {}/s from {} adapters'.format(
+        target_rate, device_count)
+    for count in sorted(set([1, worker_count])):
+        print '{:>3} worker(s): {:>7.0f} readings/s'.format(
+            count, _measure(ports, count))
+
+    for connection in connections:
+        connection.send(None)
+
+
+if __name__ == '__main__':
+    _main()
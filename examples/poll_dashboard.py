@@ -0,0 +1,55 @@
+"""Poll dashboard sensors at their own rates from a simulated vehicle.
+
+RPM and speed are asked for at 10 Hz, coolant temperature every 5 s and the
+fuel level once a minute. With --saturate, the intake air temperature is
+asked for at 200 Hz with a low priority, more than the bus can carry, and is
+slowed down so that the other sensors keep their rates.
+"""
+import sys
+
+from obd.io import OBDDevice
+from obd.scheduler import PollingScheduler
+from obd.simulator import PtySimulator
+from obd.simulator import VehicleProfile
+
+
+_RATES = {
+    "rpm": 10,
+    "speed": 10,
+    "temp": 0.2,
+    "fuel_level": 1 / 60.0,
+    }
+
+_PRIORITIES = {"rpm": 2, "speed": 2, "temp": 1, "fuel_level": 1}
+
+_DURATION = 20
+
+
+def _main():
+    simulator = PtySimulator(VehicleProfile(protocol="6"))
+    simulator.start()
+    device = OBDDevice(simulator.port_name, 2, protocol="6")
+
+    scheduler = PollingScheduler(device, _RATES, _PRIORITIES)
+    if "--saturate" in sys.argv[1:]:
+        scheduler.add("intake_air_temp", 200, priority=0)
+    scheduler.run(_DURATION)
+
+    print '{:<20} {:>8} {:>10} {:>9} {:>10} {:>6}'.format(
+        'sensor', 'target', 'scheduled', 'achieved', 'jitter', 'reads')
+    for shortname, stats in sorted(scheduler.report().items()):
+        print '{:<20} {:>6.2f}Hz {:>8.2f}Hz {:>7.2f}Hz {:>8.1f}ms {:>6}'.format(
+            shortname,
+            stats.target_rate,
+            stats.scheduled_rate,
+            stats.achieved_rate,
+            stats.jitter * 1000,
+            stats.read_count,
+            )
+
+    device.close()
+    simulator.close()
+
+
+if __name__ == '__main__':
+    _main()
@@ -1,8 +1,7 @@
 from contextlib import closing
 import sys
 
-from serial.tools.list_ports import comports
-
+from obd.discovery import discover
 from obd.io import OBDDevice
 from obd.obd2_codes import pcodes
 
@@ -17,23 +16,21 @@ def connect(device_name):
         device.close()
         device = None
     else:
-        print 'Connected to port', device_name
+        print 'Connected to port {} in {:.3f} s'.format(
+            device_name,
+            device.connect_time,
+            )
 
     return device
 
 
 def auto_connect():
-    device = None
-    for device_name, device_description, hardware_id in comports():
-        print 'Trying to connect to {} ({} - ID: {})'.format(
-            device_description,
-            device_name,
-            hardware_id,
-            )
-        device = connect(device_name)
-        if device:
-            break
-    return device
+    adapters = discover(first=True)
+    if not adapters:
+        return None
+    port, identity, probe_time = adapters[0]
+    print 'Found {} on {} in {:.3f} s'.format(identity, port, probe_time)
+    return connect(port)
 
 
 def _main():
@@ -52,7 +49,7 @@ def _main():
 
     with closing(device):
         for _status, dtc in device.get_dtc():
-            dtc_description = pcodes[dtc]
+            dtc_description = pcodes.get(dtc, 'Unknown code')
             print '[{}] {}'.format(dtc, dtc_description)
 
 
@@ -1,29 +1,18 @@
 from contextlib import closing
 import sys
 
-from serial.tools.list_ports import comports
-
+from obd.discovery import discover
 from obd.io import OBDDevice
-
-
-_SENSOR_SUPPORT_SENSOR_INDEXES = (0, 32, 64, 96)
-
-
-def _get_sensor_support_PIDs(device):
-    sensor_support_PIDs = []
-    for sensor_index in _SENSOR_SUPPORT_SENSOR_INDEXES:
-        supported_sensor_PIDs = device.sensor(sensor_index)[1]
-        sensor_support_PIDs.extend(supported_sensor_PIDs)
-    return sensor_support_PIDs
+from obd.sensors import SENSORS
 
 
 def get_supported_sensor_indexes(device):
-    supported_sensor_PIDs = _get_sensor_support_PIDs(device)
-    supported_sensor_indexes = []
-    for sensor_index, is_supported in enumerate(supported_sensor_PIDs, 1):
-        if is_supported == "1":
-            supported_sensor_indexes.append(sensor_index)
-    return supported_sensor_indexes
+    supported_pids = device.get_supported_pids()
+    return [
+        sensor_index
+        for sensor_index, sensor in enumerate(SENSORS)
+        if sensor.cmd.startswith("01") and sensor.pid in supported_pids
+        ]
 
 
 def print_supported_sensors_values(device):
@@ -43,23 +32,21 @@ def connect(device_name):
         device.close()
         device = None
     else:
-        print 'Connected to port', device_name
+        print 'Connected to port {} in {:.3f} s'.format(
+            device_name,
+            device.connect_time,
+            )
 
     return device
 
 
 def auto_connect():
-    device = None
-    for device_name, device_description, hardware_id in comports():
-        print 'Trying to connect to {} ({} - ID: {})'.format(
-            device_description,
-            device_name,
-            hardware_id,
-            )
-        device = connect(device_name)
-        if device:
-            break
-    return device
+    adapters = discover(first=True)
+    if not adapters:
+        return None
+    port, identity, probe_time = adapters[0]
+    print 'Found {} on {} in {:.3f} s'.format(identity, port, probe_time)
+    return connect(port)
 
 
 def _main():
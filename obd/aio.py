@@ -0,0 +1,358 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""Non-blocking client for use with asyncio (trollius on Python 2).
+
+A single event loop drives any number of adapters, serial or TCP, without a
+thread per device::
+
+    @asyncio.coroutine
+    def poll(port):
+        device = yield From(AsyncOBDDevice.connect(port, 2))
+        while True:
+            name, value, unit = yield From(device.sensor(12))
+
+    loop.run_until_complete(asyncio.gather(*[poll(p) for p in ports]))
+
+Replies are parsed and decoded by the same code as OBDDevice.
+"""
+
+from logging import getLogger
+
+import serial
+import trollius as asyncio
+from trollius import From
+from trollius import Return
+
+from .elm import BUSY_SUFFIX
+from .elm import OBD_REQUEST
+from .elm import PROMPT
+from .elm import SEARCH_COMMAND
+from .elm import encode_command
+from .elm import get_command_class
+from .elm import get_timeout_policies
+from .io import CLEAR_DTC_COMMAND
+from .io import GET_DTC_COMMAND
+from .io import GET_FREEZE_DTC_COMMAND
+from .io import clean_result
+from .io import decode_sensor_value
+from .io import get_supported_pids_bitmap
+from .io import is_unanswered
+from .io import parse_dtcs
+from .pids import LAST_SUPPORTED_PIDS
+from .pids import SUPPORTED_PIDS_RANGE
+from .pids import SupportedPIDs
+from .replies import NO_DATA
+from .replies import ReadTimeout
+from .replies import UnansweredRequests
+from .replies import find_reply
+from .replies import get_missing_value
+from .replies import parse_reply
+from .sensors import SENSORS
+from .transport import SERIAL_BAUDRATE
+from .transport import TransportError
+from .transport import parse_tcp_url
+
+
+_READ_SIZE = 4096
+
+
+class _SerialWriter(object):
+    """Writing end of the streams over a serial port.
+
+    A write pipe transport cannot share the port with the read pipe
+    transport (both would watch the same file descriptor), so commands,
+    which are a handful of bytes, are written straight to the port.
+    """
+
+    def __init__(self, port, read_transport):
+        self._port = port
+        self._read_transport = read_transport
+
+    def write(self, data):
+        try:
+            self._port.write(data)
+        except serial.SerialException as e:
+            raise TransportError(str(e))
+
+    def close(self):
+        # closing the transport closes the port
+        self._read_transport.close()
+
+
+@asyncio.coroutine
+def _open_serial_streams(port_name, loop):
+    try:
+        port = serial.Serial(port_name, baudrate=SERIAL_BAUDRATE, timeout=0)
+    except serial.SerialException as e:
+        raise TransportError(str(e))
+    reader = asyncio.StreamReader(loop=loop)
+    protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+    transport, _ = yield From(loop.connect_read_pipe(lambda: protocol, port))
+    raise Return((reader, _SerialWriter(port, transport)))
+
+
+class AsyncOBDDevice(object):
+    """Abstract communication with OBD-II device, without blocking.
+
+    Use `connect` to create instances. Requests made concurrently on the same
+    device are sent one after the other.
+    """
+
+    _LOGGER = getLogger(__name__ + '.AsyncOBDDevice')
+
+    def __init__(
+        self,
+        reader,
+        writer,
+        timeout,
+        loop=None,
+        timeout_policies=None,
+        ):
+        self.ELMver = "Unknown"
+        self._reader = reader
+        self._writer = writer
+        # see OBDDevice
+        self.timeout_policies = get_timeout_policies(timeout)
+        self.timeout_policies.update(timeout_policies or {})
+        self.supported_pids = None
+        self.unanswered_requests = UnansweredRequests()
+        self._loop = loop or asyncio.get_event_loop()
+        self._buffer = bytearray()
+        self._lock = asyncio.Lock(loop=loop)
+
+    @classmethod
+    @asyncio.coroutine
+    def connect(cls, port, timeout, loop=None, timeout_policies=None):
+        """Open the port (a serial port name or a "tcp://host:port" URL),
+        reset the device and return it once it is ready. Timeouts are as
+        for OBDDevice."""
+        loop = loop or asyncio.get_event_loop()
+        address = parse_tcp_url(port)
+        if address:
+            host, tcp_port = address
+            try:
+                reader, writer = yield From(
+                    asyncio.open_connection(host, tcp_port, loop=loop),
+                    )
+            except OSError as e:
+                raise TransportError(str(e))
+        else:
+            reader, writer = yield From(_open_serial_streams(port, loop))
+
+        device = cls(reader, writer, timeout, loop, timeout_policies)
+        try:
+            yield From(device._initialize())
+        except Exception:
+            # the caller never gets the device to close, e.g. when
+            # DeviceFleet reconnects to an adapter that does not answer
+            device.close()
+            raise
+        raise Return(device)
+
+    @asyncio.coroutine
+    def _initialize(self):
+        self._LOGGER.info("Connecting to ECU...")
+        # warm start first, as OBDDevice.reset does
+        for reset_command in ("atws", "atz"):
+            result = yield From(self.query(reset_command))
+            if result and "ELM" in result:
+                self.ELMver = result[result.index("ELM"):]
+                break
+        else:
+            if not result:
+                raise TransportError("No response from the device")
+            self.ELMver = result
+        self._LOGGER.info("reset response: %s", self.ELMver)
+
+        ate0_result = yield From(self.query("ate0"))  # echo off
+        self._LOGGER.debug("ate0 response: %s", ate0_result)
+
+        ready = yield From(self.query("0100", SEARCH_COMMAND))
+        if not ready:
+            raise TransportError("No response from the ECU")
+        self._LOGGER.info("0100 response: %s", ready)
+
+    def close(self):
+        """Close the link to the device"""
+        self._writer.close()
+
+    @asyncio.coroutine
+    def query(self, cmd, command_class=None):
+        """Send the command and return its result, like
+        OBDDevice.get_result_for"""
+        policy = self.timeout_policies[command_class or get_command_class(cmd)]
+        frame = yield From(self._query_frame(encode_command(cmd), policy))
+        result = clean_result(frame)
+        self._LOGGER.debug("Get result: %r", result)
+        raise Return(result)
+
+    @asyncio.coroutine
+    def _query_reply(self, encoded_cmd):
+        """Send the OBD request and return the Reply to it"""
+        frame = yield From(self._query_frame(
+            encoded_cmd,
+            self.timeout_policies[OBD_REQUEST],
+            ))
+        reply = parse_reply(frame)
+        self._LOGGER.debug("Get result: %r", reply.lines)
+        raise Return(reply)
+
+    @asyncio.coroutine
+    def _query_frame(self, encoded_cmd, policy):
+        """Send the command and return the frame of its result, sending it
+        again as the policy allows, as OBDDevice does"""
+        with (yield From(self._lock)):
+            retry_delay = policy.retry_delay
+            for attempt in range(policy.retries + 1):
+                if attempt:
+                    self._LOGGER.debug(
+                        "No answer to %r, retrying", encoded_cmd)
+                    yield From(asyncio.sleep(retry_delay, loop=self._loop))
+                    retry_delay *= policy.backoff
+                self._writer.write(encoded_cmd)
+                self._LOGGER.debug("Send command: %r", encoded_cmd)
+                frame = yield From(self._read_frame(policy))
+                if frame or not isinstance(frame, ReadTimeout):
+                    break
+        raise Return(frame)
+
+    @asyncio.coroutine
+    def _read_frame(self, policy):
+        """Read up to the next prompt within the timeouts of the policy, as
+        OBDDevice.read_frame does"""
+        buffer = self._buffer
+        scanned = 0
+        deadline = self._loop.time() + policy.deadline
+        while True:
+            prompt_index = buffer.find(PROMPT, scanned)
+            if prompt_index != -1:
+                frame = str(buffer[:prompt_index])
+                del buffer[:prompt_index + 1]
+                if buffer:
+                    # nothing may follow the prompt until the next command
+                    self._resync()
+                raise Return(frame)
+            scanned = len(buffer)
+
+            remaining_time = deadline - self._loop.time()
+            if remaining_time <= 0:
+                break
+            if not buffer or buffer.rstrip().endswith(BUSY_SUFFIX):
+                timeout = policy.first_byte_timeout
+            else:
+                timeout = policy.inter_byte_timeout
+            try:
+                chunk = yield From(asyncio.wait_for(
+                    self._reader.read(_READ_SIZE),
+                    min(timeout, remaining_time),
+                    loop=self._loop,
+                    ))
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                raise TransportError("Connection closed by the device")
+            buffer.extend(chunk)
+
+        # no prompt in time: hand over whatever arrived
+        frame = ReadTimeout(buffer)
+        self._resync()
+        raise Return(frame)
+
+    def _resync(self):
+        self._LOGGER.warning("Device out of sync, dropping input")
+        del self._buffer[:]
+
+    @asyncio.coroutine
+    def sensor(self, sensor_index):
+        """Return the (name, value, unit) 3-tuple of the sensor, as
+        OBDDevice.sensor does"""
+        sensor = SENSORS[sensor_index]
+        value = yield From(self.get_sensor_value(sensor))
+        raise Return((sensor.name, value, sensor.unit))
+
+    @asyncio.coroutine
+    def get_supported_pids(self):
+        """Return the SupportedPIDs of mode 01, as
+        OBDDevice.get_supported_pids does"""
+        supported_pids = SupportedPIDs()
+        base_pid = 0
+        while base_pid <= LAST_SUPPORTED_PIDS:
+            reply = yield From(self._query_reply(
+                encode_command("01%02X" % base_pid)))
+            bitmap = get_supported_pids_bitmap(reply.messages, base_pid)
+            if bitmap is None:
+                break
+            supported_pids.add_bitmap(base_pid, bitmap)
+            if base_pid + SUPPORTED_PIDS_RANGE not in supported_pids:
+                break
+            base_pid += SUPPORTED_PIDS_RANGE
+        self.supported_pids = supported_pids
+        raise Return(supported_pids)
+
+    @asyncio.coroutine
+    def get_sensor_value(self, sensor):
+        """Return the value of the Sensor, as OBDDevice.get_sensor_value
+        does"""
+        if self.supported_pids is None:
+            yield From(self.get_supported_pids())
+        if is_unanswered(sensor, self.supported_pids, self.unanswered_requests):
+            raise Return("NODATA")
+        reply = yield From(self._query_reply(sensor.encoded_cmd))
+        message = find_reply(sensor, reply.messages)
+        if message is None and reply.messages:
+            # a late reply to an earlier command: ask again
+            self._resync()
+            reply = yield From(self._query_reply(sensor.encoded_cmd))
+            message = find_reply(sensor, reply.messages)
+        if message is None:
+            if reply.status == NO_DATA:
+                self.unanswered_requests.add(sensor.request)
+            value = get_missing_value(reply)
+        else:
+            value = decode_sensor_value(sensor, message)
+        raise Return(value)
+
+    @asyncio.coroutine
+    def get_dtc(self):
+        """Return a list of all pending DTC codes. Each element consists of
+        a 2-tuple: (DTC code (string), Code description (string) )"""
+        _, dtc_status, _ = yield From(self.sensor(1))
+        dtcs = []
+        # without a status (e.g. "NODATA") the codes are read in case there
+        # are any
+        if isinstance(dtc_status, str) or dtc_status[0]:
+            reply = yield From(
+                self._query_reply(encode_command(GET_DTC_COMMAND)),
+                )
+            dtcs.extend(parse_dtcs(reply.messages, 0x03, "Active"))
+
+        reply = yield From(
+            self._query_reply(encode_command(GET_FREEZE_DTC_COMMAND)),
+            )
+        dtcs.extend(parse_dtcs(reply.messages, 0x07, "Passive"))
+        raise Return(dtcs)
+
+    @asyncio.coroutine
+    def clear_dtc(self):
+        """Clear all DTCs and freeze frame data"""
+        result = yield From(self.query(CLEAR_DTC_COMMAND))
+        raise Return(result)
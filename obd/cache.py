@@ -0,0 +1,113 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""On-disk record of what vehicles and adapters support.
+
+Finding out the protocol, supported PIDs and number of responding ECUs of a
+vehicle takes several requests. OBDDevice records them per vehicle (VIN) and
+adapter, so that later sessions with the same pair start polling at once.
+"""
+
+from logging import getLogger
+import json
+import os
+
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"),
+    ".pyobdlib",
+    "capabilities.json",
+    )
+
+
+class CapabilityCache(object):
+    """Capabilities of vehicles, keyed by adapter identifier and VIN.
+
+    Each entry is a dictionary with:
+
+    - "elm_version": identity of the adapter
+    - "protocol": ELM327 protocol number
+    - "supported_pids": supported PID bitmaps, keyed by the hex PID of the
+      range (e.g. "00", "20")
+    - "response_counts": number of ECUs answering each request
+
+    The protocol last used with each adapter is kept too, as a hint for the
+    next connection, before the vehicle is identified.
+    """
+
+    _LOGGER = getLogger(__name__ + '.CapabilityCache')
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self._vehicles = {}
+        self._adapter_protocols = {}
+        try:
+            with open(path) as cache_file:
+                contents = json.load(cache_file)
+        except IOError:
+            return
+        except ValueError:
+            self._LOGGER.warning("Ignoring corrupt capability cache %s", path)
+            return
+        self._vehicles = contents.get("vehicles", {})
+        self._adapter_protocols = contents.get("adapter_protocols", {})
+
+    @staticmethod
+    def _get_key(adapter_id, vin):
+        return "%s|%s" % (adapter_id, vin)
+
+    def get(self, adapter_id, vin):
+        """Return the capabilities recorded for the vehicle and adapter, or
+        None if there are none"""
+        return self._vehicles.get(self._get_key(adapter_id, vin))
+
+    def get_protocol(self, adapter_id):
+        """Return the protocol last used with the adapter, or None"""
+        return self._adapter_protocols.get(adapter_id)
+
+    def put(self, adapter_id, vin, capabilities):
+        """Record the capabilities of the vehicle and save the cache"""
+        self._vehicles[self._get_key(adapter_id, vin)] = capabilities
+        self._adapter_protocols[adapter_id] = capabilities["protocol"]
+        self.save()
+
+    def invalidate(self, adapter_id, vin):
+        """Forget the capabilities of the vehicle, e.g. after they turned
+        out to be wrong"""
+        if self._vehicles.pop(self._get_key(adapter_id, vin), None):
+            self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write a new file and move it in place, so that readers never see
+        # a partial one
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as cache_file:
+            json.dump(
+                {
+                    "vehicles": self._vehicles,
+                    "adapter_protocols": self._adapter_protocols,
+                    },
+                cache_file,
+                )
+        os.rename(temporary_path, self.path)
@@ -22,45 +22,77 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 ###########################################################################
 
+"""Conversions of the data bytes of replies into values.
+
+Codes are the bytes after the mode and PID echo, as a memoryview (or any
+other buffer, e.g. a bytearray).
+"""
+
+from binascii import hexlify
+from collections import namedtuple
+import ast
+import string
+import struct
+
+
+# Unpackers of big-endian unsigned integers, by size in bytes
+_UNSIGNED_INTEGERS = dict(
+    (struct.calcsize(integer_format), struct.Struct(integer_format))
+    for integer_format in (">B", ">H", ">I", ">Q")
+    )
+
+_BIT_STRINGS = [format(byte, "08b") for byte in range(256)]
+
+# Parts formulas can be made of: arithmetic on numbers and byte names
+_FORMULA_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Num,
+    ast.Name,
+    ast.Load,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+    ast.LShift,
+    ast.RShift,
+    ast.BitAnd,
+    ast.BitOr,
+    ast.BitXor,
+    ast.UAdd,
+    ast.USub,
+    ast.Invert,
+    )
+
 
 def noop(code):
     """Return the code with no conversion"""
     return code
 
 
-def to_int(str):
-    """Convert the code (hex string) into an integer"""
-    #i = eval("0x" + str, {}, {})
-    # return i
-    if str == '':
+def to_hex(code):
+    """Return the code as a hex string (e.g. "0BB8")"""
+    return hexlify(code).upper()
+
+
+def to_int(code):
+    """Convert the code (big-endian) into an integer"""
+    unpacker = _UNSIGNED_INTEGERS.get(len(code))
+    if unpacker is not None:
+        return unpacker.unpack_from(code)[0]
+    if not len(code):
         return 0
-    return int(str, 16)
-
-
-def to_bitstring(str):
-    """Convert the given code into a bit string (binary string, equiv. 4 bytes)"""
-    bitstring = ""
-    for i in str:
-        # silly type safety, we don't want to eval random stuff
-        if type(i) == type(''):
-            v = eval("0x%s" % i)
-            if v & 8:
-                bitstring += '1'
-            else:
-                bitstring += '0'
-            if v & 4:
-                bitstring += '1'
-            else:
-                bitstring += '0'
-            if v & 2:
-                bitstring += '1'
-            else:
-                bitstring += '0'
-            if v & 1:
-                bitstring += '1'
-            else:
-                bitstring += '0'
-    return bitstring
+    return int(hexlify(code), 16)
+
+
+def to_bitstring(code):
+    """Convert the given code into a bit string (e.g. "1011..."), 8
+    characters per byte"""
+    return "".join(_BIT_STRINGS[byte] for byte in bytearray(code))
 
 
 def to_percent_scale(code):
@@ -98,9 +130,195 @@ def to_maf_grams_sec(code):
     return to_int(code) / 100.0
 
 
+# Conversion of the form value = raw * multiplier / divisor + offset, where
+# raw is the code read as an unsigned integer. Integer arguments keep the
+# value an integer (e.g. RPM), like the functions above.
+LinearConversion = namedtuple(
+    "LinearConversion",
+    ["multiplier", "divisor", "offset"],
+    )
+
+# The conversions of the functions above
+IDENTITY = LinearConversion(1, 1, 0)
+PERCENT_SCALE = LinearConversion(100.0, 255, 0)
+TEMP_C = LinearConversion(1, 1, -40)
+FUEL_TRIM_PERCENT = LinearConversion(100.0, 128, -100.0)
+KPA_GAUGE = LinearConversion(3, 1, 0)
+RPM = LinearConversion(1, 4, 0)
+TIMING_ADVANCE = LinearConversion(1, 2.0, -64.0)
+MAF_GRAMS_SEC = LinearConversion(1, 100.0, 0)
+
+
+def compile_conversion(conversion, size):
+    """Return a function converting codes of the given size in bytes as per
+    the linear conversion.
+
+    Values of single-byte codes are looked up in a table computed here, and
+    those of other sizes are worked out from the unpacked integer. Codes
+    shorter than expected are converted from what there is.
+    """
+    multiplier, divisor, offset = conversion
+
+    def convert_raw(raw):
+        return raw * multiplier / divisor + offset
+
+    def convert_code(code):
+        return convert_raw(to_int(code))
+
+    unpacker = _UNSIGNED_INTEGERS.get(size)
+    if unpacker is None:
+        return convert_code
+    unpack_from = unpacker.unpack_from
+
+    if size == 1:
+        values = [convert_raw(raw) for raw in range(256)]
+
+        def convert(code):
+            try:
+                return values[unpack_from(code)[0]]
+            except struct.error:
+                return convert_code(code)
+    elif conversion == IDENTITY:
+        def convert(code):
+            try:
+                return unpack_from(code)[0]
+            except struct.error:
+                return to_int(code)
+    else:
+        def convert(code):
+            try:
+                return unpack_from(code)[0] * multiplier / divisor + offset
+            except struct.error:
+                return convert_code(code)
+    return convert
+
+
+def compile_formula(formula, size):
+    """Return the code of a function of the `size` data bytes, named A, B,
+    C, ... in order, computing the formula (e.g. "(256*A+B)/4").
+
+    Formulas are arithmetic as in Python: integers divide as integers, so
+    fractions need a float (e.g. "A*100.0/255"). ValueError is raised for
+    anything else.
+    """
+    byte_names = string.ascii_uppercase[:size]
+    try:
+        tree = ast.parse(formula, mode="eval")
+    except SyntaxError:
+        raise ValueError("Invalid formula %r" % formula)
+    for node in ast.walk(tree):
+        if not isinstance(node, _FORMULA_NODES) or \
+                isinstance(node, ast.Name) and node.id not in byte_names:
+            raise ValueError("Invalid formula %r" % formula)
+    return compile(
+        "lambda %s: %s" % (", ".join(byte_names), formula),
+        "<formula %s>" % formula,
+        "eval",
+        )
+
+
+def get_linear_conversion(formula, size):
+    """Return the LinearConversion computing the formula of `size` data
+    bytes (see compile_formula), or None if it is not one.
+
+    Formulas are recognized when written in the order the conversion
+    computes them, e.g. "(256*A+B)/10.0-40", so that both give the same
+    values.
+    """
+    node = ast.parse(formula, mode="eval").body
+    multiplier, divisor, offset = 1, 1, 0
+    if _is_constant_operation(node, (ast.Add, ast.Sub)):
+        offset = node.right.n if isinstance(node.op, ast.Add) else -node.right.n
+        node = node.left
+    if _is_constant_operation(node, (ast.Div,)):
+        divisor = node.right.n
+        node = node.left
+    if _is_constant_operation(node, (ast.Mult,)):
+        multiplier = node.right.n
+        node = node.left
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult) and \
+            isinstance(node.left, ast.Num):
+        multiplier = node.left.n
+        node = node.right
+    if _get_raw_size(node) != size:
+        return None
+    return LinearConversion(multiplier, divisor, offset)
+
+
+def _is_constant_operation(node, operators):
+    return isinstance(node, ast.BinOp) and isinstance(node.op, operators) \
+        and isinstance(node.right, ast.Num)
+
+
+def _get_raw_size(node):
+    """Return the number of data bytes the node reads as a big-endian
+    unsigned integer (e.g. 2 for "256*A+B"), or None"""
+    terms = []
+    while isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        terms.append(node.right)
+        node = node.left
+    terms.append(node)
+    terms.reverse()
+    size = len(terms)
+    for index, term in enumerate(terms):
+        weight = 256 ** (size - 1 - index)
+        if weight != 1 and isinstance(term, ast.BinOp) and \
+                isinstance(term.op, ast.Mult) and \
+                isinstance(term.left, ast.Num) and term.left.n == weight:
+            term = term.right
+        elif weight != 1:
+            return None
+        if not isinstance(term, ast.Name) or \
+                term.id != string.ascii_uppercase[index]:
+            return None
+    return size
+
+
+def get_formula_table(formula_code):
+    """Return the values of the compiled formula of a single byte, by
+    byte"""
+    compute = eval(formula_code, {"__builtins__": {}})
+    return [compute(byte) for byte in range(256)]
+
+
+def make_formula_conversion(formula_code, size, table=None):
+    """Return a function converting codes of the given size in bytes with
+    the compiled formula (see compile_formula).
+
+    Single-byte codes are looked up in the table (see get_formula_table),
+    computed here if not given. Codes shorter than expected are taken as
+    the low bytes of the value, as the conversion functions do.
+    """
+    compute = eval(formula_code, {"__builtins__": {}})
+
+    def convert_code(code):
+        return compute(*bytearray(code[:size]).rjust(size, "\0"))
+
+    if size == 1:
+        values = table or get_formula_table(formula_code)
+        unpack_from = _UNSIGNED_INTEGERS[1].unpack_from
+
+        def convert(code):
+            try:
+                return values[unpack_from(code)[0]]
+            except struct.error:
+                return convert_code(code)
+    else:
+        unpack_from = struct.Struct(">%dB" % size).unpack_from
+
+        def convert(code):
+            try:
+                return compute(*unpack_from(code))
+            except struct.error:
+                return convert_code(code)
+    return convert
+
+
 def dtc_decode(code):
-    # first byte is byte after PID and without spaces
-    num = to_int(code[:2])  # A byte
+    # A, B, C and D bytes after the PID
+    numA, numB, numC, numD = bytearray(code[:4]).ljust(4, "\0")
+
+    num = numA
     res = []
 
     if num & 0x80:  # is mil light on
@@ -114,14 +332,9 @@ def dtc_decode(code):
     res.append(num)
     res.append(mil)
 
-    numB = to_int(code[2:4])  # B byte
-
     for i in range(0, 3):
         res.append(((numB >> i) & 0x01) + ((numB >> (3 + i)) & 0x02))
 
-    numC = to_int(code[4:6])  # C byte
-    numD = to_int(code[6:8])  # D byte
-
     for i in range(0, 7):
         res.append(((numC >> i) & 0x01) + (((numD >> i) & 0x01) << 1))
 
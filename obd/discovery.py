@@ -0,0 +1,146 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""Finding ELM327 adapters among the ports of the host.
+
+Every candidate port is probed at the same time with a short identity check
+(ATI), so discovery takes about as long as the slowest probe instead of the
+sum of all of them.
+"""
+
+from collections import namedtuple
+from logging import getLogger
+import Queue
+import threading
+import time
+
+from serial.tools.list_ports import comports
+
+from .elm import PROMPT
+from .elm import encode_command
+from .transport import TransportError
+from .transport import open_transport
+
+
+# Seconds to wait for an adapter to answer the identity check
+PROBE_TIMEOUT = 0.5
+
+_LOGGER = getLogger(__name__)
+
+
+AdapterInfo = namedtuple(
+    "AdapterInfo",
+    [
+        "port",
+        # the adapter's answer to ATI, e.g. "ELM327 v1.5"
+        "identity",
+        # seconds taken by the probe
+        "probe_time",
+        ],
+    )
+
+
+def probe(port, timeout=PROBE_TIMEOUT):
+    """Return the AdapterInfo of the ELM327 adapter on the port (a serial
+    port name or a "tcp://host:port" URL), or None if there is none"""
+    start_time = time.time()
+    try:
+        transport = open_transport(port, timeout)
+    except TransportError as e:
+        _LOGGER.debug("Cannot open %s: %s", port, e)
+        return None
+
+    reply = bytearray()
+    try:
+        transport.write(encode_command("ati"))
+        deadline = start_time + timeout
+        while PROMPT not in reply and time.time() < deadline:
+            chunk = transport.read_available()
+            if not chunk:
+                break
+            reply.extend(chunk)
+    except TransportError as e:
+        _LOGGER.debug("Probe of %s failed: %s", port, e)
+        return None
+    finally:
+        transport.close()
+
+    probe_time = time.time() - start_time
+    for line in str(reply).replace(PROMPT, "\r").split("\r"):
+        line = line.strip()
+        if line.startswith("ELM"):
+            _LOGGER.info("%s found on %s in %.3f s", line, port, probe_time)
+            return AdapterInfo(port, line, probe_time)
+
+    _LOGGER.debug("No adapter on %s (%.3f s)", port, probe_time)
+    return None
+
+
+def _report_probe(port, timeout, results):
+    """Probe the port and put the result in the queue, None if the probe
+    failed in any way, so that discover hears back from every probe"""
+    adapter = None
+    try:
+        adapter = probe(port, timeout)
+    except Exception:
+        _LOGGER.exception("Probe of %s failed", port)
+    finally:
+        results.put(adapter)
+
+
+def discover(ports=None, timeout=PROBE_TIMEOUT, first=False):
+    """Probe the ports (all the serial ports of the host by default) at the
+    same time and return the AdapterInfo of the adapters found, in the
+    order they answered.
+
+    With `first`, return as soon as one adapter answers; the other probes
+    finish in the background.
+    """
+    if ports is None:
+        ports = [port for port, _description, _hardware_id in comports()]
+
+    start_time = time.time()
+    results = Queue.Queue()
+    for port in ports:
+        thread = threading.Thread(
+            target=_report_probe,
+            args=(port, timeout, results),
+            name="probe %s" % port,
+            )
+        thread.daemon = True
+        thread.start()
+
+    adapters = []
+    for _ in ports:
+        adapter = results.get()
+        if adapter is None:
+            continue
+        adapters.append(adapter)
+        if first:
+            break
+
+    _LOGGER.info(
+        "Found %d adapter(s) among %d port(s) in %.3f s",
+        len(adapters),
+        len(ports),
+        time.time() - start_time,
+        )
+    return adapters
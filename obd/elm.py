@@ -0,0 +1,135 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""Wire-level details of the ELM327 command interface"""
+
+from collections import namedtuple
+import re
+
+PROMPT = ">"
+
+# The ELM327 executes a command on carriage return and ignores line feeds
+COMMAND_TERMINATOR = "\r"
+
+# First version accepting the number of expected responses after a request
+RESPONSE_COUNT_VERSION = (1, 3)
+
+# Largest number of expected responses a request can carry (one hex digit)
+MAX_RESPONSE_COUNT = 0xF
+
+# Baud rates are set as divisors of this clock (ATBRD)
+BAUDRATE_CLOCK = 4000000
+
+# Smallest divisor, i.e. fastest rate, the ELM327 accepts (500 kbps)
+MIN_BAUDRATE_DIVISOR = 8
+
+# Lines ending like this ("SEARCHING...", "BUS INIT: ...") mean that the
+# device is still working on the command and may stay silent for seconds
+BUSY_SUFFIX = "..."
+
+# Classes of commands, which take more or less time to be answered: commands
+# answered by the adapter itself (AT and ST commands), resets, the first
+# request to the vehicle, during which the device finds its protocol, and
+# other OBD requests
+ADAPTER_COMMAND = "adapter"
+RESET_COMMAND = "reset"
+SEARCH_COMMAND = "search"
+OBD_REQUEST = "obd"
+
+_RESET_COMMANDS = frozenset(["atz", "atws", "atd"])
+
+# Seconds allowed for the device to search for the vehicle protocol
+SEARCH_TIMEOUT = 20.0
+
+TimeoutPolicy = namedtuple(
+    "TimeoutPolicy",
+    [
+        # seconds allowed before the first byte of the reply, and after a
+        # line ending with BUSY_SUFFIX
+        "first_byte_timeout",
+        # seconds of silence allowed once the reply has started
+        "inter_byte_timeout",
+        # seconds allowed for the whole reply
+        "deadline",
+        # times the command is sent again when the device sends nothing
+        "retries",
+        # seconds waited before the first retry, multiplied by `backoff`
+        # before each of the next ones
+        "retry_delay",
+        "backoff",
+        ],
+    )
+
+_ENCODED_COMMANDS = {}
+
+_VERSION_PATTERN = re.compile(r"ELM327 v(\d+)\.(\d+)")
+
+
+def encode_command(cmd):
+    """Return the exact bytes to write to the device to run the command.
+
+    Encodings are cached, so repeated commands are only built once.
+    """
+    try:
+        return _ENCODED_COMMANDS[cmd]
+    except KeyError:
+        encoded_cmd = _ENCODED_COMMANDS[cmd] = str(cmd) + COMMAND_TERMINATOR
+        return encoded_cmd
+
+
+def parse_version(identity):
+    """Return the (major, minor) version in the identity string the device
+    sends on reset (e.g. "ELM327 v1.5"), or None if it is not there"""
+    match = _VERSION_PATTERN.search(identity or "")
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def get_command_class(cmd):
+    """Return the class of the command (e.g. ADAPTER_COMMAND for "atdpn")"""
+    cmd = cmd.strip().lower()
+    if cmd in _RESET_COMMANDS:
+        return RESET_COMMAND
+    if cmd.startswith(("at", "st")):
+        return ADAPTER_COMMAND
+    return OBD_REQUEST
+
+
+def get_timeout_policies(timeout):
+    """Return the TimeoutPolicy of each class of commands, for a vehicle
+    expected to answer OBD requests within `timeout` seconds"""
+    return {
+        ADAPTER_COMMAND: TimeoutPolicy(1.0, 0.2, 2.0, 1, 0.1, 2.0),
+        # the adapter takes about a second to come back after a reset
+        RESET_COMMAND: TimeoutPolicy(5.0, 0.5, 5.0, 0, 0.0, 1.0),
+        SEARCH_COMMAND: TimeoutPolicy(
+            max(timeout, SEARCH_TIMEOUT),
+            0.5,
+            max(timeout, SEARCH_TIMEOUT),
+            0,
+            0.0,
+            1.0,
+            ),
+        # other ECUs may answer up to the device's own timeout (ATST, 200 ms
+        # by default) after the first one
+        OBD_REQUEST: TimeoutPolicy(timeout, 0.5, 2 * timeout, 1, 0.1, 2.0),
+        }
@@ -0,0 +1,362 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""Polling many adapters from a single thread.
+
+A DeviceFleet connects to any number of adapters and polls each of them on
+its own schedule, from one asyncio (trollius) event loop::
+
+    fleet = DeviceFleet(2)
+    for port in ports:
+        fleet.add(port, {"rpm": 10, "speed": 10, "temp": 1})
+    fleet.run(60, callback=lambda port, shortname, value, timestamp: ...)
+    device_metrics, fleet_metrics = fleet.get_metrics()
+
+Schedules give reads per second by sensor short name, as for
+PollingScheduler. Each device reads next the sensor whose read is due
+soonest. Commands, errors and latencies are counted per device and for the
+whole fleet.
+"""
+
+from collections import deque
+from collections import namedtuple
+from logging import getLogger
+import math
+import time
+
+import trollius as asyncio
+from trollius import From
+from trollius import Return
+
+from .aio import AsyncOBDDevice
+from .replies import ReplyError
+from .scheduler import get_sensor
+from .transport import TransportError
+
+
+# Seconds to wait before connecting again to a device that failed
+RECONNECT_DELAY = 1.0
+
+# Percentiles of the latency of commands reported in the metrics
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# Number of latest command latencies the percentiles are worked out from
+LATENCY_SAMPLE_SIZE = 10000
+
+
+DeviceMetrics = namedtuple(
+    "DeviceMetrics",
+    [
+        "commands",
+        # commands that failed or got no response, and failed connections
+        "errors",
+        "commands_per_second",
+        # seconds, keyed by percentile (see LATENCY_PERCENTILES)
+        "latency_percentiles",
+        ],
+    )
+
+
+def get_percentile(sorted_values, percentile):
+    """Return the percentile (nearest rank) of the sorted values, or None if
+    there are none"""
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percentile / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class _MetricsRecorder(object):
+
+    def __init__(self):
+        self.commands = 0
+        self.errors = 0
+        # the latest ones only, so that long runs take bounded memory
+        self.latencies = deque(maxlen=LATENCY_SAMPLE_SIZE)
+        self.first_command_time = None
+        self.last_command_time = None
+
+    def record_command(self, start_time, end_time, error=False):
+        self.commands += 1
+        if error:
+            self.errors += 1
+        self.latencies.append(end_time - start_time)
+        if self.first_command_time is None:
+            self.first_command_time = start_time
+        self.last_command_time = end_time
+
+    def get_metrics(self):
+        return _summarize(
+            self.commands,
+            self.errors,
+            self.latencies,
+            self.first_command_time,
+            self.last_command_time,
+            )
+
+
+def _summarize(commands, errors, latencies, first_command_time, last_command_time):
+    if commands and last_command_time > first_command_time:
+        commands_per_second = \
+            commands / (last_command_time - first_command_time)
+    else:
+        commands_per_second = 0.0
+    latencies = sorted(latencies)
+    return DeviceMetrics(
+        commands,
+        errors,
+        commands_per_second,
+        dict(
+            (percentile, get_percentile(latencies, percentile))
+            for percentile in LATENCY_PERCENTILES
+            ),
+        )
+
+
+class _FleetDevice(object):
+
+    def __init__(self, port, rates):
+        self.port = port
+        self.schedule = []
+        for shortname, rate in sorted(rates.items()):
+            if rate <= 0:
+                raise ValueError(
+                    "Rate of %s must be positive: %r" % (shortname, rate))
+            self.schedule.append((get_sensor(shortname), 1.0 / rate))
+        self.device = None
+        # time each sensor is next due, once connected
+        self.deadlines = None
+        self.task = None
+        self.removed = False
+        # done once the link is closed after removing the adapter
+        self.released = None
+        self.metrics = _MetricsRecorder()
+
+
+class DeviceFleet(object):
+    """Adapters polled on per-device schedules from one event loop.
+
+    Adapters may be added and removed while the fleet is polling.
+    """
+
+    _LOGGER = getLogger(__name__ + '.DeviceFleet')
+
+    def __init__(self, timeout, loop=None):
+        self.timeout = timeout
+        self._loop = loop or asyncio.get_event_loop()
+        self._devices = {}
+        self._callback = None
+        self._end_time = None
+        # set when polling ends, None before it starts
+        self._stopped = None
+
+    def add(self, port, rates):
+        """Poll the adapter on the port (a serial port name or a
+        "tcp://host:port" URL) with the rates, in reads per second by
+        sensor short name"""
+        if not rates:
+            raise ValueError("No sensors to poll on %s" % port)
+        if port in self._devices:
+            raise ValueError("%s is already in the fleet" % port)
+        fleet_device = _FleetDevice(port, rates)
+        self._devices[port] = fleet_device
+        if self.polling:
+            self._start_polling(fleet_device)
+
+    def remove(self, port):
+        """Stop polling the adapter on the port and close the link to it.
+
+        Return a future done once the link is closed, which a polling task
+        only does when its command in flight is done.
+        """
+        fleet_device = self._devices.pop(port)
+        fleet_device.removed = True
+        fleet_device.released = asyncio.Future(loop=self._loop)
+        if fleet_device.task is None or fleet_device.task.done():
+            self._close_device(fleet_device)
+        return fleet_device.released
+
+    @property
+    def ports(self):
+        return sorted(self._devices)
+
+    @property
+    def polling(self):
+        return self._stopped is not None and not self._stopped.is_set()
+
+    def run(self, duration=None, callback=None):
+        """Poll all the adapters for `duration` seconds, passing the port,
+        sensor short name, value and time of each read to the callback.
+
+        Without a duration, polling goes on until `stop` is called.
+        """
+        self._loop.run_until_complete(self.poll(duration, callback))
+
+    @asyncio.coroutine
+    def poll(self, duration=None, callback=None):
+        """Coroutine polling as `run` does, for use in a running loop"""
+        if self.polling:
+            raise RuntimeError("The fleet is already polling")
+        loop = self._loop
+        self._callback = callback
+        self._stopped = asyncio.Event(loop=loop)
+        if duration is None:
+            self._end_time = None
+            stop_handle = None
+        else:
+            self._end_time = loop.time() + duration
+            stop_handle = loop.call_at(self._end_time, self.stop)
+        for fleet_device in self._devices.values():
+            self._start_polling(fleet_device)
+        try:
+            yield From(self._stopped.wait())
+        finally:
+            if stop_handle is not None:
+                stop_handle.cancel()
+            self._stopped.set()
+        tasks = [
+            fleet_device.task
+            for fleet_device in self._devices.values()
+            if fleet_device.task is not None
+            ]
+        if tasks:
+            yield From(asyncio.wait(tasks, loop=loop))
+
+    def stop(self):
+        """Have `poll` return once the commands in progress are done"""
+        if self._stopped is not None:
+            self._stopped.set()
+
+    def _start_polling(self, fleet_device):
+        fleet_device.task = asyncio.ensure_future(
+            self._poll_device(fleet_device),
+            loop=self._loop,
+            )
+
+    @asyncio.coroutine
+    def _poll_device(self, fleet_device):
+        loop = self._loop
+        schedule = fleet_device.schedule
+        metrics = fleet_device.metrics
+        try:
+            while self.polling and not fleet_device.removed:
+                device = fleet_device.device
+                if device is None:
+                    device = yield From(self._connect(fleet_device))
+                    if device is None:
+                        yield From(asyncio.sleep(RECONNECT_DELAY, loop=loop))
+                    continue
+
+                deadlines = fleet_device.deadlines
+                index = min(range(len(schedule)), key=deadlines.__getitem__)
+                delay = deadlines[index] - loop.time()
+                if 0 < delay:
+                    if self._end_time is not None and \
+                            self._end_time <= loop.time() + delay:
+                        break
+                    yield From(asyncio.sleep(delay, loop=loop))
+                    # the fleet may have stopped meanwhile
+                    continue
+
+                sensor, period = schedule[index]
+                start_time = loop.time()
+                try:
+                    value = yield From(device.get_sensor_value(sensor))
+                except TransportError as e:
+                    self._LOGGER.warning("Lost %s: %s", fleet_device.port, e)
+                    metrics.record_command(start_time, loop.time(), error=True)
+                    self._close_device(fleet_device)
+                    continue
+                metrics.record_command(
+                    start_time,
+                    loop.time(),
+                    error=isinstance(value, ReplyError),
+                    )
+                deadlines[index] = max(deadlines[index] + period, start_time)
+                if self._callback is not None:
+                    self._callback(
+                        fleet_device.port,
+                        sensor.shortname,
+                        value,
+                        time.time(),
+                        )
+        finally:
+            if fleet_device.removed:
+                self._close_device(fleet_device)
+
+    @asyncio.coroutine
+    def _connect(self, fleet_device):
+        try:
+            device = yield From(AsyncOBDDevice.connect(
+                fleet_device.port,
+                self.timeout,
+                self._loop,
+                ))
+        except (TransportError, OSError) as e:
+            self._LOGGER.warning(
+                "Cannot connect to %s: %s", fleet_device.port, e)
+            fleet_device.metrics.errors += 1
+            device = None
+        else:
+            now = self._loop.time()
+            fleet_device.deadlines = [now] * len(fleet_device.schedule)
+        fleet_device.device = device
+        raise Return(device)
+
+    @staticmethod
+    def _close_device(fleet_device):
+        if fleet_device.device is not None:
+            fleet_device.device.close()
+            fleet_device.device = None
+        released = fleet_device.released
+        if released is not None and not released.done():
+            released.set_result(None)
+
+    def get_metrics(self):
+        """Return the DeviceMetrics of each adapter, by port, and those of
+        the whole fleet"""
+        device_metrics = {}
+        latencies = []
+        commands = errors = 0
+        first_command_times = []
+        last_command_times = []
+        for port, fleet_device in self._devices.items():
+            recorder = fleet_device.metrics
+            device_metrics[port] = recorder.get_metrics()
+            commands += recorder.commands
+            errors += recorder.errors
+            latencies.extend(recorder.latencies)
+            if recorder.commands:
+                first_command_times.append(recorder.first_command_time)
+                last_command_times.append(recorder.last_command_time)
+        fleet_metrics = _summarize(
+            commands,
+            errors,
+            latencies,
+            min(first_command_times) if first_command_times else None,
+            max(last_command_times) if last_command_times else None,
+            )
+        return device_metrics, fleet_metrics
+
+    def close(self):
+        """Close the links to all the adapters"""
+        for fleet_device in self._devices.values():
+            self._close_device(fleet_device)
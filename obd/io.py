@@ -24,10 +24,38 @@
 from logging import getLogger
 import time
 
-import serial
-
+from .conversion import to_hex
 from .conversion import to_int
+from .elm import BAUDRATE_CLOCK
+from .elm import BUSY_SUFFIX
+from .elm import MAX_RESPONSE_COUNT
+from .elm import MIN_BAUDRATE_DIVISOR
+from .elm import OBD_REQUEST
+from .elm import PROMPT
+from .elm import RESET_COMMAND
+from .elm import RESPONSE_COUNT_VERSION
+from .elm import SEARCH_COMMAND
+from .elm import encode_command
+from .elm import get_command_class
+from .elm import get_timeout_policies
+from .elm import parse_version
+from .pids import LAST_SUPPORTED_PIDS
+from .pids import SUPPORTED_PIDS_BITMAP_SIZE
+from .pids import SUPPORTED_PIDS_RANGE
+from .pids import SupportedPIDs
+from .replies import NO_DATA
+from .replies import ReadTimeout
+from .replies import UnansweredRequests
+from .replies import find_reply
+from .replies import get_missing_value
+from .replies import get_payload
+from .replies import parse_reply
+from .replies import strip_headers
+from .sensors import PID_DATA_SIZES
 from .sensors import SENSORS
+from .transport import Transport
+from .transport import TransportError
+from .transport import open_transport
 
 
 GET_DTC_COMMAND = "03"
@@ -36,68 +64,517 @@ CLEAR_DTC_COMMAND = "04"
 
 GET_FREEZE_DTC_COMMAND = "07"
 
+GET_VIN_COMMAND = "0902"
+
+GET_CALIBRATION_IDS_COMMAND = "0904"
+
+# Flow control frame sent to the ECUs on CAN during long replies: go on, with
+# no limit on the frames between flow control frames (block size 0) and no
+# delay between frames (separation time 0), so that a reply comes in one go
+FLOW_CONTROL_DATA = "300000"
+
+# Request headers addressing all ECUs (functional addressing) on 11-bit and
+# 29-bit CAN, as set with ATSH
+FUNCTIONAL_REQUEST_HEADER = "7DF"
+EXTENDED_FUNCTIONAL_REQUEST_HEADER = "DB33F1"
+
+# Characters of each calibration identifier (mode 09 PID 04)
+CALIBRATION_ID_SIZE = 16
+
+# Sent to stop monitoring. Spaces in commands are ignored by the device, so
+# it does no harm if monitoring already stopped on its own.
+MONITOR_STOP_CHARACTER = " "
+
+# Line the device sends before it stops monitoring for lack of buffer space
+MONITOR_BUFFER_FULL = "BUFFER FULL"
+
+# Seconds without a monitored frame after which monitor yields None, so that
+# callers get control back on a quiet bus
+MONITOR_IDLE_TIMEOUT = 1.0
+
+# Largest 11-bit and 29-bit CAN identifiers
+MAX_STANDARD_CAN_ID = 0x7FF
+MAX_EXTENDED_CAN_ID = 0x1FFFFFFF
+
+# Number of results from earlier commands skipped while connecting
+MAX_STALE_RESULTS = 2
+
+# Baud rates tried by OBDDevice.negotiate_baudrate, fastest first. Rates
+# above 500 kbps are only reached by STN-based adapters.
+NEGOTIATED_BAUDRATES = (2000000, 1000000, 500000, 230400, 115200, 57600)
+
+# Round trips that must succeed at a new baud rate for it to be kept
+BAUDRATE_CHECKS = 3
+
+DTC_LETTERS = ["P", "C", "B", "U"]
+
+# ELM327 protocol numbers (as reported by ATDPN) of the CAN protocols
+CAN_PROTOCOLS = frozenset("6789ABC")
+
+# CAN protocols with 29-bit identifiers; the others use 11-bit ones
+EXTENDED_ID_PROTOCOLS = frozenset("79")
+
+# Mode 01 PIDs that a single request can carry on CAN
+MAX_PIDS_PER_REQUEST = 6
+
+# Ends the monitored frames when the device ran out of buffer
+_BUFFER_FULL = object()
+
+
+def interpret_result(code):
+    """Return the data in the result of a request, as a hex string without
+    the mode and PID echo, or "NODATA" if the vehicle did not answer"""
+    reply = parse_reply(code)
+    if not reply.messages:
+        return "NODATA"
+    return to_hex(get_payload(reply.messages[0]))
+
+
+def clean_result(frame):
+    """Return the result in the frame read from the device, or None if the
+    frame is empty. Frames cut short by a timeout give a ReadTimeout, empty
+    if nothing was received."""
+    result = frame.replace("\r", "")
+    if isinstance(frame, ReadTimeout):
+        return ReadTimeout(result)
+    if result == "":
+        return None
+    return result
+
+
+def decode_sensor_value(sensor, message):
+    """Return the value of the sensor in the message answering its command,
+    or "NODATA" if there is none"""
+    if message is None:
+        return "NODATA"
+    return sensor.value(get_payload(message, len(sensor.reply_prefix)))
+
+
+def is_unanswered(sensor, supported_pids, unanswered_requests):
+    """Return whether the vehicle is known not to answer the sensor: its
+    mode 01 PID is not among the SupportedPIDs (if any were found), or its
+    request was answered NO DATA lately"""
+    if supported_pids and sensor.reply_mode == 0x41 and \
+            sensor.pid not in supported_pids:
+        return True
+    return sensor.request in unanswered_requests
+
+
+def get_supported_pids_bitmap(messages, base_pid):
+    """Return the bitmap of supported PIDs in the messages answering PID
+    `base_pid`, or None if there is none. A PID is supported if any ECU
+    supports it."""
+    # read as they are: the sizes of the PIDs in PID_DATA_SIZES only cover
+    # those of sensors
+    echo = bytearray([0x41, base_pid])
+    end = len(echo) + SUPPORTED_PIDS_BITMAP_SIZE
+    bitmap = None
+    for message in messages:
+        if message.startswith(echo) and len(message) >= end:
+            bitmap = (bitmap or 0) | to_int(memoryview(message)[2:end])
+    return bitmap
+
+
+def split_result_lines(frame):
+    """Return the non-empty lines in the frame read from the device"""
+    return [line.strip() for line in frame.split("\r") if line.strip()]
+
+
+def demultiplex_pids(messages, mode):
+    """Return the data of each PID, as a memoryview keyed by PID, in the
+    messages answering a request for several PIDs of the given mode"""
+    return split_pid_data(messages, mode)[0]
+
+
+def split_pid_data(messages, mode):
+    """Return the data of each PID as demultiplex_pids does, and whether
+    the messages were split in full. Splitting a message stops at a PID of
+    unknown size, which leaves out the PIDs after it."""
+    reply_mode = mode + 0x40
+    pid_data = {}
+    complete = True
+    for message in messages:
+        if not message or message[0] != reply_mode:
+            continue
+        view = memoryview(message)
+        position = 1
+        while position < len(message):
+            pid = message[position]
+            size = PID_DATA_SIZES.get(pid)
+            if size is None:
+                # unknown size: the rest of the message cannot be split
+                complete = False
+                break
+            data = view[position + 1:position + 1 + size]
+            # several ECUs may answer: keep the first answer
+            pid_data.setdefault(pid, data)
+            position += 1 + size
+    return pid_data, complete
+
+
+def _get_mode_09_data(messages, pid):
+    """Return the data answering a mode 09 request for the PID: that of each
+    message on CAN, or that of the numbered messages of other protocols
+    joined together"""
+    header = bytearray([0x49, pid])
+    parts = [message for message in messages if message[:2] == header]
+    if not parts:
+        return []
+    if all(len(part) == 7 for part in parts):
+        # four bytes per message, the third byte being its index
+        data = bytearray()
+        for part in sorted(parts, key=lambda part: part[2]):
+            data.extend(part[3:])
+        return [data]
+    # CAN: a message per ECU, whose third byte is the number of items
+    return [part[3:] for part in parts]
+
+
+def parse_vin(messages):
+    """Return the VIN in the messages answering a mode 09 PID 02 request, or
+    None if there is none"""
+    for data in _get_mode_09_data(messages, 0x02):
+        return str(data).strip("\x00") or None
+    return None
+
+
+def parse_calibration_ids(messages):
+    """Return the calibration identifiers in the messages answering a mode
+    09 PID 04 request"""
+    calibration_ids = []
+    for data in _get_mode_09_data(messages, 0x04):
+        for start in range(0, len(data), CALIBRATION_ID_SIZE):
+            calibration_id = data[start:start + CALIBRATION_ID_SIZE]
+            calibration_id = str(calibration_id).strip("\x00")
+            if calibration_id:
+                calibration_ids.append(calibration_id)
+    return calibration_ids
+
+
+def decode_dtc(value):
+    """Return the trouble code (e.g. "P0133") encoded in the 16-bit value"""
+    return "%s%04X" % (DTC_LETTERS[value >> 14], value & 0x3FFF)
+
+
+def parse_dtcs(messages, mode, status):
+    """Return the [status, code] pairs in the messages answering a mode 03
+    or 07 request"""
+    reply_mode = mode + 0x40
+    DTCCodes = []
+    for message in messages:
+        if not message or message[0] != reply_mode:
+            continue
+        if len(message) % 2:
+            # three codes per message, zeros filling the last one
+            data = message[1:]
+        else:
+            # CAN: the number of codes, then all of them
+            data = message[2:2 + 2 * message[1]]
+        for position in range(0, len(data) - 1, 2):
+            val = data[position] << 8 | data[position + 1]  # DTC val as int
+            if val == 0:  # skip fill of last packet
+                continue
+            DTCCodes.append([status, decode_dtc(val)])
+    return DTCCodes
+
 
 class OBDDevice(object):
     """Abstract communication with OBD-II device."""
 
     _LOGGER = getLogger(__name__ + 'OBDDevice')
 
-    def __init__(self, serial_port, SERTIMEOUT):
-        """Reset the device and retrieve supported PIDs"""
+    def __init__(
+        self,
+        serial_port,
+        SERTIMEOUT,
+        protocol=None,
+        cache=None,
+        timeout_policies=None,
+        ):
+        """Reset the device and retrieve supported PIDs
+
+        `serial_port` is either a Transport or a port to open one for: the
+        name of a serial port or a "tcp://host:port" URL. Passing the
+        `protocol` the vehicle uses, as found on a previous connection in
+        `OBDDevice.protocol`, saves the device from searching for it.
+
+        With a CapabilityCache, the vehicle's capabilities (protocol,
+        supported PIDs, responding ECUs) are taken from it when it knows the
+        vehicle (by VIN) and adapter, instead of finding them out again.
+
+        Replies are waited for as set by the TimeoutPolicy of each class of
+        commands (see obd.elm.get_timeout_policies), with the vehicle given
+        SERTIMEOUT seconds to answer OBD requests. `timeout_policies`
+        replaces the policies of some classes.
+        """
         self.ELMver = "Unknown"
         # state SERIAL is 1 connected, 0 disconnected (connection failed)
         self.state = 1
         self.port = None
+        # ELM327 number of the protocol used by the vehicle, see get_protocol
+        self.protocol = None
+        # seconds from opening the port to being ready for readings
+        self.connect_time = None
+        self.vin = None
+        # SupportedPIDs of mode 01, see get_supported_pids; found on the
+        # first sensor read if not before
+        self.supported_pids = None
+        # requests not sent again for a while, see UnansweredRequests
+        self.unanswered_requests = UnansweredRequests()
+        # whether the device shows headers (ATH1), so that the frames of CAN
+        # replies are reassembled here
+        self.headers = False
+        # CAN identifier of the only ECU listened to, see select_ecu
+        self.selected_ecu = None
+        self._cache = None
+        self.timeout_policies = get_timeout_policies(SERTIMEOUT)
+        self.timeout_policies.update(timeout_policies or {})
+        # bytes received from the device and not yet consumed, kept across
+        # calls so that reads never reallocate the buffer
+        self._buffer = bytearray()
+        # number of ECUs answering each OBD request (e.g. "010C"), appended
+        # to the request so that the device does not wait for more answers
+        self._supports_response_count = False
+        self._response_counts = {}
+        self._encoded_requests = {}
+        self._last_request = None
+        for sensor in SENSORS:
+            if sensor.responses:
+                self._set_response_count(sensor.request, sensor.responses)
 
-        self._LOGGER.info("Opening interface (serial port)")
+        self._LOGGER.info("Opening interface")
 
-        try:
-            self.port = serial.Serial(serial_port,
-                                      baudrate=38400,
-                                      timeout=SERTIMEOUT)
-
-        except serial.SerialException as e:
-            print e
-            self.state = 0
-            return None
+        if isinstance(serial_port, Transport):
+            self.port = serial_port
+        else:
+            try:
+                self.port = open_transport(serial_port, SERTIMEOUT)
+            except TransportError as e:
+                print e
+                self.state = 0
+                return None
 
         self._LOGGER.info(
             "Interface %s successfully opened",
-            self.port.portstr,
+            self.port.name,
             )
         self._LOGGER.info("Connecting to ECU...")
 
+        start_time = time.time()
         try:
-            self.send_command("atz")   # initialize
-            time.sleep(1)
-        except serial.SerialException:
+            self.ELMver = self.reset()
+        except TransportError:
             self.state = 0
             return None
 
-        self.ELMver = self.get_result()
         if(self.ELMver is None):
             self.state = 0
             return None
 
-        self._LOGGER.info("atz response:" + self.ELMver)
+        self._LOGGER.info("reset response:" + self.ELMver)
+        version = parse_version(self.ELMver)
+        self._supports_response_count = \
+            version is not None and version >= RESPONSE_COUNT_VERSION
 
         self.send_command("ate0")  # echo off
-        self._LOGGER.debug("ate0 response:" + self.get_result())
+        result = self.get_result()
+        # a late reply to a reset sent before (e.g. by close) may come first
+        for _ in range(MAX_STALE_RESULTS):
+            if not result or "OK" in result:
+                break
+            self._LOGGER.debug("Skipping stale result:" + result)
+            result = self.get_result()
+        self._LOGGER.debug("ate0 response:" + str(result))
 
-        self.send_command("0100")
-        ready = self.get_result()
+        if protocol is None and cache is not None:
+            protocol = cache.get_protocol(self.adapter_id)
+        ready = self.connect_protocol(protocol)
 
-        if(ready is None):
+        if not ready:
             self.state = 0
             return None
 
         self._LOGGER.info("0100 response:" + ready)
+        if self.get_protocol() in CAN_PROTOCOLS:
+            self.configure_can()
+        if cache is not None:
+            self.load_capabilities(cache)
+        self.connect_time = time.time() - start_time
+        self._LOGGER.info(
+            "Connected using protocol %s in %.3f s",
+            self.get_protocol(),
+            self.connect_time,
+            )
         return None
 
+    def reset(self):
+        """Internal use only: reset the device and return its identity.
+
+        A warm start (ATWS) skips the LED test of a full reset (ATZ), which
+        adapters that do not know it get instead. Either way the result is
+        read as soon as the prompt comes back.
+        """
+        for reset_command in ("atws", "atz"):
+            self.send_command(reset_command)
+            lines = self.get_result_lines(self.timeout_policies[RESET_COMMAND])
+            for line in lines:
+                if line.startswith("ELM"):
+                    return line
+        # not an ELM327 as far as it says: keep whatever it answered
+        return "".join(lines) or None
+
+    def connect_protocol(self, protocol=None):
+        """Internal use only: establish the protocol with the vehicle and
+        return the result of the first request (0100).
+
+        With no protocol the device searches for it, which may take
+        seconds. A protocol number (see get_protocol) skips the search; if
+        the vehicle does not answer on it the device searches after all.
+        """
+        if protocol:
+            self.get_result_for("atsp" + protocol)
+            ready = self.get_result_for("0100", SEARCH_COMMAND)
+            if ready and "4100" in "".join(ready.split()):
+                if not protocol.startswith("A"):
+                    self.protocol = protocol
+                return ready
+            self._LOGGER.info("No answer using protocol %s", protocol)
+            self.get_result_for("atsp0")
+            self.protocol = None
+        return self.get_result_for("0100", SEARCH_COMMAND)
+
+    def configure_can(self):
+        """Internal use only: have the device show CAN frames as they come
+        and let ECUs send long replies in one go"""
+        self.get_result_for("atfcsd" + FLOW_CONTROL_DATA)
+        self.get_result_for("atfcsm2")
+        self.set_headers(True)
+
+    def set_headers(self, headers):
+        """Internal use only: turn headers on or off"""
+        self.get_result_for("ath1" if headers else "ath0")
+        self.headers = headers
+
+    @property
+    def adapter_id(self):
+        """Identifier of the adapter: its port and identity"""
+        return "%s %s" % (self.port.name, self.ELMver)
+
+    def load_capabilities(self, cache):
+        """Internal use only: take the capabilities of the vehicle from the
+        cache, or find them out and record them there"""
+        self._cache = cache
+        self.vin = self.get_vin()
+        if self.vin is None:
+            self._LOGGER.info("No VIN: capabilities cannot be cached")
+            return
+
+        capabilities = cache.get(self.adapter_id, self.vin)
+        if capabilities is not None:
+            if capabilities["protocol"] == self.get_protocol() and \
+                    capabilities["elm_version"] == self.ELMver:
+                self._LOGGER.info("Using cached capabilities of %s", self.vin)
+                self.supported_pids = SupportedPIDs.from_bitmaps(dict(
+                    (int(base_pid, 16), bitmap)
+                    for base_pid, bitmap
+                    in capabilities["supported_pids"].items()
+                    ))
+                for request, count in capabilities["response_counts"].items():
+                    self._set_response_count(str(request), count)
+                return
+            self._LOGGER.info("Cached capabilities of %s out of date", self.vin)
+            cache.invalidate(self.adapter_id, self.vin)
+
+        self.get_supported_pids()
+        self.save_capabilities()
+
+    def save_capabilities(self):
+        """Internal use only: record the capabilities of the vehicle"""
+        if self._cache is None or self.vin is None:
+            return
+        self._cache.put(
+            self.adapter_id,
+            self.vin,
+            {
+                "elm_version": self.ELMver,
+                "protocol": self.get_protocol(),
+                "supported_pids": dict(
+                    ("%02X" % base_pid, bitmap)
+                    for base_pid, bitmap
+                    in self.supported_pids.get_bitmaps().items()
+                    ),
+                "response_counts": self._response_counts,
+                },
+            )
+
+    def get_vin(self):
+        """Return the Vehicle Identification Number, or None if the vehicle
+        does not report it"""
+        return parse_vin(self.query(GET_VIN_COMMAND).messages)
+
+    def get_calibration_ids(self):
+        """Return the calibration identifiers of the software of the ECUs"""
+        return parse_calibration_ids(
+            self.query(GET_CALIBRATION_IDS_COMMAND).messages)
+
+    def get_supported_pids(self):
+        """Return the SupportedPIDs of mode 01.
+
+        Ranges are asked for as long as the previous one advertises them.
+        """
+        supported_pids = SupportedPIDs()
+        base_pid = 0
+        while base_pid <= LAST_SUPPORTED_PIDS:
+            reply = self.query("01%02X" % base_pid)
+            bitmap = get_supported_pids_bitmap(reply.messages, base_pid)
+            if bitmap is None:
+                break
+            supported_pids.add_bitmap(base_pid, bitmap)
+            # the last bit of the bitmap advertises the next range
+            if base_pid + SUPPORTED_PIDS_RANGE not in supported_pids:
+                break
+            base_pid += SUPPORTED_PIDS_RANGE
+        self.supported_pids = supported_pids
+        return supported_pids
+
+    def get_result_for(self, cmd, command_class=None):
+        """Internal use only: send the command and return its result, waiting
+        for it as the policy of the class of the command (by default, the
+        one it belongs to) says"""
+        policy = self.timeout_policies[command_class or get_command_class(cmd)]
+        result = clean_result(
+            self._strip_headers(self._exchange(encode_command(cmd), policy)))
+        self._LOGGER.debug("Get result: %r", result)
+        return result
+
+    def _strip_headers(self, frame):
+        """Internal use only: results are returned as without headers, which
+        are only on for the replies parsed into messages (see configure_can)"""
+        if self.headers:
+            return strip_headers(frame)
+        return frame
+
+    def _exchange(self, encoded_cmd, policy):
+        """Send the command and return the frame of its result, sending it
+        again as many times as the policy allows while nothing comes back"""
+        retry_delay = policy.retry_delay
+        for attempt in range(policy.retries + 1):
+            if attempt:
+                self._LOGGER.debug("No answer to %r, retrying", encoded_cmd)
+                time.sleep(retry_delay)
+                retry_delay *= policy.backoff
+            self.write_command(encoded_cmd)
+            frame = self.read_frame(policy)
+            if frame or not isinstance(frame, ReadTimeout):
+                break
+        return frame
+
     def close(self):
         """ Resets device and closes all associated filehandles"""
 
         if (self.port != None) and self.state == 1:
+            # keep what was learnt during the session for the next one
+            self.save_capabilities()
             self.send_command("atz")
             self.port.close()
 
@@ -106,89 +583,257 @@ class OBDDevice(object):
 
     def send_command(self, cmd):
         """Internal use only: not a public interface"""
+        self.write_command(encode_command(cmd))
+
+    def write_command(self, encoded_cmd):
+        """Internal use only: send an already encoded command in one write"""
         if self.port:
-            self.port.flushOutput()
-            self.port.flushInput()
-            for c in cmd:
-                self.port.write(c)
-            self.port.write("\r\n")
-            self._LOGGER.debug("Send command:" + cmd)
+            self.port.write(encoded_cmd)
+            self._LOGGER.debug("Send command: %r", encoded_cmd)
 
-    def interpret_result(self, code):
-        """Internal use only: not a public interface"""
-        # Code will be the string returned from the device.
-        # It should look something like this:
-        # '41 11 0 0\r\r'
+    def resync(self):
+        """Internal use only: drop stale input once replies are out of step
+        with the commands sent"""
+        self._LOGGER.warning("Device out of sync, flushing input")
+        del self._buffer[:]
+        if self._last_request is not None:
+            # more ECUs may have answered than expected: count them again
+            self._set_response_count(self._last_request, None)
+        if self.port:
+            self.port.flush_input()
 
-        # 9 seems to be the length of the shortest valid response
-        if len(code) < 7:
-            #raise Exception("BogusCode")
-            print "boguscode?" + code
+    def negotiate_baudrate(self, baudrates=NEGOTIATED_BAUDRATES):
+        """Switch the serial link to the fastest of the given baud rates that
+        works reliably and return the rate in use afterwards.
 
-        # get the first thing returned, echo should be off
-        code = code.split("\r")
-        code = code[0]
+        Rates are tried from the fastest with ATBRD, the ELM327 handshake
+        that falls back to the current rate by itself when the host does
+        not confirm it. Adapters without ATBRD are tried with STSBR (STN
+        chips). A rate is kept only after BAUDRATE_CHECKS identity requests
+        answer correctly at it; otherwise the previous rate is restored.
+        """
+        current_baudrate = self.port.baudrate
+        if current_baudrate is None:
+            # not a serial link
+            return None
 
-        # remove whitespace
-        code = code.split()
-        code = ''.join(code)
+        for baudrate in sorted(baudrates, reverse=True):
+            if baudrate <= current_baudrate:
+                break
+            if self._switch_baudrate(baudrate):
+                self._LOGGER.info("Switched to %d bps", baudrate)
+                return baudrate
+        return current_baudrate
 
-        # cables can behave differently
-        if code[:6] == "NODATA":  # there is no such sensor
-            return "NODATA"
+    def _switch_baudrate(self, baudrate):
+        previous_baudrate = self.port.baudrate
+        if not self._switch_baudrate_elm(baudrate) and \
+                not self._switch_baudrate_stn(baudrate):
+            return False
+        if self._check_link():
+            return True
+
+        self._LOGGER.info("Unreliable link at %d bps", baudrate)
+        if not self._switch_baudrate_elm(previous_baudrate) and \
+                not self._switch_baudrate_stn(previous_baudrate):
+            self.port.set_baudrate(previous_baudrate)
+        self.resync()
+        return False
+
+    def _switch_baudrate_elm(self, baudrate):
+        """Change the baud rate with the ELM327 handshake (ATBRD) and tell
+        whether it succeeded"""
+        previous_baudrate = self.port.baudrate
+        divisor = int(round(float(BAUDRATE_CLOCK) / baudrate))
+        if divisor < MIN_BAUDRATE_DIVISOR:
+            return False
+
+        self.send_command("atbrd%02X" % divisor)
+        if "OK" not in self._read_until("\r"):
+            # not supported: drop the rest of the reply
+            self.read_frame()
+            return False
+
+        # the device now sends its identity at the new rate and waits for a
+        # carriage return confirming that the host follows
+        self.port.set_baudrate(baudrate)
+        if "ELM" not in self._read_until("\r"):
+            # the device goes back to the previous rate on its own
+            self.port.set_baudrate(previous_baudrate)
+            self.resync()
+            self.read_frame()
+            return False
+        self.write_command("\r")
+        return "OK" in (self.get_result() or "")
 
-        # first 4 characters are code from ELM
-        code = code[4:]
-        return code
+    def _switch_baudrate_stn(self, baudrate):
+        """Change the baud rate with the STN command (STSBR), which switches
+        at once, and tell whether the device accepted it"""
+        result = self.get_result_for("stsbr%d" % baudrate)
+        if not result or "OK" not in result:
+            return False
+        self.port.set_baudrate(baudrate)
+        return True
 
-    def get_result(self):
+    def _check_link(self):
+        """Tell whether the device answers identity requests correctly"""
+        for _ in range(BAUDRATE_CHECKS):
+            identity = self.get_result_for("ati")
+            if not identity or not identity.startswith("ELM"):
+                return False
+        return True
+
+    def _read_until(self, terminator):
+        """Read up to and including the terminator, or whatever arrives
+        before reads come back empty, and return it"""
+        buffer = self._buffer
+        while True:
+            index = buffer.find(terminator)
+            if index != -1:
+                end = index + len(terminator)
+                text = str(buffer[:end])
+                del buffer[:end]
+                if text.strip():
+                    return text
+                continue
+            chunk = self.port.read_available()
+            if not chunk:
+                text = str(buffer)
+                del buffer[:]
+                return text
+            buffer.extend(chunk)
+
+    def interpret_result(self, code):
         """Internal use only: not a public interface"""
-        # time.sleep(0.01)
-        repeat_count = 0
-        if self.port is not None:
-            buffer = ""
-            while 1:
-                c = self.port.read(1)
-                if len(c) == 0:
-                    if(repeat_count == 5):
-                        break
-                    print "Got nothing\n"
-                    repeat_count = repeat_count + 1
-                    continue
+        return interpret_result(code)
 
-                if c == '\r':
-                    continue
+    def read_frame(self, policy=None):
+        """Internal use only: not a public interface
 
-                if c == ">":
-                    break
+        Read everything the device sends up to the next prompt and return it
+        as a raw string (prompt excluded). Whatever the port has available is
+        read in a single call instead of one byte at a time.
 
-                # if something is in buffer, add everything
-                if buffer != "" or c != ">":
-                    buffer = buffer + c
+        Reading is abandoned once the deadline of the TimeoutPolicy (by
+        default, the one of OBD requests) passes, or once the device stays
+        silent for longer than its first-byte timeout (before the first byte
+        and while the device says it is busy) or its inter-byte timeout.
+        What arrived by then is returned as a ReadTimeout.
+        """
+        if policy is None:
+            policy = self.timeout_policies[OBD_REQUEST]
+        buffer = self._buffer
+        scanned = 0
+        start_time = time.time()
+        deadline = start_time + policy.deadline
+        while True:
+            prompt_index = buffer.find(PROMPT, scanned)
+            if prompt_index != -1:
+                frame = str(buffer[:prompt_index])
+                del buffer[:prompt_index + 1]
+                if buffer:
+                    # nothing may follow the prompt until the next command
+                    self.resync()
+                return frame
+            scanned = len(buffer)
 
-            self._LOGGER.debug("Get result:" + buffer)
-            if(buffer == ""):
-                return None
-            return buffer
-        else:
+            remaining_time = deadline - time.time()
+            if remaining_time <= 0:
+                break
+            if not buffer or buffer.rstrip().endswith(BUSY_SUFFIX):
+                timeout = policy.first_byte_timeout
+            else:
+                timeout = policy.inter_byte_timeout
+            chunk = self.port.read_available(min(timeout, remaining_time))
+            if not chunk:
+                break
+            buffer.extend(chunk)
+
+        # no prompt before giving up: hand over whatever arrived, but do not
+        # let the rest of this reply be taken for the next one
+        self._LOGGER.debug(
+            "No prompt after %.3f s", time.time() - start_time)
+        frame = ReadTimeout(buffer)
+        self.resync()
+        return frame
+
+    def get_result(self, policy=None):
+        """Internal use only: not a public interface"""
+        if self.port is None:
             self._LOGGER.error("NO self.port!")
-        return None
+            return None
+
+        result = clean_result(self._strip_headers(self.read_frame(policy)))
+        self._LOGGER.debug("Get result: %r", result)
+        return result
 
     # get sensor value from command
     def get_sensor_value(self, sensor):
         """Internal use only: not a public interface"""
-        cmd = sensor.cmd
-        self.send_command(cmd)
-        data = self.get_result()
-
-        if data:
-            data = self.interpret_result(data)
-            if data != "NODATA":
-                data = sensor.value(data)
-        else:
-            return "NORESPONSE"
+        if self._is_unanswered(sensor):
+            return "NODATA"
+        reply = self.query(sensor.request)
+        message = find_reply(sensor, reply.messages)
+
+        if message is None and reply.messages:
+            # a late reply to an earlier command: drop it and ask again
+            self.resync()
+            reply = self.query(sensor.request)
+            message = find_reply(sensor, reply.messages)
+
+        if message is None:
+            if reply.status == NO_DATA:
+                self.unanswered_requests.add(sensor.request)
+            return get_missing_value(reply)
+        return decode_sensor_value(sensor, message)
 
-        return data
+    def _is_unanswered(self, sensor):
+        """Internal use only: whether the sensor need not be asked for (see
+        is_unanswered)"""
+        if self.supported_pids is None:
+            self.get_supported_pids()
+        return is_unanswered(
+            sensor, self.supported_pids, self.unanswered_requests)
+
+    def query(self, request):
+        """Internal use only: send the OBD request (mode and PIDs) and return
+        the Reply to it (see obd.replies).
+
+        Once the number of ECUs answering the request is known, it is sent
+        along, so that the device replies as soon as they have all answered
+        instead of waiting for its timeout.
+        """
+        if self.selected_ecu is not None and self._supports_response_count:
+            # a single ECU is listened to
+            return self._query_reply(encode_command(request + "1"))
+
+        expected_responses = self._response_counts.get(request)
+        encoded_request = self._encoded_requests.get(request)
+        if encoded_request is None:
+            encoded_request = encode_command(request)
+        self._last_request = request
+        reply = self._query_reply(encoded_request)
+        self._last_request = None
+
+        if self._supports_response_count:
+            reply_mode = int(request[:2], 16) + 0x40
+            responses = sum(
+                1 for message in reply.messages
+                if message and message[0] == reply_mode
+                )
+            if expected_responses is None or responses < expected_responses:
+                self._set_response_count(request, responses)
+        return reply
+
+    def _set_response_count(self, request, responses):
+        if responses:
+            responses = min(responses, MAX_RESPONSE_COUNT)
+            self._response_counts[request] = responses
+            self._encoded_requests[request] = \
+                encode_command("%s%X" % (request, responses))
+        else:
+            self._response_counts.pop(request, None)
+            self._encoded_requests.pop(request, None)
 
     # return string of sensor name and value from sensor index
     def sensor(self, sensor_index):
@@ -198,6 +843,173 @@ class OBDDevice(object):
         r = self.get_sensor_value(sensor)
         return (sensor.name, r, sensor.unit)
 
+    def sensors(self, sensor_indexes):
+        """Returns the 3-tuples of the given sensors, as `sensor` does.
+
+        On CAN vehicles the sensors are read with requests carrying several
+        PIDs each, so reading many sensors takes fewer round trips.
+        """
+        sensors = [SENSORS[sensor_index] for sensor_index in sensor_indexes]
+        # only the sensors the vehicle may answer take room in requests
+        read_sensors = [
+            sensor for sensor in sensors if not self._is_unanswered(sensor)]
+        sensor_values = {}
+        for batch in self._get_batches(read_sensors):
+            sensor_values.update(zip(batch, self.get_sensor_values(batch)))
+        return [
+            (sensor.name, sensor_values.get(sensor, "NODATA"), sensor.unit)
+            for sensor in sensors
+            ]
+
+    def _get_batches(self, sensors):
+        """Internal use only: group the sensors by request. On CAN vehicles
+        requests carry up to MAX_PIDS_PER_REQUEST mode 01 PIDs; sensors of
+        other modes are read one by one."""
+        if self.get_protocol() not in CAN_PROTOCOLS:
+            return [[sensor] for sensor in sensors]
+        mode_01_sensors = [
+            sensor for sensor in sensors if sensor.reply_mode == 0x41]
+        batches = [
+            mode_01_sensors[start:start + MAX_PIDS_PER_REQUEST]
+            for start in range(0, len(mode_01_sensors), MAX_PIDS_PER_REQUEST)
+            ]
+        batches.extend(
+            [sensor] for sensor in sensors if sensor.reply_mode != 0x41)
+        return batches
+
+    def get_sensor_values(self, sensors):
+        """Internal use only: read the mode 01 sensors in one request"""
+        if len(sensors) == 1:
+            return [self.get_sensor_value(sensors[0])]
+
+        reply = self.query("01" + "".join(s.cmd[2:4] for s in sensors))
+        if not reply.messages:
+            if reply.status == NO_DATA:
+                for sensor in sensors:
+                    self.unanswered_requests.add(sensor.request)
+            return [get_missing_value(reply)] * len(sensors)
+
+        pid_data, complete = split_pid_data(reply.messages, 0x01)
+        values = []
+        for sensor in sensors:
+            data = pid_data.get(sensor.pid)
+            if data is not None:
+                values.append(sensor.value(data))
+            elif complete:
+                # answered with the others left out
+                self.unanswered_requests.add(sensor.request)
+                values.append("NODATA")
+            else:
+                # maybe answered after a PID the reply could not be split at
+                values.append(self.get_sensor_value(sensor))
+        return values
+
+    def sensors_by_ecu(self, sensor_indexes):
+        """Returns the 3-tuples of the given sensors, as `sensors` does, from
+        every ECU answering them, keyed by ECU (see Reply.ecus in
+        obd.replies). Sensors an ECU does not answer have the value
+        "NODATA"."""
+        sensors = [SENSORS[sensor_index] for sensor_index in sensor_indexes]
+        read_sensors = [
+            sensor for sensor in sensors if not self._is_unanswered(sensor)]
+        ecu_values = {}
+        for batch in self._get_batches(read_sensors):
+            if len(batch) == 1:
+                reply = self.query(batch[0].request)
+            else:
+                reply = self.query("01" + "".join(s.cmd[2:4] for s in batch))
+            if reply.status == NO_DATA and not reply.messages:
+                for sensor in batch:
+                    self.unanswered_requests.add(sensor.request)
+            for ecu, message in zip(reply.ecus, reply.messages):
+                values = ecu_values.setdefault(ecu, {})
+                if batch[0].reply_mode != 0x41:
+                    sensor = batch[0]
+                    if find_reply(sensor, [message]) is not None:
+                        values.setdefault(
+                            sensor, decode_sensor_value(sensor, message))
+                    continue
+                pid_data = demultiplex_pids([message], 0x01)
+                for sensor in batch:
+                    data = pid_data.get(sensor.pid)
+                    if data is not None:
+                        values.setdefault(sensor, sensor.value(data))
+        return dict(
+            (
+                ecu,
+                [
+                    (sensor.name, values.get(sensor, "NODATA"), sensor.unit)
+                    for sensor in sensors
+                    ],
+                )
+            for ecu, values in ecu_values.items()
+            )
+
+    def select_ecu(self, ecu, physical=True):
+        """Listen only to the ECU with the CAN identifier (e.g. 0x7E8), so
+        that requests complete as soon as it answers. Other ECUs' answers are
+        filtered out by the device (ATCRA). With `physical` addressing
+        requests are sent to that ECU alone (ATSH), and others do not even
+        answer. None goes back to all ECUs."""
+        if self.get_protocol() not in CAN_PROTOCOLS:
+            raise ValueError("Selecting an ECU requires a CAN protocol")
+        extended = ecu is not None and ecu > MAX_STANDARD_CAN_ID
+        if ecu is not None and physical:
+            if extended:
+                # to the ECU's address (low byte) from the tester (F1)
+                header = "DA%02XF1" % (ecu & 0xFF)
+            else:
+                # requests to 0x7E0 are answered from 0x7E8, and so on
+                header = "%03X" % (ecu - 8)
+        elif self.get_protocol() in EXTENDED_ID_PROTOCOLS:
+            header = EXTENDED_FUNCTIONAL_REQUEST_HEADER
+        else:
+            header = FUNCTIONAL_REQUEST_HEADER
+        self.get_result_for("atsh" + header)
+        self.selected_ecu = ecu
+        self._set_receive_filter()
+        # what other ECUs did not answer this one may
+        self.unanswered_requests.clear()
+
+    def _set_receive_filter(self):
+        if self.selected_ecu is None:
+            self.get_result_for("atcra")
+        elif self.selected_ecu > MAX_STANDARD_CAN_ID:
+            self.get_result_for("atcra%08X" % self.selected_ecu)
+        else:
+            self.get_result_for("atcra%03X" % self.selected_ecu)
+
+    def get_result_lines(self, policy=None):
+        """Internal use only: like get_result, keeping lines apart"""
+        if self.port is None:
+            self._LOGGER.error("NO self.port!")
+            return []
+
+        frame = self._strip_headers(self.read_frame(policy))
+        lines = split_result_lines(frame)
+        self._LOGGER.debug("Get result: %r", lines)
+        return lines
+
+    def _query_reply(self, encoded_request):
+        """Send the OBD request and return the Reply to it"""
+        frame = self._exchange(
+            encoded_request,
+            self.timeout_policies[OBD_REQUEST],
+            )
+        reply = parse_reply(frame, self.headers)
+        self._LOGGER.debug("Get result: %r", reply.lines)
+        return reply
+
+    def get_protocol(self):
+        """Return the ELM327 number of the protocol in use (e.g. "6" for
+        ISO 15765-4 CAN 11/500), asking the device the first time"""
+        if self.protocol is None:
+            result = self.get_result_for("atdpn")
+            if result:
+                # "A6" means the protocol was found by automatic search
+                self.protocol = result.strip().lstrip("A")
+        return self.protocol
+
     def sensor_names(self):
         """Internal use only: not a public interface"""
         names = []
@@ -231,59 +1043,185 @@ class OBDDevice(object):
     def get_dtc(self):
         """Returns a list of all pending DTC codes. Each element consists of
         a 2-tuple: (DTC code (string), Code description (string) )"""
-        dtcLetters = ["P", "C", "B", "U"]
         r = self.sensor(1)[1]  # data
-        dtcNumber = r[0]
-        mil = r[1]
         DTCCodes = []
 
-        print "Number of stored DTC:" + str(dtcNumber) + " MIL: " + str(mil)
-        # get all DTC, 3 per mesg response
-        for i in range(0, ((dtcNumber + 2) / 3)):
-            self.send_command(GET_DTC_COMMAND)
-            res = self.get_result()
-            print "DTC result:" + res
-            for i in range(0, 3):
-                val1 = to_int(res[3 + i * 6:5 + i * 6])
-                # get DTC codes from response (3 DTC each 2 bytes)
-                val2 = to_int(res[6 + i * 6:8 + i * 6])
-                val = (val1 << 8) + val2  # DTC val as int
-
-                if val == 0:  # skip fill of last packet
-                    break
-
-                DTCStr = dtcLetters[(val & 0xC000) > 14] + str((val & 0x3000) >> 12) + \
-                    str((val & 0x0f00) >> 8) + \
-                    str((val & 0x00f0) >> 4) + str(val & 0x000f)
-
-                DTCCodes.append(["Active", DTCStr])
+        if isinstance(r, str):
+            # no status, e.g. "NODATA": read the codes in case there are any
+            print "Number of stored DTC unknown: " + r
+            dtcNumber = None
+        else:
+            dtcNumber = r[0]
+            mil = r[1]
+            print "Number of stored DTC:" + str(dtcNumber) + " MIL: " + str(mil)
+        if dtcNumber or dtcNumber is None:
+            # every ECU answers with all its codes: several messages on
+            # non-CAN vehicles, a multi-frame one on CAN
+            reply = self.query_dtcs(GET_DTC_COMMAND)
+            print "DTC result:" + " | ".join(reply.lines)
+            DTCCodes.extend(parse_dtcs(reply.messages, 0x03, "Active"))
 
         # read mode 7
-        self.send_command(GET_FREEZE_DTC_COMMAND)
-        res = self.get_result()
-
-        if res[:7] == "NO DATA":  # no freeze frame
+        reply = self.query_dtcs(GET_FREEZE_DTC_COMMAND)
+        if not reply.messages:  # no freeze frame
             return DTCCodes
 
-        print "DTC freeze result:" + res
-        for i in range(0, 3):
-            val1 = to_int(res[3 + i * 6:5 + i * 6])
-            # get DTC codes from response (3 DTC each 2 bytes)
-            val2 = to_int(res[6 + i * 6:8 + i * 6])
-            val = (val1 << 8) + val2  # DTC val as int
-
-            if val == 0:  # skip fill of last packet
-                break
-
-            DTCStr = dtcLetters[(val & 0xC000) > 14] + str((val & 0x3000) >> 12) + \
-                str((val & 0x0f00) >> 8) + \
-                str((val & 0x00f0) >> 4) + str(val & 0x000f)
-            DTCCodes.append(["Passive", DTCStr])
+        print "DTC freeze result:" + " | ".join(reply.lines)
+        DTCCodes.extend(parse_dtcs(reply.messages, 0x07, "Passive"))
 
         return DTCCodes
 
+    def query_dtcs(self, cmd):
+        """Internal use only: send the mode 03 or 07 request and return the
+        Reply to it. The number of responses is not learnt, as it changes
+        with the number of codes."""
+        return self._query_reply(encode_command(cmd))
+
     def clear_dtc(self):
         """Clears all DTCs and freeze frame data"""
-        self.send_command(CLEAR_DTC_COMMAND)
-        r = self.get_result()
+        r = self.get_result_for(CLEAR_DTC_COMMAND)
         return r
+
+    def monitor(
+        self,
+        can_ids=None,
+        receiver=None,
+        transmitter=None,
+        idle_timeout=MONITOR_IDLE_TIMEOUT,
+        ):
+        """Generator of the frames on the CAN bus, as (timestamp, identifier,
+        data) tuples, with the device listening without sending anything.
+
+        All frames are monitored (ATMA), or those sent to the `receiver` or
+        by the `transmitter` address (ATMR, ATMT). `can_ids` limits them to
+        the identifiers listed, most wanted first, filtered by the device
+        itself as far as its filter allows. Timestamps are the times frames
+        were read: the device does not send any.
+
+        When the device runs out of buffer because the serial link cannot
+        keep up, the baud rate is raised (see negotiate_baudrate) and
+        monitoring resumes. Once the rate cannot be raised further, the least
+        wanted identifiers are dropped one at a time.
+
+        None is yielded whenever no frame came for `idle_timeout` seconds,
+        so that callers can check a deadline or stop even on a quiet bus.
+
+        Monitoring stops when the generator is closed.
+        """
+        if self.get_protocol() not in CAN_PROTOCOLS:
+            raise ValueError("Monitoring requires a CAN protocol")
+        if receiver is not None:
+            monitor_command = "atmr%02X" % receiver
+        elif transmitter is not None:
+            monitor_command = "atmt%02X" % transmitter
+        else:
+            monitor_command = "atma"
+        can_ids = list(can_ids or ())
+
+        # identifiers shown, without spaces, and frames shown in full
+        for cmd in ("ath1", "ats0", "atcaf0"):
+            self.get_result_for(cmd)
+        can_raise_baudrate = True
+        monitoring = False
+        try:
+            while True:
+                self._set_can_filter(can_ids)
+                self.send_command(monitor_command)
+                monitoring = True
+                overflowed = False
+                frames = self._read_monitored_frames(
+                    frozenset(can_ids), idle_timeout)
+                for frame in frames:
+                    if frame is _BUFFER_FULL:
+                        overflowed = True
+                        break
+                    yield frame
+                # the device is back at the prompt
+                monitoring = False
+                if not overflowed:
+                    return
+
+                if can_raise_baudrate:
+                    baudrate = self.port.baudrate
+                    new_baudrate = self.negotiate_baudrate()
+                    can_raise_baudrate = \
+                        new_baudrate is not None and new_baudrate > baudrate
+                    if can_raise_baudrate:
+                        continue
+                if len(can_ids) > 1:
+                    self._LOGGER.warning(
+                        "Buffer full: no longer monitoring %X",
+                        can_ids.pop(),
+                        )
+                else:
+                    self._LOGGER.warning("Buffer full: frames were lost")
+        finally:
+            if monitoring:
+                self.write_command(MONITOR_STOP_CHARACTER)
+                self.read_frame()
+            for cmd in ("ats1", "atcaf1"):
+                self.get_result_for(cmd)
+            self.set_headers(self.headers)
+            if can_ids or self.selected_ecu is not None:
+                self._set_receive_filter()
+
+    def _set_can_filter(self, can_ids):
+        """Let the device receive the CAN identifiers (and any others its
+        filter cannot tell apart from them), or all if there are none"""
+        if not can_ids:
+            self.get_result_for("atcra")
+            return
+        if max(can_ids) > MAX_STANDARD_CAN_ID:
+            mask, digits = MAX_EXTENDED_CAN_ID, 8
+        else:
+            mask, digits = MAX_STANDARD_CAN_ID, 3
+        # keep the bits all the identifiers agree on
+        for can_id in can_ids:
+            mask &= ~(can_id ^ can_ids[0])
+        self.get_result_for("atcf%0*X" % (digits, can_ids[0] & mask))
+        self.get_result_for("atcm%0*X" % (digits, mask))
+
+    def _read_monitored_frames(self, can_ids, idle_timeout):
+        """Parse monitored frames as they arrive and yield them, None after
+        `idle_timeout` seconds without any, then _BUFFER_FULL if monitoring
+        stopped because the device ran out of buffer"""
+        buffer = self._buffer
+        pending = str(buffer)
+        del buffer[:]
+        last_frame_time = time.time()
+        while True:
+            chunk = self.port.read_available(idle_timeout)
+            timestamp = time.time()
+            if timestamp - last_frame_time >= idle_timeout:
+                # a quiet bus, or no frame passing the filter
+                last_frame_time = timestamp
+                yield None
+            if not chunk:
+                continue
+            lines = (pending + chunk).split("\r")
+            pending = lines.pop()
+            for line in lines:
+                if not line:
+                    continue
+                if line.endswith(MONITOR_BUFFER_FULL):
+                    buffer.extend(pending)
+                    self.read_frame()
+                    yield _BUFFER_FULL
+                    return
+                # 11-bit identifiers take 3 digits, 29-bit ones 8: the
+                # digits of data bytes come in pairs
+                id_digits = 3 if len(line) % 2 else 8
+                try:
+                    can_id = int(line[:id_digits], 16)
+                    data = bytearray.fromhex(line[id_digits:])
+                except ValueError:
+                    # e.g. "<DATA ERROR" or "CAN ERROR"
+                    self._LOGGER.debug("Ignoring monitored line %r", line)
+                    continue
+                if can_ids and can_id not in can_ids:
+                    continue
+                last_frame_time = timestamp
+                yield timestamp, can_id, data
+            if PROMPT in pending:
+                self._LOGGER.warning("Monitoring stopped by the device")
+                return
@@ -0,0 +1,138 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+
+"""Reassembly of ISO 15765-2 (ISO-TP) messages from CAN frames.
+
+With headers on (ATH1), the device shows each CAN frame of a reply as is: the
+identifier of the sending ECU, then the protocol control information (PCI)
+and data bytes::
+
+    7E8 10 14 49 02 01 31 44 34      first frame: 0x014 bytes in all
+    7E9 03 41 0D 00                  single frame from another ECU
+    7E8 21 47 50 30 30 52 35 35      consecutive frames, numbered
+    7E8 22 42 31 32 33 34 35 36
+
+Frames from several ECUs may interleave; they are put back together by ECU.
+"""
+
+from logging import getLogger
+
+
+# Types of frame, in the high nibble of the first PCI byte
+SINGLE_FRAME = 0x0
+FIRST_FRAME = 0x1
+CONSECUTIVE_FRAME = 0x2
+FLOW_CONTROL_FRAME = 0x3
+
+# Digits of 11-bit and 29-bit identifiers as shown by the device
+STANDARD_ID_DIGITS = 3
+EXTENDED_ID_DIGITS = 8
+
+_LOGGER = getLogger(__name__)
+
+
+def parse_frame(line):
+    """Return the identifier and data, as an int and a bytearray, of the CAN
+    frame in a line shown by the device with headers on, or None if the line
+    is not a frame (e.g. "NO DATA")"""
+    compact = "".join(line.split())
+    # data bytes take two digits each: identifiers are told apart by parity
+    if len(compact) % 2:
+        id_digits = STANDARD_ID_DIGITS
+    else:
+        id_digits = EXTENDED_ID_DIGITS
+    try:
+        can_id = int(compact[:id_digits], 16)
+        data = bytearray.fromhex(compact[id_digits:])
+    except ValueError:
+        return None
+    if not data:
+        return None
+    return can_id, data
+
+
+class Reassembler(object):
+    """Puts messages back together from the frames of any number of ECUs"""
+
+    def __init__(self):
+        # transfers in progress, keyed by identifier: (size, message so far,
+        # next sequence number)
+        self._transfers = {}
+
+    def feed(self, can_id, data):
+        """Take the frame and return the message it completes, or None"""
+        frame_type = data[0] >> 4
+        if frame_type == SINGLE_FRAME:
+            size = data[0] & 0x0F
+            if not size or size > len(data) - 1:
+                _LOGGER.debug("Bad single frame from %X", can_id)
+                return None
+            return data[1:1 + size]
+
+        if frame_type == FIRST_FRAME:
+            if len(data) < 2:
+                return None
+            size = (data[0] & 0x0F) << 8 | data[1]
+            self._transfers[can_id] = (size, data[2:], 1)
+            return None
+
+        if frame_type == CONSECUTIVE_FRAME:
+            transfer = self._transfers.get(can_id)
+            if transfer is None:
+                _LOGGER.debug("Consecutive frame from %X out of place", can_id)
+                return None
+            size, message, sequence_number = transfer
+            if data[0] & 0x0F != sequence_number:
+                _LOGGER.debug("Frame from %X missing: dropping message", can_id)
+                del self._transfers[can_id]
+                return None
+            message.extend(data[1:])
+            if len(message) >= size:
+                del self._transfers[can_id]
+                return message[:size]
+            self._transfers[can_id] = (size, message, (sequence_number + 1) % 16)
+            return None
+
+        # flow control frames only steer the sender
+        return None
+
+    @property
+    def incomplete_ids(self):
+        """Identifiers of the ECUs with messages still missing frames"""
+        return sorted(self._transfers)
+
+
+def reassemble(lines):
+    """Return the messages in the lines shown by the device with headers on,
+    as (identifier, bytearray) pairs in the order they were completed"""
+    reassembler = Reassembler()
+    messages = []
+    for line in lines:
+        frame = parse_frame(line)
+        if frame is None:
+            continue
+        message = reassembler.feed(*frame)
+        if message is not None:
+            messages.append((frame[0], message))
+    for can_id in reassembler.incomplete_ids:
+        _LOGGER.debug("Incomplete message from %X", can_id)
+    return messages
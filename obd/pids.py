@@ -0,0 +1,94 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""Mode 01 PIDs supported by a vehicle.
+
+Vehicles report them in bitmaps of 32 PIDs, in reply to PIDs 0x00, 0x20,
+0x40, ... The most significant bit of each bitmap stands for the PID after
+the one reporting it, and the least significant bit for the next reporting
+PID: whether the vehicle reports the next range at all.
+"""
+
+
+# Each supported PIDs bitmap covers the 32 PIDs after its own
+SUPPORTED_PIDS_RANGE = 0x20
+
+# Bytes of each bitmap
+SUPPORTED_PIDS_BITMAP_SIZE = 4
+
+LAST_SUPPORTED_PIDS = 0xE0
+
+
+def _reverse_bitmap(bitmap):
+    return int(format(bitmap, "032b")[::-1], 2)
+
+
+class SupportedPIDs(object):
+    """Set of supported PIDs, kept as a bitmask with bit N set if PID N is
+    supported.
+
+    PIDs reporting a bitmap count as supported: the vehicle answered them.
+    """
+
+    def __init__(self, mask=0):
+        self.mask = mask
+
+    @classmethod
+    def from_bitmaps(cls, bitmaps):
+        """Return the PIDs supported as per the bitmaps, keyed by the PID
+        reporting them"""
+        supported_pids = cls()
+        for base_pid, bitmap in bitmaps.items():
+            supported_pids.add_bitmap(base_pid, bitmap)
+        return supported_pids
+
+    def add_bitmap(self, base_pid, bitmap):
+        """Add the PIDs of the bitmap reported by PID `base_pid`"""
+        self.mask |= (_reverse_bitmap(bitmap) << 1 | 1) << base_pid
+
+    def get_bitmap(self, base_pid):
+        """Return the bitmap PID `base_pid` reports, as per the PIDs here"""
+        return _reverse_bitmap(self.mask >> base_pid + 1 & 0xFFFFFFFF)
+
+    def get_bitmaps(self):
+        """Return the bitmaps reported, keyed by the PID reporting them"""
+        return dict(
+            (base_pid, self.get_bitmap(base_pid))
+            for base_pid
+            in range(0, LAST_SUPPORTED_PIDS + 1, SUPPORTED_PIDS_RANGE)
+            if base_pid in self
+            )
+
+    def __contains__(self, pid):
+        return self.mask >> pid & 1 == 1
+
+    def __iter__(self):
+        mask = self.mask
+        while mask:
+            lowest_bit = mask & -mask
+            yield lowest_bit.bit_length() - 1
+            mask ^= lowest_bit
+
+    def __len__(self):
+        return bin(self.mask).count("1")
+
+    def __repr__(self):
+        return "SupportedPIDs(%s)" % ", ".join("%02X" % pid for pid in self)
@@ -0,0 +1,128 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""Sharing an OBDDevice between threads.
+
+OBDDevice is not thread-safe: the device answers one command at a time and
+replies carry nothing to match them with their requests. A CommandQueue owns
+the device in a single I/O thread and runs requests from any number of
+threads in order, handing back futures::
+
+    queue = CommandQueue(device)
+    rpm = queue.sensor(12)
+    speed = queue.sensor(13)
+    print rpm.result(), speed.result()
+
+The I/O thread sends each request as soon as the reply to the previous one is
+parsed, so callers never wait on each other's hand-offs.
+"""
+
+from logging import getLogger
+import Queue
+import sys
+import threading
+
+
+_STOP = object()
+
+
+class Future(object):
+    """Result of a request that may not have completed yet"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the request to complete and return its result, or raise
+        what it raised"""
+        if not self._done.wait(timeout):
+            raise RuntimeError("Request still pending after %s s" % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+
+class CommandQueue(object):
+    """Runs requests on an OBDDevice from a single I/O thread"""
+
+    _LOGGER = getLogger(__name__ + '.CommandQueue')
+
+    def __init__(self, device):
+        self.device = device
+        self._requests = Queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="OBD I/O %s" % device.port.name,
+            )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, function, *args):
+        """Call the function (usually a method of the device) with the
+        arguments in the I/O thread and return the Future of its result"""
+        future = Future()
+        self._requests.put((future, function, args))
+        return future
+
+    def sensor(self, sensor_index):
+        """Future of OBDDevice.sensor"""
+        return self.submit(self.device.sensor, sensor_index)
+
+    def sensors(self, sensor_indexes):
+        """Future of OBDDevice.sensors"""
+        return self.submit(self.device.sensors, sensor_indexes)
+
+    def command(self, cmd):
+        """Future of the result of a raw command, e.g. "atrv" """
+        return self.submit(self.device.get_result_for, cmd)
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is _STOP:
+                return
+            future, function, args = request
+            try:
+                result = function(*args)
+            except Exception:
+                self._LOGGER.debug("Request failed", exc_info=True)
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """Complete the pending requests and stop the I/O thread. The device
+        is left open."""
+        self._requests.put(_STOP)
+        self._thread.join()
@@ -0,0 +1,264 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""Parsing of the replies of the device into messages.
+
+A reply is everything the device sends for a command, up to its prompt. Its
+lines are data, which are turned into bytes as they are parsed, or status
+lines: progress reports ("SEARCHING...", "BUS INIT: ...OK"), which are
+skipped, and errors ("NO DATA", "CAN ERROR", "STOPPED", ...), the first of
+which becomes the status of the reply.
+
+Messages are bytearrays, starting with the mode and PID echo of the request
+they answer. Decoders are handed a memoryview of the bytes after the echo.
+"""
+
+from collections import namedtuple
+import time
+
+from .isotp import reassemble
+
+
+# The vehicle did not answer the request, e.g. an unsupported PID
+NO_DATA = "NO DATA"
+
+# Seconds requests answered with NO DATA are not sent again. Some PIDs are
+# only answered in some conditions (e.g. with the engine running), so they
+# are tried again from time to time.
+NO_DATA_EXPIRY = 30.0
+
+# The device gave up on the command because it received a character
+STOPPED = "STOPPED"
+
+# Status lines reporting errors start or end like these
+_ERROR_PREFIXES = (
+    NO_DATA,
+    STOPPED,
+    "?",
+    "ACT ALERT",
+    "BUFFER FULL",
+    "BUS BUSY",
+    # ERR followed by a number, e.g. ERR94 after a CAN bus failure
+    "ERR",
+    "LV RESET",
+    "UNABLE TO CONNECT",
+    )
+# e.g. "CAN ERROR", "BUS INIT: ...ERROR", "41 0C 0B <DATA ERROR"
+_ERROR_SUFFIXES = ("ERROR",)
+
+# Status lines reporting progress start like these, unless they end with an
+# error
+_PROGRESS_PREFIXES = ("SEARCHING", "BUS INIT")
+
+Reply = namedtuple(
+    "Reply",
+    [
+        # the non-empty lines of the reply
+        "lines",
+        "messages",
+        # the ECU of each message: the CAN identifier it answered with (e.g.
+        # 0x7E8 for the engine), or None without headers
+        "ecus",
+        # the first error line, NO_RESPONSE if the device did not answer in
+        # time, or None
+        "status",
+        ],
+    )
+
+
+class ReplyError(str):
+    """Status standing for the value of a sensor whose reply has none, such
+    as "CAN ERROR". A string, so that callers not telling errors from values
+    keep working."""
+
+
+class ReadTimeout(ReplyError):
+    """What the device sent of a result before the time allowed for it ran
+    out. Timeouts are told from complete results with isinstance, while
+    callers that do not care keep handling a string."""
+
+
+# Value of a sensor that the device did not answer in time
+NO_RESPONSE = ReadTimeout("NORESPONSE")
+
+
+def parse_reply(frame, headers=False):
+    """Return the Reply in the frame read from the device (prompt excluded).
+
+    With `headers` on, data lines are CAN frames, which are reassembled by
+    ECU (see obd.isotp).
+    """
+    reply = parse_lines(frame.split("\r"), headers)
+    if isinstance(frame, ReadTimeout) and \
+            not reply.messages and reply.status is None:
+        return Reply(reply.lines, [], [], NO_RESPONSE)
+    return reply
+
+
+def parse_lines(lines, headers=False):
+    """Return the Reply in the lines of a frame, as parse_reply does"""
+    result_lines = []
+    data_lines = []
+    status = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        result_lines.append(line)
+        if _is_error_line(line):
+            if status is None:
+                status = line
+        elif not line.startswith(_PROGRESS_PREFIXES):
+            data_lines.append(line)
+
+    if headers:
+        ecu_messages = reassemble(data_lines)
+        ecus = [ecu for ecu, _message in ecu_messages]
+        messages = [message for _ecu, message in ecu_messages]
+    else:
+        messages = _join_lines(data_lines)
+        ecus = [None] * len(messages)
+    return Reply(result_lines, messages, ecus, status)
+
+
+def _is_error_line(line):
+    return line.endswith(_ERROR_SUFFIXES) or line.startswith(_ERROR_PREFIXES)
+
+
+def strip_headers(frame):
+    """Return the frame read with headers on as the device sends it with
+    them off: each message, reassembled, on a line of its own in hex, with
+    the status lines around them. Frames without CAN messages (e.g. the
+    results of AT commands) are returned as they are."""
+    reply = parse_reply(frame, headers=True)
+    if not reply.messages:
+        return frame
+    lines = []
+    message_lines = [
+        " ".join("%02X" % byte for byte in message)
+        for message in reply.messages
+        ]
+    for line in reply.lines:
+        if _is_error_line(line) or line.startswith(_PROGRESS_PREFIXES):
+            lines.append(line)
+        elif message_lines:
+            # in place of the first data line
+            lines.extend(message_lines)
+            message_lines = None
+    stripped = "\r".join(lines)
+    if isinstance(frame, ReadTimeout):
+        return ReadTimeout(stripped)
+    return stripped
+
+
+def _join_lines(lines):
+    """Return the messages in the data lines of a reply without headers.
+
+    Messages longer than a CAN frame are laid out by the adapter as a line
+    with their length followed by numbered lines ("0: 41 0C ...") that are
+    joined back here. Lines that are not data (e.g. "OK") are skipped.
+    """
+    messages = []
+    message = None
+    message_size = 0
+    for line in lines:
+        if ":" in line:
+            # continuation of a multi-frame message
+            index, _, data = line.partition(":")
+            if message is None or not index.strip().isalnum():
+                continue
+            try:
+                message.extend(bytearray.fromhex(data.strip()))
+            except ValueError:
+                continue
+            if len(message) >= message_size:
+                del message[message_size:]
+                message = None
+            continue
+
+        if len(line) == 3:
+            # length of the multi-frame message that follows
+            try:
+                message_size = int(line, 16)
+            except ValueError:
+                continue
+            message = bytearray()
+            messages.append(message)
+            continue
+
+        try:
+            messages.append(bytearray.fromhex(line))
+        except ValueError:
+            continue
+    return messages
+
+
+def find_reply(sensor, messages):
+    """Return the first of the messages that answers the sensor command,
+    i.e. starts with its mode and PID echo, or None"""
+    reply_prefix = sensor.reply_prefix
+    for message in messages:
+        if message.startswith(reply_prefix):
+            return message
+    return None
+
+
+def get_payload(message, echo_size=2):
+    """Return a view of the data in the message, after its mode and PID
+    echo (two bytes, or more for PIDs of several bytes)"""
+    return memoryview(message)[echo_size:]
+
+
+def get_missing_value(reply):
+    """Return what stands for the value of a sensor that the reply does not
+    answer: "NODATA" if the vehicle has none, else a ReplyError (e.g.
+    NO_RESPONSE)"""
+    status = reply.status
+    if status is None or status.startswith(NO_DATA):
+        return "NODATA"
+    if isinstance(status, ReplyError):
+        return status
+    return ReplyError(status)
+
+
+class UnansweredRequests(object):
+    """Requests (mode and PIDs, e.g. "010C") the vehicle answered NO DATA
+    to, each kept for `expiry` seconds, so that they are not sent again in
+    the meantime"""
+
+    def __init__(self, expiry=NO_DATA_EXPIRY):
+        self.expiry = expiry
+        self._expiry_times = {}
+
+    def add(self, request):
+        self._expiry_times[request] = time.time() + self.expiry
+
+    def clear(self):
+        self._expiry_times.clear()
+
+    def __contains__(self, request):
+        expiry_time = self._expiry_times.get(request)
+        if expiry_time is None:
+            return False
+        if time.time() < expiry_time:
+            return True
+        del self._expiry_times[request]
+        return False
@@ -0,0 +1,339 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+
+"""Polling sensors at their own rates.
+
+A PollingScheduler reads each sensor at the rate asked for it, e.g. RPM at
+10 Hz and coolant temperature every 5 s, always reading next the sensor whose
+read is due soonest (earliest deadline first)::
+
+    scheduler = PollingScheduler(device, {"rpm": 10, "speed": 10, "temp": 0.2})
+    scheduler.run(60, callback=lambda shortname, value, timestamp: ...)
+    for shortname, stats in scheduler.report().items():
+        print shortname, stats.achieved_rate, stats.jitter
+
+Sensors added with `add_adaptive` have no fixed rate: they are read more
+often while their value changes and less often while it holds, within the
+bounds given::
+
+    scheduler.add_adaptive("temp", min_interval=1, max_interval=30)
+
+The time taken by the reads of each sensor is measured as polling goes. When
+the rates asked for need more bus time than there is, the sensors with the
+lowest priority are polled less often, so that those with the highest keep
+their rates.
+"""
+
+from collections import namedtuple
+from logging import getLogger
+import math
+import time
+
+from .sensors import SENSORS
+
+
+# Fraction of the bus time that polling is planned to take. The rest absorbs
+# variations in the time taken by reads.
+BUS_TIME_BUDGET = 0.9
+
+# Longest interval between the reads of a sensor given less bus time than it
+# needs, so that no sensor stops being read altogether
+MAX_DEGRADED_PERIOD = 60.0
+
+# Factors applied to the interval between the reads of an adaptive sensor
+# when its value changes and when it holds
+ADAPTIVE_SPEEDUP = 0.5
+ADAPTIVE_BACKOFF = 1.5
+
+# Weight of each new read in the running estimate of the time taken by reads
+READ_TIME_SMOOTHING = 0.2
+
+
+SensorStats = namedtuple(
+    "SensorStats",
+    [
+        # reads per second asked for
+        "target_rate",
+        # reads per second planned, lower than the target if the sensor was
+        # given less bus time than it needs
+        "scheduled_rate",
+        # reads per second made
+        "achieved_rate",
+        # standard deviation of the intervals between reads, in seconds
+        "jitter",
+        "read_count",
+        ],
+    )
+
+
+# Sensors by short name and alias. Some aliases (former short names) are
+# shared by several sensors.
+_SENSORS_BY_SHORTNAME = {}
+for _sensor in SENSORS:
+    for _name in (_sensor.shortname,) + _sensor.aliases:
+        _SENSORS_BY_SHORTNAME.setdefault(_name, []).append(_sensor)
+del _sensor, _name
+
+
+def get_sensor(shortname):
+    """Return the Sensor with the short name or alias, e.g. "rpm" """
+    try:
+        sensors = _SENSORS_BY_SHORTNAME[shortname]
+    except KeyError:
+        raise ValueError("Unknown sensor %r" % shortname)
+    if len(sensors) > 1:
+        raise ValueError(
+            "Ambiguous sensor %r, one of %s"
+            % (shortname, ", ".join(sensor.shortname for sensor in sensors))
+            )
+    return sensors[0]
+
+
+class _ScheduledSensor(object):
+
+    def __init__(self, sensor, rate, priority):
+        self.sensor = sensor
+        self.target_rate = rate
+        self.priority = priority
+        self.period = 1.0 / rate
+        # time the next read is due
+        self.deadline = None
+        # running estimate of the time taken by a read
+        self.read_time = None
+        self.value = None
+        self.read_count = 0
+        self.first_read_timestamp = None
+        self.last_read_timestamp = None
+        self.interval_sum = 0.0
+        self.interval_square_sum = 0.0
+
+    def record_read(self, value, timestamp, read_time):
+        self.value = value
+        if self.read_time is None:
+            self.read_time = read_time
+        else:
+            self.read_time += READ_TIME_SMOOTHING * (read_time - self.read_time)
+
+        if self.last_read_timestamp is None:
+            self.first_read_timestamp = timestamp
+        else:
+            interval = timestamp - self.last_read_timestamp
+            self.interval_sum += interval
+            self.interval_square_sum += interval * interval
+        self.last_read_timestamp = timestamp
+        self.read_count += 1
+
+        # keep to the original time slots unless more than a period late:
+        # then the next read is due at once, rather than making up for all
+        # the missed ones in a burst
+        self.deadline = max(self.deadline + self.period, timestamp)
+
+    def set_period(self, period):
+        if period == self.period:
+            return
+        self.period = period
+        if self.last_read_timestamp is not None:
+            self.deadline = self.last_read_timestamp + period
+
+    def get_stats(self):
+        interval_count = self.read_count - 1
+        if interval_count < 1:
+            achieved_rate = jitter = 0.0
+        else:
+            achieved_rate = interval_count / \
+                (self.last_read_timestamp - self.first_read_timestamp)
+            mean_interval = self.interval_sum / interval_count
+            variance = \
+                self.interval_square_sum / interval_count - mean_interval ** 2
+            jitter = math.sqrt(max(variance, 0.0))
+        return SensorStats(
+            self.target_rate,
+            1.0 / self.period,
+            achieved_rate,
+            jitter,
+            self.read_count,
+            )
+
+
+class _AdaptiveSensor(_ScheduledSensor):
+    """Scheduled sensor whose rate follows how fast its value changes"""
+
+    def __init__(self, sensor, min_interval, max_interval, tolerance, priority):
+        # start fast: nothing is known about the value yet
+        super(_AdaptiveSensor, self).__init__(
+            sensor,
+            1.0 / min_interval,
+            priority,
+            )
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.tolerance = tolerance
+
+    def record_read(self, value, timestamp, read_time):
+        if self.read_count:
+            if self._has_changed(value):
+                interval = ADAPTIVE_SPEEDUP / self.target_rate
+            else:
+                interval = ADAPTIVE_BACKOFF / self.target_rate
+            interval = min(max(interval, self.min_interval), self.max_interval)
+            self.target_rate = 1.0 / interval
+        super(_AdaptiveSensor, self).record_read(value, timestamp, read_time)
+
+    def _has_changed(self, value):
+        try:
+            return self.tolerance < abs(value - self.value)
+        except TypeError:
+            # not a number, e.g. "NODATA" or a raw hex value
+            return value != self.value
+
+
+class PollingScheduler(object):
+    """Reads sensors of an OBDDevice at per-sensor rates.
+
+    Rates are given in reads per second, by sensor short name. Sensors with a
+    higher priority keep their rate when the bus cannot fit them all; among
+    sensors with the same priority, those added last give way first.
+    """
+
+    _LOGGER = getLogger(__name__ + '.PollingScheduler')
+
+    def __init__(self, device, rates=None, priorities=None):
+        self.device = device
+        self._scheduled_sensors = []
+        priorities = priorities or {}
+        for shortname, rate in sorted((rates or {}).items()):
+            self.add(shortname, rate, priorities.get(shortname, 0))
+
+    def add(self, shortname, rate, priority=0):
+        """Poll the sensor with the short name `rate` times per second"""
+        if rate <= 0:
+            raise ValueError("Rate of %s must be positive: %r" % (shortname, rate))
+        sensor = get_sensor(shortname)
+        self.remove(shortname)
+        self._add(_ScheduledSensor(sensor, rate, priority))
+
+    def add_adaptive(
+        self,
+        shortname,
+        min_interval,
+        max_interval,
+        tolerance=0,
+        priority=0,
+        ):
+        """Poll the sensor with the short name every `min_interval` to
+        `max_interval` seconds: faster while its value changes by more than
+        `tolerance` between reads, slower while it does not"""
+        if not 0 < min_interval <= max_interval:
+            raise ValueError(
+                "Bad interval bounds for %s: %r to %r"
+                % (shortname, min_interval, max_interval)
+                )
+        sensor = get_sensor(shortname)
+        self.remove(shortname)
+        self._add(_AdaptiveSensor(
+            sensor,
+            min_interval,
+            max_interval,
+            tolerance,
+            priority,
+            ))
+
+    def _add(self, scheduled_sensor):
+        scheduled_sensor.deadline = time.time()
+        self._scheduled_sensors.append(scheduled_sensor)
+        self._plan()
+
+    def remove(self, shortname):
+        """Stop polling the sensor with the short name or alias"""
+        if shortname not in _SENSORS_BY_SHORTNAME:
+            return
+        sensor = get_sensor(shortname)
+        self._scheduled_sensors = [
+            s for s in self._scheduled_sensors if s.sensor is not sensor
+            ]
+
+    @property
+    def values(self):
+        """Latest value read of each sensor, by short name"""
+        return dict(
+            (s.sensor.shortname, s.value)
+            for s in self._scheduled_sensors
+            if s.read_count
+            )
+
+    def poll(self):
+        """Wait for the next read to be due, make it and return the short
+        name of the sensor, its value and the time it was read"""
+        if not self._scheduled_sensors:
+            raise ValueError("No sensors to poll")
+        scheduled_sensor = min(
+            self._scheduled_sensors,
+            key=lambda s: (s.deadline, -s.priority),
+            )
+        delay = scheduled_sensor.deadline - time.time()
+        if 0 < delay:
+            time.sleep(delay)
+
+        start_time = time.time()
+        value = self.device.get_sensor_value(scheduled_sensor.sensor)
+        end_time = time.time()
+        scheduled_sensor.record_read(value, start_time, end_time - start_time)
+        self._plan()
+        return scheduled_sensor.sensor.shortname, value, start_time
+
+    def run(self, duration=None, callback=None):
+        """Poll for `duration` seconds (for ever by default), passing the
+        short name, value and time of each read to the callback"""
+        end_time = None if duration is None else time.time() + duration
+        while end_time is None or time.time() < end_time:
+            shortname, value, timestamp = self.poll()
+            if callback is not None:
+                callback(shortname, value, timestamp)
+
+    def report(self):
+        """Return the SensorStats of each sensor, by short name"""
+        return dict(
+            (s.sensor.shortname, s.get_stats()) for s in self._scheduled_sensors
+            )
+
+    def _plan(self):
+        """Share the bus time among the sensors, by priority"""
+        available_time = BUS_TIME_BUDGET
+        by_priority = sorted(self._scheduled_sensors, key=lambda s: -s.priority)
+        for scheduled_sensor in by_priority:
+            read_time = scheduled_sensor.read_time
+            rate = scheduled_sensor.target_rate
+            if read_time:
+                if available_time < read_time * rate:
+                    rate = max(available_time / read_time, 1 / MAX_DEGRADED_PERIOD)
+                    rate = min(rate, scheduled_sensor.target_rate)
+                available_time = max(available_time - read_time * rate, 0.0)
+
+            period = 1.0 / rate
+            if period != scheduled_sensor.period:
+                self._LOGGER.debug(
+                    "Polling %s at %.2f Hz (asked for %.2f Hz)",
+                    scheduled_sensor.sensor.shortname,
+                    rate,
+                    scheduled_sensor.target_rate,
+                    )
+            scheduled_sensor.set_period(period)
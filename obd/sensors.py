@@ -22,167 +22,280 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 ###########################################################################
 
+"""Sensors and their definitions.
+
+Sensors are defined in JSON files such as::
+
+    {"sensors": [
+        {"command": "010C", "responses": 1, "shortname": "rpm",
+         "name": "Engine RPM", "bytes": 2, "formula": "(256*A+B)/4",
+         "unit": "rpm"},
+        {"command": "0101", "shortname": "dtc_status",
+         "name": "Status Since DTC Cleared", "bytes": 4,
+         "decoder": "dtc_status"}
+        ]}
+
+- "command": mode and PID of the request, in hex. PIDs of mode 22 (vendor
+  data identifiers) take two bytes, e.g. "22F40D".
+- "responses": number of responses to wait for, if known (see Sensor)
+- "aliases": other names the sensor is known by, e.g. former short names
+- "bytes": number of data bytes in the reply, after the mode and PID echo
+- "formula": value computed from the data bytes, named A, B, C, ... as in
+  SAE J1979 (see obd.conversion.compile_formula)
+- "decoder": instead of a formula, one of DECODERS. Sensors with neither
+  give the data in hex.
+
+The standard mode 01 sensors are in sensors.json, next to this module.
+Files in VENDOR_SENSORS_DIRECTORY add sensors after those, e.g. for the mode
+22 data identifiers of some make.
+
+Formulas are compiled when a file is loaded. Linear ones on the data read
+as an integer (e.g. "(256*A+B)/4") become LinearConversions; others
+become a table of their 256 values for single bytes, or functions of the
+unpacked bytes. If COMPILED_SENSORS_DIRECTORY exists, the compiled sensors
+are cached there until the file changes, so that later loads skip parsing
+and compiling (several times faster). Nothing is written unless the
+directory is created.
+"""
+
+from logging import getLogger
+import hashlib
+import json
+import marshal
+import os
+import sys
+
+from obd.conversion import LinearConversion
+from obd.conversion import compile_conversion
+from obd.conversion import compile_formula
 from obd.conversion import dtc_decode
-from obd.conversion import noop
+from obd.conversion import get_formula_table
+from obd.conversion import get_linear_conversion
+from obd.conversion import make_formula_conversion
 from obd.conversion import to_bitstring
-from obd.conversion import to_fuel_trim_percent
-from obd.conversion import to_int
-from obd.conversion import to_kpa_gauge
-from obd.conversion import to_maf_grams_sec
-from obd.conversion import to_percent_scale
-from obd.conversion import to_rpm
-from obd.conversion import to_temp_c
-from obd.conversion import to_timing_advance
+from obd.conversion import to_hex
+from obd.elm import encode_command
+
+
+_LOGGER = getLogger(__name__)
+
+STANDARD_SENSORS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "sensors.json",
+    )
+
+VENDOR_SENSORS_DIRECTORY = os.path.join(
+    os.path.expanduser("~"),
+    ".pyobdlib",
+    "sensors",
+    )
+
+COMPILED_SENSORS_DIRECTORY = os.path.join(
+    os.path.expanduser("~"),
+    ".pyobdlib",
+    "compiled",
+    )
+
+# Conversions sensor definitions may name instead of a formula
+DECODERS = {
+    "bitstring": to_bitstring,
+    "dtc_status": dtc_decode,
+    "hex": to_hex,
+    }
+
+# Bytes taken by the PIDs of each mode, if not one
+_PID_SIZES = {0x22: 2}
+
+# Version of the layout of compiled sensors, part of their cache key
+_COMPILED_SENSORS_FORMAT = 3
 
 
 class Sensor:
 
-    def __init__(self, command, short_name, name, value_func=noop, unit=""):
+    def __init__(
+        self,
+        command,
+        short_name,
+        name,
+        value_func=to_hex,
+        unit="",
+        size=None,
+        aliases=(),
+        ):
         self.cmd = command
+        # the command as written to the device and the mode of its reply,
+        # which starts with that mode and the PID, worked out once instead
+        # of on every request
+        self.encoded_cmd = encode_command(command)
+        mode = int(command[:2], 16)
+        pid_end = 2 + 2 * _PID_SIZES.get(mode, 1)
+        self.reply_mode = mode + 0x40
+        self.pid = int(command[2:pid_end], 16)
+        self.reply_prefix = bytearray.fromhex(
+            "%02X%s" % (self.reply_mode, command[2:pid_end]))
+        # mode and PID, without the number of expected responses that some
+        # commands end with
+        self.request = command[:pid_end]
+        self.responses = \
+            int(command[pid_end:], 16) if command[pid_end:] else None
+        # number of data bytes in the reply, if known
+        self.size = size
         self.shortname = short_name
+        self.aliases = tuple(aliases)
         self.name = name
+        # linear conversions are compiled for the size of the PID here, so
+        # that decoding a sample is a lookup or a little arithmetic
+        self.conversion = value_func
+        if isinstance(value_func, LinearConversion):
+            value_func = compile_conversion(value_func, self.size)
         self.value = value_func
         self.unit = unit
 
 
-# Sensor definitions. Note that not all units/conversions appear to be
-# implemented. Those which are not will return the raw hex value.
+def load_sensors(path, compiled_directory=COMPILED_SENSORS_DIRECTORY):
+    """Return the Sensors defined in the JSON file (see the module
+    documentation), compiling it or taking it from the compiled ones in
+    the directory, if it exists"""
+    stat = os.stat(path)
+    # like .pyc files, compiled sensors are for a version of Python and a
+    # version of the file
+    key = (
+        _COMPILED_SENSORS_FORMAT,
+        sys.version,
+        os.path.abspath(path),
+        stat.st_mtime,
+        stat.st_size,
+        )
+    compiled_path = os.path.join(
+        compiled_directory,
+        hashlib.sha1(os.path.abspath(path)).hexdigest() + ".marshal",
+        )
+    compiled_sensors = _read_compiled_sensors(compiled_path, key)
+    if compiled_sensors is None:
+        with open(path) as sensors_file:
+            definitions = json.load(sensors_file)["sensors"]
+        compiled_sensors = [
+            _compile_sensor(definition) for definition in definitions]
+        _write_compiled_sensors(compiled_path, key, compiled_sensors)
+    return [
+        _make_sensor(*compiled_sensor) for compiled_sensor in compiled_sensors]
+
+
+def load_vendor_sensors(directory=VENDOR_SENSORS_DIRECTORY):
+    """Return the Sensors defined in the JSON files in the directory.
+
+    Files that cannot be read or have bad definitions are logged and
+    skipped, so that they do not stop the module from being imported.
+    """
+    try:
+        file_names = sorted(os.listdir(directory))
+    except OSError:
+        return []
+    sensors = []
+    for file_name in file_names:
+        if not file_name.endswith(".json"):
+            continue
+        path = os.path.join(directory, file_name)
+        try:
+            sensors.extend(load_sensors(path))
+        except (
+                ArithmeticError,
+                EnvironmentError,
+                KeyError,
+                TypeError,
+                ValueError,
+                ) as e:
+            _LOGGER.error("Skipping vendor sensors %s: %r", path, e)
+    return sensors
+
+
+def _compile_sensor(definition):
+    """Return the definition as marshal can save it: a tuple of its
+    fields, its linear conversion (if its formula is one) or else the code
+    of its formula (if any) and the table of values of single-byte
+    formulas"""
+    formula = definition.get("formula")
+    size = definition["bytes"]
+    if not isinstance(size, int) or size < 1:
+        raise ValueError("Invalid number of bytes %r" % size)
+    conversion = None
+    formula_code = None
+    table = None
+    if formula is not None:
+        formula_code = compile_formula(str(formula), size)
+        conversion = get_linear_conversion(str(formula), size)
+        if conversion is not None:
+            conversion = tuple(conversion)
+            formula_code = None
+        elif size == 1:
+            table = get_formula_table(formula_code)
+    decoder = definition.get("decoder", "hex")
+    if decoder not in DECODERS:
+        raise ValueError("Unknown decoder %r" % decoder)
+    command = str(definition["command"])
+    if "responses" in definition:
+        command += "%X" % definition["responses"]
+    fields = (
+        command,
+        definition["shortname"].encode("utf-8"),
+        definition["name"].encode("utf-8"),
+        definition.get("unit", "").encode("utf-8"),
+        size,
+        str(decoder),
+        tuple(
+            alias.encode("utf-8") for alias in definition.get("aliases", ())),
+        )
+    return fields, conversion, formula_code, table
+
+
+def _make_sensor(fields, conversion, formula_code, table):
+    command, shortname, name, unit, size, decoder, aliases = fields
+    if conversion is not None:
+        value_func = LinearConversion(*conversion)
+    elif formula_code is not None:
+        value_func = make_formula_conversion(formula_code, size, table)
+    else:
+        value_func = DECODERS[decoder]
+    return Sensor(command, shortname, name, value_func, unit, size, aliases)
+
+
+def _read_compiled_sensors(compiled_path, key):
+    try:
+        with open(compiled_path, "rb") as compiled_file:
+            compiled_key, compiled_sensors = marshal.load(compiled_file)
+    except IOError:
+        return None
+    except (EOFError, ValueError, TypeError):
+        _LOGGER.warning("Ignoring corrupt compiled sensors %s", compiled_path)
+        return None
+    if compiled_key != key:
+        return None
+    return compiled_sensors
+
+
+def _write_compiled_sensors(compiled_path, key, compiled_sensors):
+    # caching is asked for by creating the directory
+    if not os.path.isdir(os.path.dirname(compiled_path)):
+        return
+    # write a new file and move it in place, so that readers never see a
+    # partial one
+    temporary_path = "%s.%d.tmp" % (compiled_path, os.getpid())
+    try:
+        with open(temporary_path, "wb") as compiled_file:
+            marshal.dump((key, compiled_sensors), compiled_file)
+        os.rename(temporary_path, compiled_path)
+    except (IOError, OSError) as e:
+        # as with .pyc files, failing to save only means compiling again
+        _LOGGER.warning("Cannot save compiled sensors: %s", e)
+
+
+# Sensor definitions: the standard mode 01 ones, in order of PID, so that
+# the index of each is its PID, and then those of vendors.
 # More info: http://en.wikipedia.org/wiki/OBD-II_PIDs#Standard_PIDs
-SENSORS = [
-    Sensor("0100", "pids", "Supported PIDs", to_bitstring),
-    Sensor("0101", "dtc_status", "Status Since DTC Cleared", dtc_decode),
-    Sensor("0102", "dtc_ff", "DTC Causing Freeze Frame"),
-    Sensor("0103", "fuel_status", "Fuel System Status"),
-    Sensor("01041", "load", "Calculated Load Value", to_percent_scale, "%"),
-    Sensor("0105", "temp", "Coolant Temperature", to_temp_c, "C"),
-    Sensor("0106", "short_term_fuel_trim_1", "Short Term Fuel Trim", to_fuel_trim_percent, "%"),
-    Sensor("0107", "long_term_fuel_trim_1", "Long Term Fuel Trim", to_fuel_trim_percent, "%"),
-    Sensor("0108", "short_term_fuel_trim_2", "Short Term Fuel Trim", to_fuel_trim_percent, "%"),
-    Sensor("0109", "long_term_fuel_trim_2", "Long Term Fuel Trim", to_fuel_trim_percent, "%"),
-    Sensor("010A", "fuel_pressure", "Fuel Rail Pressure", to_kpa_gauge, "kPa"),
-    Sensor("010B", "manifold_pressure", "Intake Manifold Pressure", to_int, "kPa"),
-    Sensor("010C1", "rpm", "Engine RPM", to_rpm, "rpm"),
-    Sensor("010D1", "speed", "Vehicle Speed", to_int, "km/h"),
-    Sensor("010E", "timing_advance", "Timing Advance", to_timing_advance, "degrees"),
-    Sensor("010F", "intake_air_temp", "Intake Air Temp", to_temp_c, "C"),
-    Sensor("0110", "maf", "Air Flow Rate (MAF)", to_maf_grams_sec, "grams/sec"),
-    Sensor("01111", "throttle_pos", "Throttle Position", to_percent_scale, "%"),
-    Sensor("0112", "secondary_air_status", "Secondary Air Status"),
-    Sensor("0113", "o2_sensor_positions", "Location of O2 sensors"),
-    Sensor("0114", "o211", "O2 Sensor: 1 - 1", to_fuel_trim_percent, "%"),
-    Sensor("0115", "o212", "O2 Sensor: 1 - 2", to_fuel_trim_percent, "%"),
-    Sensor("0116", "o213", "O2 Sensor: 1 - 3", to_fuel_trim_percent, "%"),
-    Sensor("0117", "o214", "O2 Sensor: 1 - 4", to_fuel_trim_percent, "%"),
-    Sensor("0118", "o221", "O2 Sensor: 2 - 1", to_fuel_trim_percent, "%"),
-    Sensor("0119", "o222", "O2 Sensor: 2 - 2", to_fuel_trim_percent, "%"),
-    Sensor("011A", "o223", "O2 Sensor: 2 - 3", to_fuel_trim_percent, "%"),
-    Sensor("011B", "o224", "O2 Sensor: 2 - 4", to_fuel_trim_percent, "%"),
-    Sensor("011C", "obd_standard", "OBD Designation"),
-    Sensor("011D", "o2_sensor_position_b", "Location of O2 sensors"),
-    Sensor("011E", "aux_input", "Aux input status"),
-    Sensor("011F", "engine_time", "Time Since Engine Start", to_int, "secs"),
-    Sensor("0120", "pids2", "PIDs_supported_[21_-_40]", to_bitstring),
-    Sensor("0121", "Distance_traveled_with_", "Distance_traveled_with_m"),
-    Sensor("0122", "Fuel_Rail_Pressure_(rel", "Fuel_Rail_Pressure_(rela"),
-    Sensor("0123", "Fuel_Rail_Pressure_(die", "Fuel_Rail_Pressure_(dies"),
-    Sensor("0124", "O2S1_WR_lambda", "O2S1_WR_lambda(1)"),
-    Sensor("0125", "O2S2_WR_lambda", "O2S2_WR_lambda(1)"),
-    Sensor("0126", "O2S3_WR_lambda", "O2S3_WR_lambda(1)"),
-    Sensor("0127", "O2S4_WR_lambda", "O2S4_WR_lambda(1)"),
-    Sensor("0128", "O2S5_WR_lambda", "O2S5_WR_lambda(1)"),
-    Sensor("0129", "O2S6_WR_lambda", "O2S6_WR_lambda(1)"),
-    Sensor("012A", "O2S7_WR_lambda", "O2S7_WR_lambda(1)"),
-    Sensor("012B", "O2S8_WR_lambda", "O2S8_WR_lambda(1)"),
-    Sensor("012C", "Commanded_EGR", "Commanded_EGR"),
-    Sensor("012D", "EGR_Error", "EGR_Error"),
-    Sensor("012E", "Commanded_evaporative_p", "Commanded_evaporative_pu"),
-    Sensor("012F", "Fuel_Level_Input", "Fuel_Level_Input"),
-    Sensor("0130", "of_warm-ups_since_cod", "of_warm-ups_since_code"),
-    Sensor("0131", "Distance_traveled_since", "Distance_traveled_since_"),
-    Sensor("0132", "Evap._System_Vapor_Pres", "Evap._System_Vapor_Press"),
-    Sensor("0133", "Barometric_pressure", "Barometric_pressure"),
-    Sensor("0134", "O2S1_WR_lambda", "O2S1_WR_lambda(1)"),
-    Sensor("0135", "O2S2_WR_lambda", "O2S2_WR_lambda(1)"),
-    Sensor("0136", "O2S3_WR_lambda", "O2S3_WR_lambda(1)"),
-    Sensor("0137", "O2S4_WR_lambda", "O2S4_WR_lambda(1)"),
-    Sensor("0138", "O2S5_WR_lambda", "O2S5_WR_lambda(1)"),
-    Sensor("0139", "O2S6_WR_lambda", "O2S6_WR_lambda(1)"),
-    Sensor("013A", "O2S7_WR_lambda", "O2S7_WR_lambda(1)"),
-    Sensor("013B", "O2S8_WR_lambda", "O2S8_WR_lambda(1)"),
-    Sensor("013C", "Catalyst_Temperature", "Catalyst_Temperature"),
-    Sensor("013D", "Catalyst_Temperature", "Catalyst_Temperature"),
-    Sensor("013E", "Catalyst_Temperature", "Catalyst_Temperature"),
-    Sensor("013F", "Catalyst_Temperature", "Catalyst_Temperature"),
-    Sensor("0140", "pids3", "PIDs_supported_[41_-_60]", to_bitstring),
-    Sensor("0141", "Monitor_status_this_dri", "Monitor_status_this_driv"),
-    Sensor("0142", "Control_module_voltage", "Control_module_voltage"),
-    Sensor("0143", "Absolute_load_value", "Absolute_load_value"),
-    Sensor("0144", "Command_equivalence_rat", "Command_equivalence_rati"),
-    Sensor("0145", "Relative_throttle_posit", "Relative_throttle_positi"),
-    Sensor("0146", "Ambient_air_temperature", " Ambient_air_temperature"),
-    Sensor("0147", "Absolute_throttle_posit", "Absolute_throttle_positi"),
-    Sensor("0148", "Absolute_throttle_posit", "Absolute_throttle_positi"),
-    Sensor("0149", "Accelerator_pedal_posit", "Accelerator_pedal_positi"),
-    Sensor("014A", "Accelerator_pedal_posit", "Accelerator_pedal_positi"),
-    Sensor("014B", "Accelerator_pedal_posit", "Accelerator_pedal_positi"),
-    Sensor("014C", "Commanded_throttle_actu", "Commanded_throttle_actua"),
-    Sensor("014D", "Time_run_with_MIL_on", "Time_run_with_MIL_on"),
-    Sensor("014E", "Time_since_trouble_code", "Time_since_trouble_codes"),
-    Sensor("014F", "Maximum_value_for_equiv", "Maximum_value_for_equiva"),
-    Sensor("0150", "Maximum_value_for_air_f", "Maximum_value_for_air_fl"),
-    Sensor("0151", "Fuel_Type", "Fuel_Type"),
-    Sensor("0152", "Ethanol_fuel_%", "Ethanol_fuel_%"),
-    Sensor("0153", "Absolute_Evap_system_Va", "Absolute_Evap_system_Vap"),
-    Sensor("0154", "Evap_system_vapor_press", "Evap_system_vapor_pressu"),
-    Sensor("0155", "Short_term_secondary_ox", "Short_term_secondary_oxy"),
-    Sensor("0156", "Long_term_secondary_oxy", "Long_term_secondary_oxyg"),
-    Sensor("0157", "Short_term_secondary_ox", "Short_term_secondary_oxy"),
-    Sensor("0158", "Long_term_secondary_oxy", "Long_term_secondary_oxyg"),
-    Sensor("0159", "Fuel_rail_pressure_(abs", "Fuel_rail_pressure_(abso"),
-    Sensor("015A", "Relative_accelerator_pe", "Relative_accelerator_ped"),
-    Sensor("015B", "Hybrid_battery_pack_rem", "Hybrid_battery_pack_rema"),
-    Sensor("015C", "Engine_oil_temperature", "Engine_oil_temperature"),
-    Sensor("015D", "Fuel_injection_timing", "Fuel_injection_timing"),
-    Sensor("015E", "Engine_fuel_rate", "Engine_fuel_rate"),
-    Sensor("015F", "Emission_requirements_t", "Emission_requirements_to"),
-    Sensor("0160", "pids4", "PIDs_supported_[61_-_80]", to_bitstring),
-    Sensor("0161", "Driver's_demand_engine_", "Driver's_demand_engine_-"),
-    Sensor("0162", "Actual_engine_-_percent", "Actual_engine_-_percent_"),
-    Sensor("0163", "Engine_reference_torque", "Engine_reference_torque"),
-    Sensor("0164", "Engine_percent_torque_d", "Engine_percent_torque_da"),
-    Sensor("0165", "Auxiliary_input_/_outpu", "Auxiliary_input_/_output"),
-    Sensor("0166", "Mass_air_flow_sensor", "Mass_air_flow_sensor"),
-    Sensor("0167", "Engine_coolant_temperat", "Engine_coolant_temperatu"),
-    Sensor("0168", "Intake_air_temperature_", "Intake_air_temperature_s"),
-    Sensor("0169", "Commanded_EGR_and_EGR_E", "Commanded_EGR_and_EGR_Er"),
-    Sensor("016A", "Commanded_Diesel_intake", "Commanded_Diesel_intake_"),
-    Sensor("016B", "Exhaust_gas_recirculati", "Exhaust_gas_recirculatio"),
-    Sensor("016C", "Commanded_throttle_actu", "Commanded_throttle_actua"),
-    Sensor("016D", "Fuel_pressure_control_s", "Fuel_pressure_control_sy"),
-    Sensor("016E", "Injection_pressure_cont", "Injection_pressure_contr"),
-    Sensor("016F", "Turbocharger_compressor", "Turbocharger_compressor_"),
-    Sensor("0170", "Boost_pressure_control", "Boost_pressure_control"),
-    Sensor("0171", "Variable_Geometry_turbo", "Variable_Geometry_turbo_"),
-    Sensor("0172", "Wastegate_control", "Wastegate_control"),
-    Sensor("0173", "Exhaust_pressure", "Exhaust_pressure"),
-    Sensor("0174", "Turbocharger_RPM", "Turbocharger_RPM"),
-    Sensor("0175", "Turbocharger_temperatur", "Turbocharger_temperature"),
-    Sensor("0176", "Turbocharger_temperatur", "Turbocharger_temperature"),
-    Sensor("0177", "Charge_air_cooler_tempe", "Charge_air_cooler_temper"),
-    Sensor("0178", "Exhaust_Gas_temperature", "Exhaust_Gas_temperature_"),
-    Sensor("0179", "Exhaust_Gas_temperature", "Exhaust_Gas_temperature_"),
-    Sensor("017A", "Diesel_particulate_filt", "Diesel_particulate_filte"),
-    Sensor("017B", "Diesel_particulate_filt", "Diesel_particulate_filte"),
-    Sensor("017C", "Diesel_Particulate_filt", "Diesel_Particulate_filte"),
-    Sensor("017D", "NOx_NTE_control_area_st", "NOx_NTE_control_area_sta"),
-    Sensor("017E", "PM_NTE_control_area_sta", "PM_NTE_control_area_stat"),
-    Sensor("017F", "Engine_run_time", "Engine_run_time"),
-    Sensor("0180", "pids5", "PIDs_supported_[81_-_A0]", to_bitstring),
-    Sensor("0181", "Engine_run_time_for_Aux", "Engine_run_time_for_Auxi"),
-    Sensor("0182", "Engine_run_time_for_Aux", "Engine_run_time_for_Auxi"),
-    Sensor("0183", "NOx_sensor", "NOx_sensor"),
-    Sensor("0184", "Manifold_surface_temper", "Manifold_surface_tempera"),
-    Sensor("0185", "NOx_reagent_system" , "NOx_reagent_system"),
-    Sensor("0186", "Particulate_matter_(PM)", "Particulate_matter_(PM)_"),
-    Sensor("0187", "Intake_manifold_absolut", "Intake_manifold_absolute"),
-]
+SENSORS = load_sensors(STANDARD_SENSORS_PATH)
+
+# Number of data bytes in the reply to each mode 01 PID, as per SAE J1979
+PID_DATA_SIZES = dict(
+    (sensor.pid, sensor.size) for sensor in SENSORS if sensor.reply_mode == 0x41)
+
+SENSORS.extend(load_vendor_sensors())
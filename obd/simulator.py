@@ -0,0 +1,1210 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""Simulated ELM327 adapter plugged into a simulated vehicle.
+
+The simulator speaks the ELM327 command set on a pseudo-terminal (or a TCP
+socket, like a Wi-Fi adapter), so the library and the examples run against it
+unmodified::
+
+    $ python -m obd.simulator
+    ELM327 simulator listening on /dev/pts/5
+    $ python examples/scan_sensors.py /dev/pts/5
+
+Replies are delayed as they would be on the vehicle bus, following the timing
+of the protocol the simulated vehicle uses. Pass a latency scale of 0 to get
+replies as fast as possible.
+
+On CAN, the vehicle also broadcasts frames periodically, which the monitoring
+commands (ATMA, ATMR, ATMT) stream out at the pace of the serial link.
+"""
+
+from collections import namedtuple
+from logging import getLogger
+import argparse
+import json
+import os
+import select
+import socket
+import threading
+import time
+import tty
+
+from .elm import COMMAND_TERMINATOR
+from .elm import PROMPT
+from .sensors import SENSORS
+
+
+ELM_VERSION = "ELM327 v1.5"
+
+ELM_DEVICE_DESCRIPTION = "OBDII to RS232 Interpreter"
+
+# Default adapter timeout (ATST 32), in units of 4 ms
+DEFAULT_TIMEOUT_UNITS = 0x32
+
+DEFAULT_VIN = "1D4GP00R55B123456"
+
+DEFAULT_CALIBRATION_IDS = ("JMB*36761500",)
+
+# Identifiers the engine ECU answers with on 11-bit and 29-bit CAN. Other
+# ECUs answer with the following ones (0x7E9, 0x18DAF111, ...).
+ECU_CAN_ID = 0x7E8
+ECU_EXTENDED_CAN_ID = 0x18DAF110
+
+# Request headers addressing all ECUs at once (functional addressing), as
+# set with ATSH
+FUNCTIONAL_HEADER = 0x7DF
+EXTENDED_FUNCTIONAL_HEADER = 0xDB33F1
+
+# Flow control data sent by the adapter unless set otherwise (ATFC SD): no
+# block size limit, no separation time
+DEFAULT_FLOW_CONTROL_DATA = bytearray([0x30, 0x00, 0x00])
+
+# Time the adapter takes to come back after a reset, in seconds
+RESET_TIME = 1.0
+
+WARM_START_TIME = 0.25
+
+SERIAL_BAUDRATE = 38400
+
+# Baud rates are set as divisors of this clock (ATBRD)
+BAUDRATE_CLOCK = 4000000
+
+# Fastest baud rate of an ELM327 (ATBRD 08)
+ELM_MAX_BAUDRATE = 500000
+
+# Bytes of monitored frames the adapter holds while the serial link is too
+# slow to send them, before giving up with BUFFER FULL
+MONITOR_BUFFER_SIZE = 512
+
+# Seconds between the checks for a character stopping monitoring
+MONITOR_INTERVAL = 0.01
+
+# Seconds between the checks of a PtySimulator for being closed
+_CLOSE_POLL_INTERVAL = 0.05
+
+
+Protocol = namedtuple(
+    "Protocol",
+    [
+        "description",
+        "is_can",
+        # bus speed, in bits per second
+        "bitrate",
+        # bits on the bus per data byte (K-line and J1850) or per frame of
+        # eight data bytes (CAN)
+        "bits_per_unit",
+        # header and checksum bytes around each K-line or J1850 message
+        "overhead_bytes",
+        # time an ECU takes to start answering a request (P2)
+        "response_time",
+        # time the adapter spends trying the protocol during a search
+        "search_time",
+        ],
+    )
+
+PROTOCOLS = {
+    "1": Protocol("SAE J1850 PWM", False, 41600, 8, 4, 0.010, 0.35),
+    "2": Protocol("SAE J1850 VPW", False, 10400, 8, 4, 0.010, 0.35),
+    "3": Protocol("ISO 9141-2", False, 10400, 10, 4, 0.030, 2.6),
+    "4": Protocol("ISO 14230-4 (KWP 5BAUD)", False, 10400, 10, 4, 0.030, 2.6),
+    "5": Protocol("ISO 14230-4 (KWP FAST)", False, 10400, 10, 4, 0.030, 0.3),
+    "6": Protocol("ISO 15765-4 (CAN 11/500)", True, 500000, 111, 0, 0.005, 0.1),
+    "7": Protocol("ISO 15765-4 (CAN 29/500)", True, 500000, 131, 0, 0.005, 0.1),
+    "8": Protocol("ISO 15765-4 (CAN 11/250)", True, 250000, 111, 0, 0.005, 0.1),
+    "9": Protocol("ISO 15765-4 (CAN 29/250)", True, 250000, 131, 0, 0.005, 0.1),
+    }
+
+# CAN protocols with 29-bit identifiers; the others use 11-bit ones
+_EXTENDED_ID_PROTOCOLS = frozenset("79")
+
+# Order in which the adapter tries protocols during an automatic search
+SEARCH_ORDER = ("1", "2", "3", "4", "5", "6", "7", "8", "9")
+
+# Reply the adapter gives when a pinned protocol finds no vehicle
+_CONNECTION_ERRORS = {
+    "1": "NO DATA",
+    "2": "NO DATA",
+    "3": "BUS INIT: ...ERROR",
+    "4": "BUS INIT: ...ERROR",
+    "5": "BUS INIT: ...ERROR",
+    }
+
+_DTC_LETTERS = "PCBU"
+
+# Mode 09 PIDs answered by the simulated ECU: supported PIDs, VIN and
+# calibration identifiers
+_MODE_09_SUPPORTED_PIDS = bytearray([0x50, 0x00, 0x00, 0x00])
+
+_CALIBRATION_ID_SIZE = 16
+
+_SUPPORTED_PIDS_RANGE = 0x20
+
+# Values of some common PIDs for an idling engine. PIDs not listed answer
+# with zeros.
+DEFAULT_PID_VALUES = {
+    0x03: "0200",
+    0x04: "33",
+    0x05: "7B",
+    0x06: "80",
+    0x07: "80",
+    0x08: "80",
+    0x09: "80",
+    0x0B: "21",
+    0x0C: "0BB8",
+    0x0D: "00",
+    0x0E: "8C",
+    0x0F: "46",
+    0x10: "0190",
+    0x11: "1A",
+    0x1C: "06",
+    0x1F: "012C",
+    0x2F: "A0",
+    0x33: "65",
+    0x42: "3A98",
+    0x46: "41",
+    }
+
+
+# Frames broadcast on the CAN bus by the simulated vehicle: identifier,
+# period in seconds and data
+DEFAULT_TRAFFIC = (
+    (0x0C9, 0.010, "8A1F0BB800000000"),
+    (0x0F1, 0.010, "0000400000000000"),
+    (0x1A1, 0.020, "00000000A0000000"),
+    (0x1E5, 0.010, "0F08000000000000"),
+    (0x2C3, 0.025, "007B000000000000"),
+    (0x3C9, 0.100, "0000000000000000"),
+    (0x4C1, 0.100, "7B46650000000000"),
+    (0x4D1, 0.500, "0000A00000000000"),
+    )
+
+
+def encode_dtc(dtc):
+    """Encode a trouble code such as "P0133" into its two bytes"""
+    value = _DTC_LETTERS.index(dtc[0].upper()) << 14 | int(dtc[1:], 16)
+    return bytearray([value >> 8, value & 0xFF])
+
+
+def _to_bytes(value):
+    if isinstance(value, basestring):
+        return bytearray.fromhex(value.replace(" ", ""))
+    return bytearray(value)
+
+
+def _format_bytes(data):
+    return " ".join("%02X" % byte for byte in data)
+
+
+class VehicleProfile(object):
+    """What the simulated vehicle answers and how fast.
+
+    `pids` maps mode 01 PIDs to their data, as hex strings or byte sequences,
+    and overrides the defaults. By default every PID in SENSORS is supported;
+    `unsupported` lists PIDs the vehicle does not answer.
+
+    `traffic` lists the frames broadcast on CAN buses, as (identifier, period
+    in seconds, data) tuples.
+
+    `ecus` adds ECUs answering mode 01 requests on CAN besides the engine
+    ECU. It maps their reply identifier on 11-bit CAN (0x7E9 to 0x7EF) to
+    their PIDs and data.
+
+    `dids` maps the mode 22 data identifiers the engine ECU answers (e.g.
+    0xF40D) to their data.
+    """
+
+    def __init__(
+        self,
+        protocol="6",
+        pids=None,
+        unsupported=(),
+        dtcs=(),
+        freeze_dtcs=(),
+        vin=DEFAULT_VIN,
+        traffic=DEFAULT_TRAFFIC,
+        calibration_ids=DEFAULT_CALIBRATION_IDS,
+        ecus=None,
+        dids=None,
+        ):
+        if protocol not in PROTOCOLS:
+            raise ValueError("Unknown protocol: %s" % protocol)
+        self.protocol = protocol
+        self.pids = {}
+        for sensor in SENSORS:
+            if sensor.reply_mode == 0x41 and \
+                    sensor.pid % _SUPPORTED_PIDS_RANGE:
+                value = DEFAULT_PID_VALUES.get(sensor.pid)
+                if value is None:
+                    self.pids[sensor.pid] = bytearray(sensor.size)
+                else:
+                    self.pids[sensor.pid] = _to_bytes(value)
+        for pid, value in (pids or {}).items():
+            self.pids[pid] = _to_bytes(value)
+        for pid in unsupported:
+            self.pids.pop(pid, None)
+        self.dtcs = list(dtcs)
+        self.freeze_dtcs = list(freeze_dtcs)
+        self.vin = vin
+        self.calibration_ids = list(calibration_ids)
+        self.ecus = dict(
+            (ecu_id, dict((pid, _to_bytes(value)) for pid, value in pids.items()))
+            for ecu_id, pids in (ecus or {}).items()
+            )
+        self.dids = dict(
+            (did, _to_bytes(value)) for did, value in (dids or {}).items())
+        self.traffic = [
+            (can_id, period, _to_bytes(data))
+            for can_id, period, data in traffic
+            ]
+
+    @classmethod
+    def load(cls, path):
+        """Read a profile from a JSON file such as::
+
+            {"protocol": "3", "pids": {"0C": "1F40"}, "unsupported": ["5C"],
+             "dtcs": ["P0133"], "freeze_dtcs": [], "vin": "...",
+             "calibration_ids": ["..."],
+             "traffic": [["0C9", 0.01, "8A1F0BB800000000"]],
+             "ecus": {"7E9": {"0D": "32"}}, "dids": {"F40D": "32"}}
+        """
+        with open(path) as profile_file:
+            settings = json.load(profile_file)
+        kwargs = dict((str(key), value) for key, value in settings.items())
+        kwargs["pids"] = dict(
+            (int(pid, 16), value)
+            for pid, value in kwargs.get("pids", {}).items()
+            )
+        kwargs["unsupported"] = [
+            int(pid, 16) for pid in kwargs.get("unsupported", ())
+            ]
+        if "ecus" in kwargs:
+            kwargs["ecus"] = dict(
+                (int(ecu_id, 16), dict(
+                    (int(pid, 16), value) for pid, value in pids.items()
+                    ))
+                for ecu_id, pids in kwargs["ecus"].items()
+                )
+        if "traffic" in kwargs:
+            kwargs["traffic"] = [
+                (int(can_id, 16), period, data)
+                for can_id, period, data in kwargs["traffic"]
+                ]
+        if "dids" in kwargs:
+            kwargs["dids"] = dict(
+                (int(did, 16), value) for did, value in kwargs["dids"].items())
+        return cls(**kwargs)
+
+    @property
+    def ecu_ids(self):
+        """Reply identifiers (on 11-bit CAN) of the ECUs, engine first"""
+        return [ECU_CAN_ID] + sorted(self.ecus)
+
+    def get_pid(self, pid, ecu_id=ECU_CAN_ID):
+        """Return the data for the mode 01 PID from the ECU, or None if not
+        supported"""
+        if ecu_id == ECU_CAN_ID:
+            pids = self.pids
+        else:
+            pids = self.ecus[ecu_id]
+        if pid % _SUPPORTED_PIDS_RANGE == 0:
+            return self._get_supported_pids(pid, pids)
+        if pid == 0x01 and pid in pids and ecu_id == ECU_CAN_ID:
+            return self.get_dtc_status()
+        return pids.get(pid)
+
+    @staticmethod
+    def _get_supported_pids(base_pid, pids):
+        bitmap = 0
+        for pid in pids:
+            if base_pid < pid <= base_pid + _SUPPORTED_PIDS_RANGE:
+                bitmap |= 1 << (base_pid + _SUPPORTED_PIDS_RANGE - pid)
+            elif pid > base_pid + _SUPPORTED_PIDS_RANGE:
+                # the last bit advertises the next range
+                bitmap |= 1
+        if not bitmap and base_pid:
+            # a range is only advertised if the previous one says so
+            return None
+        return bytearray([
+            bitmap >> 24 & 0xFF,
+            bitmap >> 16 & 0xFF,
+            bitmap >> 8 & 0xFF,
+            bitmap & 0xFF,
+            ])
+
+    def get_dtc_status(self):
+        mil = 0x80 if self.dtcs else 0
+        return bytearray([mil | len(self.dtcs), 0x07, 0x65, 0x00])
+
+    def clear_dtcs(self):
+        del self.dtcs[:]
+        del self.freeze_dtcs[:]
+
+
+class ELM327Emulator(object):
+    """Command interpreter of an ELM327 adapter connected to a vehicle.
+
+    The emulator is independent from the link: `execute` takes a command line
+    and returns the text of the reply and how long the adapter would take to
+    send it.
+    """
+
+    _LOGGER = getLogger(__name__ + '.ELM327Emulator')
+
+    def __init__(
+        self,
+        profile=None,
+        latency_scale=1.0,
+        max_baudrate=ELM_MAX_BAUDRATE,
+        stn=False,
+        ):
+        """`max_baudrate` is the fastest serial rate the adapter accepts.
+        STN adapters (`stn`) also switch rates with STSBR."""
+        self.profile = profile or VehicleProfile()
+        self.latency_scale = latency_scale
+        self.max_baudrate = max_baudrate
+        self.stn = stn
+        self.baudrate = SERIAL_BAUDRATE
+        self._pending_baudrate = None
+        self._last_command = None
+        # monitoring in progress: "MA", or "MR" or "MT" and the address they
+        # filter frames on; None when not monitoring
+        self._monitoring = None
+        self.reset()
+
+    def reset(self):
+        """Restore the default settings, as ATZ and ATD do"""
+        self.echo = True
+        self.linefeeds = False
+        self.spaces = True
+        self.headers = False
+        self.can_auto_formatting = True
+        self.can_filter = None
+        self.can_mask = None
+        # header of requests (ATSH), None for the default functional one
+        self.request_header = None
+        self.flow_control_data = DEFAULT_FLOW_CONTROL_DATA
+        self._user_flow_control_data = None
+        self.adaptive_timing = 1
+        self.timeout = DEFAULT_TIMEOUT_UNITS * 0.004
+        self.protocol = "0"
+        self.active_protocol = None
+        self._bus_initialized = False
+
+    @property
+    def line_terminator(self):
+        return "\r\n" if self.linefeeds else "\r"
+
+    def format_reply(self, command_line, lines):
+        """Return the text the adapter sends for the command and its reply
+        lines, up to and including the prompt"""
+        terminator = self.line_terminator
+        reply = "".join(line + terminator for line in lines)
+        reply += terminator + PROMPT
+        if self.echo:
+            reply = command_line + COMMAND_TERMINATOR + reply
+        return reply
+
+    def execute(self, command_line):
+        """Run one command and return its reply and delay (in seconds)"""
+        if self._pending_baudrate:
+            # baud rate handshake (ATBRD): a bare carriage return confirms
+            baudrate, self._pending_baudrate = self._pending_baudrate, None
+            if not command_line:
+                self.baudrate = baudrate
+                return self.format_reply(command_line, ["OK"]), 0
+
+        command = "".join(command_line.split()).upper()
+        if not command:
+            # an empty line repeats the last command
+            command = self._last_command
+            if command is None:
+                return self.format_reply(command_line, []), 0
+        self._last_command = command
+
+        if command.startswith("ATBRD"):
+            reply = self._start_baudrate_handshake(command_line, command[5:])
+            return reply, 0
+        if command.startswith("STSBR") and self.stn:
+            lines = self._set_baudrate(command[5:])
+            return self.format_reply(command_line, lines), 0
+        if command == "ATMA" or command[:4] in ("ATMR", "ATMT"):
+            lines, delay = self._start_monitoring(command[2:4], command[4:])
+            if self.monitoring:
+                # frames follow, with no prompt until monitoring stops
+                reply = "".join(line + self.line_terminator for line in lines)
+                if self.echo:
+                    reply = command_line + COMMAND_TERMINATOR + reply
+            else:
+                reply = self.format_reply(command_line, lines)
+            return reply, delay * self.latency_scale
+        if command.startswith("AT"):
+            lines, delay = self._execute_at(command[2:])
+        else:
+            lines, delay = self._execute_obd(command)
+
+        reply = self.format_reply(command_line, lines)
+        # the host's command and the reply also take time on the serial line
+        delay += (len(command_line) + len(reply) + 1) * 10.0 / self.baudrate
+        return reply, delay * self.latency_scale
+
+    @property
+    def monitoring(self):
+        return self._monitoring is not None
+
+    def _start_monitoring(self, kind, address):
+        """Start monitoring, unless the vehicle cannot be reached. Return the
+        lines printed first and the delay."""
+        if (kind == "MA") != (not address):
+            return ["?"], 0
+        try:
+            address = int(address, 16) if address else None
+        except ValueError:
+            return ["?"], 0
+        lines, delay, connected = self._connect()
+        if not connected:
+            return lines, delay
+        if not self._is_can():
+            return lines + ["NO DATA"], delay + self.timeout
+        self._monitoring = (kind, address)
+        return lines, delay
+
+    def stop_monitoring(self):
+        """Return what the adapter sends when a character from the host stops
+        monitoring"""
+        self._monitoring = None
+        terminator = self.line_terminator
+        return "STOPPED" + terminator + terminator + PROMPT
+
+    def monitor(self):
+        """Yield what the adapter sends while monitoring, as it goes, until
+        its buffer overflows or `stop_monitoring` is called. Frames are sent
+        as fast as the baud rate allows; those that cannot be sent yet wait
+        in the buffer."""
+        traffic = [
+            (can_id, period, data)
+            for can_id, period, data in self.profile.traffic
+            if self._is_monitored(can_id)
+            ]
+        start_time = last_time = time.time()
+        next_times = [start_time] * len(traffic)
+        backlog = ""
+        sendable_bytes = 0.0
+        while self.monitoring:
+            now = time.time()
+            for index, (can_id, period, data) in enumerate(traffic):
+                while next_times[index] <= now:
+                    next_times[index] += period
+                    backlog += self._format_frame(can_id, data)
+
+            sendable_bytes += (now - last_time) * self.baudrate / 10.0
+            last_time = now
+            sent_count = min(int(sendable_bytes), len(backlog))
+            sendable_bytes -= sent_count
+            if not backlog:
+                # the link idles: unused time does not carry over
+                sendable_bytes = 0.0
+            text, backlog = backlog[:sent_count], backlog[sent_count:]
+
+            if len(backlog) > MONITOR_BUFFER_SIZE:
+                # finish the line being sent and give up
+                self._monitoring = None
+                terminator = self.line_terminator
+                if text and not text.endswith(terminator):
+                    end = backlog.index(terminator) + len(terminator)
+                    text += backlog[:end]
+                text += "BUFFER FULL" + terminator + terminator + PROMPT
+            yield text
+
+    def _passes_can_filter(self, can_id):
+        """Tell whether the receive filter (ATCF and ATCM, or ATCRA) lets
+        frames with the identifier through"""
+        if self.can_filter is None:
+            return True
+        mask = self.can_mask
+        if mask is None:
+            mask = 0x1FFFFFFF
+        return can_id & mask == self.can_filter & mask
+
+    def _is_monitored(self, can_id):
+        if not self._passes_can_filter(can_id):
+            return False
+        kind, address = self._monitoring
+        if kind == "MA":
+            return True
+        # ATMR and ATMT look at the target and source addresses of 29-bit
+        # identifiers, taken here as the low byte of 11-bit ones
+        if kind == "MR" and self.active_protocol in _EXTENDED_ID_PROTOCOLS:
+            return can_id >> 8 & 0xFF == address
+        return can_id & 0xFF == address
+
+    def _format_frame(self, can_id, data):
+        text = self._format_bytes(data)
+        if self.headers:
+            if self.active_protocol in _EXTENDED_ID_PROTOCOLS:
+                header = "%08X" % can_id
+            else:
+                header = "%03X" % can_id
+            text = header + (" " if self.spaces else "") + text
+        return text + self.line_terminator
+
+    def _start_baudrate_handshake(self, command_line, divisor):
+        try:
+            baudrate = BAUDRATE_CLOCK // int(divisor, 16)
+        except (ValueError, ZeroDivisionError):
+            baudrate = None
+        if not baudrate or baudrate > self.max_baudrate:
+            return self.format_reply(command_line, ["?"])
+        self._pending_baudrate = baudrate
+        # "OK" at the current rate, then the identity at the new one and no
+        # prompt, as the host has to confirm first
+        terminator = self.line_terminator
+        reply = "OK" + terminator + ELM_VERSION + terminator
+        if self.echo:
+            reply = command_line + COMMAND_TERMINATOR + reply
+        return reply
+
+    def _set_baudrate(self, baudrate):
+        try:
+            baudrate = int(baudrate)
+        except ValueError:
+            return ["?"]
+        if baudrate > self.max_baudrate:
+            return ["?"]
+        self.baudrate = baudrate
+        return ["OK"]
+
+    def _execute_at(self, command):
+        if command in ("Z", "D"):
+            self.reset()
+            if command == "D":
+                return ["OK"], 0
+            return ["", "", ELM_VERSION], RESET_TIME
+        if command == "WS":
+            self.reset()
+            return ["", "", ELM_VERSION], WARM_START_TIME
+        if command == "I":
+            return [ELM_VERSION], 0
+        if command == "@1":
+            return [ELM_DEVICE_DESCRIPTION], 0
+        if command == "RV":
+            return ["12.6V"], 0
+        if command == "DP":
+            protocol = self.active_protocol or self.protocol.lstrip("A")
+            if protocol == "0":
+                return ["AUTO"], 0
+            description = PROTOCOLS[protocol].description
+            if self._is_automatic():
+                description = "AUTO, " + description
+            return [description], 0
+        if command == "DPN":
+            protocol = self.active_protocol or self.protocol.lstrip("A")
+            if self._is_automatic():
+                protocol = "A" + protocol
+            return [protocol], 0
+        if command in ("PC", "M0", "M1"):
+            return ["OK"], 0
+
+        if command.startswith("CF") or command.startswith("CM"):
+            try:
+                value = int(command[2:], 16)
+            except ValueError:
+                return ["?"], 0
+            if command.startswith("CF"):
+                self.can_filter = value
+            else:
+                self.can_mask = value
+            return ["OK"], 0
+        if command.startswith("CRA"):
+            if command == "CRA":
+                self.can_filter = self.can_mask = None
+                return ["OK"], 0
+            try:
+                self.can_filter = int(command[3:], 16)
+            except ValueError:
+                return ["?"], 0
+            self.can_mask = 0x1FFFFFFF
+            return ["OK"], 0
+        if command.startswith("SH") and len(command) in (5, 8):
+            try:
+                self.request_header = int(command[2:], 16)
+            except ValueError:
+                return ["?"], 0
+            return ["OK"], 0
+        if command.startswith("FC"):
+            return self._set_flow_control(command[2:]), 0
+
+        setting, value = command[:-1], command[-1:]
+        if setting in ("E", "L", "S", "H", "CAF") and value in "01":
+            attribute = {
+                "E": "echo",
+                "L": "linefeeds",
+                "S": "spaces",
+                "H": "headers",
+                "CAF": "can_auto_formatting",
+                }[setting]
+            setattr(self, attribute, value == "1")
+            return ["OK"], 0
+        if setting == "AT" and value in "012":
+            self.adaptive_timing = int(value)
+            return ["OK"], 0
+
+        if command.startswith("ST") and len(command) == 4:
+            units = int(command[2:], 16) or DEFAULT_TIMEOUT_UNITS
+            self.timeout = units * 0.004
+            return ["OK"], 0
+        if command.startswith("SP") or command.startswith("TP"):
+            protocol = command[2:]
+            if command.startswith("TP"):
+                protocol = "A" + protocol
+            if protocol.lstrip("A") not in PROTOCOLS and protocol != "0":
+                return ["?"], 0
+            self.protocol = protocol
+            self.active_protocol = None
+            self._bus_initialized = False
+            return ["OK"], 0
+
+        return ["?"], 0
+
+    def _set_flow_control(self, command):
+        """Flow control settings: data (SD), header (SH) and mode (SM)"""
+        setting, value = command[:2], command[2:]
+        try:
+            data = bytearray.fromhex(value)
+        except ValueError:
+            return ["?"]
+        if setting == "SD" and 1 <= len(data) <= 5:
+            self._user_flow_control_data = data
+            return ["OK"]
+        if setting == "SH" and data:
+            return ["OK"]
+        if setting == "SM" and value in ("0", "1", "2"):
+            if value == "0":
+                self.flow_control_data = DEFAULT_FLOW_CONTROL_DATA
+            elif self._user_flow_control_data is None:
+                return ["?"]
+            else:
+                self.flow_control_data = self._user_flow_control_data
+            return ["OK"]
+        return ["?"]
+
+    def _is_automatic(self):
+        return self.protocol == "0" or self.protocol.startswith("A")
+
+    def _connect(self):
+        """Establish the protocol for an OBD request. Return the lines the
+        adapter prints while doing so, how long it took and whether it
+        succeeded."""
+        vehicle_protocol = self.profile.protocol
+        if self.active_protocol:
+            return [], 0, True
+
+        if not self._is_automatic():
+            protocol = PROTOCOLS[self.protocol]
+            if self.protocol != vehicle_protocol:
+                error = _CONNECTION_ERRORS.get(self.protocol, "CAN ERROR")
+                return [error], protocol.search_time, False
+            self.active_protocol = self.protocol
+            return self._init_bus(), protocol.search_time, True
+
+        # try the preferred protocol first (ATSP Ah / ATTP h), then search
+        candidates = list(SEARCH_ORDER)
+        preferred = self.protocol.lstrip("A")
+        if preferred != "0":
+            candidates.remove(preferred)
+            candidates.insert(0, preferred)
+        search_time = 0
+        for candidate in candidates:
+            search_time += PROTOCOLS[candidate].search_time
+            if candidate == vehicle_protocol:
+                self.active_protocol = candidate
+                lines = ["SEARCHING..."] + self._init_bus()
+                return lines, search_time, True
+        return ["SEARCHING...", "UNABLE TO CONNECT"], search_time, False
+
+    def _init_bus(self):
+        if self.active_protocol in ("3", "4", "5"):
+            if not self._bus_initialized:
+                self._bus_initialized = True
+                return ["BUS INIT: ...OK"]
+        return []
+
+    def _execute_obd(self, command):
+        try:
+            bytearray.fromhex(command[:len(command) & ~1])
+        except ValueError:
+            return ["?"], 0
+        if len(command) < 2:
+            return ["?"], 0
+
+        # an odd number of digits ends with the expected number of responses
+        expected_responses = None
+        if len(command) % 2:
+            expected_responses = int(command[-1], 16)
+            command = command[:-1]
+
+        lines, delay, connected = self._connect()
+        if not connected:
+            return lines, delay + self.timeout
+
+        request = bytearray.fromhex(command)
+        protocol = PROTOCOLS[self.active_protocol]
+        messages = self._answer(request)
+        if protocol.is_can:
+            messages = [
+                (ecu_id, message) for ecu_id, message in messages
+                if self._passes_can_filter(self._get_can_id(ecu_id))
+                ]
+        delay += self._bus_time(protocol, request)
+        if not messages:
+            return lines + ["NO DATA"], delay + self.timeout
+
+        delay += protocol.response_time
+        for _ecu_id, message in messages:
+            delay += self._bus_time(protocol, message)
+            delay += self._flow_control_time(protocol, message)
+        lines.extend(self._format_messages(protocol, messages))
+        if expected_responses is None or expected_responses > len(messages):
+            delay += self._wait_time(protocol)
+        return lines, delay
+
+    def _bus_time(self, protocol, message):
+        if protocol.is_can:
+            frames = 1 if len(message) <= 7 else (len(message) + 7) // 7
+            bits = frames * protocol.bits_per_unit
+        else:
+            bits = (len(message) + protocol.overhead_bytes) * \
+                protocol.bits_per_unit
+        return float(bits) / protocol.bitrate
+
+    def _flow_control_time(self, protocol, message):
+        """Time the flow control of a multi-frame message adds: a flow
+        control frame and an ECU response per block of consecutive frames,
+        and the separation time between them"""
+        if not protocol.is_can or len(message) <= 7:
+            return 0
+        consecutive_frames = -(-(len(message) - 6) // 7)
+        block_size = self.flow_control_data[1] \
+            if len(self.flow_control_data) > 1 else 0
+        separation_time = self.flow_control_data[2] \
+            if len(self.flow_control_data) > 2 else 0
+        if separation_time > 0x7F:
+            # 0xF1 to 0xF9 stand for 100 to 900 microseconds
+            separation_time = 0.1 * (separation_time & 0x0F)
+        blocks = -(-consecutive_frames // block_size) if block_size else 1
+        frame_time = float(protocol.bits_per_unit) / protocol.bitrate
+        return blocks * (frame_time + protocol.response_time) + \
+            consecutive_frames * separation_time / 1000.0
+
+    def _wait_time(self, protocol):
+        """Time the adapter keeps listening for further responses"""
+        if self.adaptive_timing == 1:
+            return min(self.timeout, 2 * protocol.response_time + 0.025)
+        if self.adaptive_timing == 2:
+            return min(self.timeout, protocol.response_time + 0.010)
+        return self.timeout
+
+    def _answer(self, request):
+        """Return the messages the vehicle sends in response to the
+        request, as pairs of the ECU sending it (see VehicleProfile.ecus) and
+        the bytes after the headers"""
+        ecu_ids = self._get_addressed_ecus()
+        answers = []
+        if request[0] == 0x01 and len(request) > 1:
+            for ecu_id in ecu_ids:
+                response = self._answer_pids(request, ecu_id)
+                if response is not None:
+                    answers.append((ecu_id, response))
+        elif ECU_CAN_ID in ecu_ids:
+            answers.extend(
+                (ECU_CAN_ID, message)
+                for message in self._answer_engine(request)
+                )
+        return answers
+
+    def _get_addressed_ecus(self):
+        """Return the ECUs the request header addresses: all of them by
+        default, or a single one (physical addressing)"""
+        ecu_ids = self.profile.ecu_ids
+        header = self.request_header
+        if header is None or not self._is_can() or \
+                header in (FUNCTIONAL_HEADER, EXTENDED_FUNCTIONAL_HEADER):
+            return ecu_ids if self._is_can() else ecu_ids[:1]
+        if self.active_protocol in _EXTENDED_ID_PROTOCOLS:
+            # DA, the target address, then the tester (F1)
+            ecu_id = ECU_CAN_ID + (header >> 8 & 0xFF) - (ECU_EXTENDED_CAN_ID & 0xFF)
+        else:
+            # requests to 0x7E0 are answered from 0x7E8, and so on
+            ecu_id = header + 8
+        return [ecu_id] if ecu_id in ecu_ids else []
+
+    def _get_can_id(self, ecu_id):
+        if self.active_protocol in _EXTENDED_ID_PROTOCOLS:
+            return ECU_EXTENDED_CAN_ID + ecu_id - ECU_CAN_ID
+        return ecu_id
+
+    def _answer_pids(self, request, ecu_id):
+        # CAN vehicles accept up to six PIDs per request
+        pids = request[1:7 if self._is_can() else 2]
+        response = bytearray([0x41])
+        for pid in pids:
+            data = self.profile.get_pid(pid, ecu_id)
+            if data is not None:
+                response.append(pid)
+                response.extend(data)
+        if len(response) == 1:
+            return None
+        return response
+
+    def _answer_engine(self, request):
+        """Return the messages the engine ECU sends in response to requests
+        other than mode 01 ones"""
+        mode = request[0]
+        profile = self.profile
+        if mode in (0x03, 0x07):
+            dtcs = profile.dtcs if mode == 0x03 else profile.freeze_dtcs
+            return self._dtc_messages(0x40 + mode, dtcs)
+        if mode == 0x04:
+            profile.clear_dtcs()
+            return [bytearray([0x44])]
+        if mode == 0x09 and len(request) == 2:
+            if request[1] == 0x00:
+                return [bytearray([0x49, 0x00]) + _MODE_09_SUPPORTED_PIDS]
+            if request[1] == 0x02:
+                return self._vin_messages()
+            if request[1] == 0x04:
+                return self._calibration_id_messages()
+        if mode == 0x22 and len(request) == 3:
+            data = profile.dids.get(request[1] << 8 | request[2])
+            if data is not None:
+                return [bytearray([0x62]) + request[1:3] + data]
+        return []
+
+    def _is_can(self):
+        return PROTOCOLS[self.active_protocol].is_can
+
+    def _dtc_messages(self, response_mode, dtcs):
+        encoded_dtcs = bytearray()
+        for dtc in dtcs:
+            encoded_dtcs.extend(encode_dtc(dtc))
+        if self._is_can():
+            return [bytearray([response_mode, len(dtcs)]) + encoded_dtcs]
+        # three codes per message, the last one padded with zeros
+        messages = []
+        for start in range(0, max(len(encoded_dtcs), 1), 6):
+            chunk = encoded_dtcs[start:start + 6]
+            chunk.extend(bytearray(6 - len(chunk)))
+            messages.append(bytearray([response_mode]) + chunk)
+        return messages
+
+    def _vin_messages(self):
+        vin = bytearray(self.profile.vin)
+        if self._is_can():
+            return [bytearray([0x49, 0x02, 0x01]) + vin]
+        # four characters per message, the first one padded with zeros
+        vin = bytearray(3) + vin
+        return [
+            bytearray([0x49, 0x02, index + 1]) + vin[index * 4:index * 4 + 4]
+            for index in range(len(vin) // 4)
+            ]
+
+    def _calibration_id_messages(self):
+        data = bytearray()
+        for calibration_id in self.profile.calibration_ids:
+            calibration_id = bytearray(calibration_id[:_CALIBRATION_ID_SIZE])
+            calibration_id.extend(bytearray(_CALIBRATION_ID_SIZE - len(calibration_id)))
+            data.extend(calibration_id)
+        count = len(self.profile.calibration_ids)
+        if self._is_can():
+            return [bytearray([0x49, 0x04, count]) + data]
+        return [
+            bytearray([0x49, 0x04, index + 1]) + data[index * 4:index * 4 + 4]
+            for index in range(len(data) // 4)
+            ]
+
+    def _format_messages(self, protocol, messages):
+        """Return the lines showing the messages of the ECUs"""
+        if not (protocol.is_can and self.headers):
+            lines = []
+            for _ecu_id, message in messages:
+                lines.extend(self._format_message(protocol, message))
+            return lines
+
+        # ECUs send their frames at the same time: they come interleaved
+        frame_lines = [
+            self._format_frames(self._get_can_id(ecu_id), message)
+            for ecu_id, message in messages
+            ]
+        lines = []
+        for index in range(max(len(frames) for frames in frame_lines)):
+            for frames in frame_lines:
+                if index < len(frames):
+                    lines.append(frames[index])
+        return lines
+
+    def _format_message(self, protocol, message):
+        if not protocol.is_can or len(message) <= 7:
+            return [self._format_bytes(message)]
+        # multi-frame message, as the adapter lays it out with headers off
+        lines = ["%03X" % len(message)]
+        chunks = [message[:6]]
+        for start in range(6, len(message), 7):
+            chunks.append(message[start:start + 7])
+        padding = 7 - len(chunks[-1])
+        if len(chunks) > 1 and padding:
+            chunks[-1] = chunks[-1] + bytearray([0x55] * padding)
+        for index, chunk in enumerate(chunks):
+            lines.append("%X: %s" % (index % 16, self._format_bytes(chunk)))
+        return lines
+
+    def _format_frames(self, can_id, message):
+        """Lay out the message as the ISO-TP frames carrying it, as the
+        adapter shows them with headers on"""
+        if self.active_protocol in _EXTENDED_ID_PROTOCOLS:
+            header = "%08X" % can_id
+        else:
+            header = "%03X" % can_id
+        if len(message) <= 7:
+            frames = [bytearray([len(message)]) + message]
+        else:
+            frames = [
+                bytearray([0x10 | len(message) >> 8, len(message) & 0xFF]) +
+                message[:6]
+                ]
+            for index, start in enumerate(range(6, len(message), 7)):
+                frames.append(
+                    bytearray([0x20 | (index + 1) % 16]) + message[start:start + 7]
+                    )
+        separator = " " if self.spaces else ""
+        lines = []
+        for frame in frames:
+            frame.extend(bytearray([0x55] * (8 - len(frame))))
+            lines.append(header + separator + self._format_bytes(frame))
+        return lines
+
+    def _format_bytes(self, data):
+        text = _format_bytes(data)
+        if not self.spaces:
+            text = text.replace(" ", "")
+        return text
+
+
+def serve(emulator, read, write, wait_readable):
+    """Run the emulator over a link until `read` returns no data.
+    `wait_readable(timeout)` tells whether the host sent anything within the
+    timeout."""
+    pending = ""
+    while True:
+        data = read()
+        if not data:
+            return
+        pending += data.replace("\n", "")
+        while COMMAND_TERMINATOR in pending:
+            command_line, pending = pending.split(COMMAND_TERMINATOR, 1)
+            reply, delay = emulator.execute(command_line)
+            if delay:
+                time.sleep(delay)
+            write(reply)
+            if emulator.monitoring:
+                pending = _serve_monitoring(emulator, read, write, wait_readable)
+
+
+def _serve_monitoring(emulator, read, write, wait_readable):
+    """Stream monitored frames until the host sends a character, which is
+    dropped, and return what the host sent after it"""
+    for text in emulator.monitor():
+        if text:
+            write(text)
+        if emulator.monitoring and wait_readable(MONITOR_INTERVAL):
+            data = read()
+            write(emulator.stop_monitoring())
+            return data[1:].replace("\n", "")
+    return ""
+
+
+class PtySimulator(object):
+    """Simulated adapter reachable as a serial port on a pseudo-terminal"""
+
+    _LOGGER = getLogger(__name__ + '.PtySimulator')
+
+    def __init__(self, profile=None, latency_scale=1.0):
+        self.emulator = ELM327Emulator(profile, latency_scale)
+        self._master_fd, self._slave_fd = os.openpty()
+        tty.setraw(self._slave_fd)
+        self.port_name = os.ttyname(self._slave_fd)
+        self._thread = None
+        self._closed = False
+
+    def start(self):
+        """Serve in a background (daemon) thread"""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def serve_forever(self):
+        """Serve until closed. The master end of the pseudo-terminal is
+        closed on return."""
+        self._LOGGER.info("Serving on %s", self.port_name)
+        try:
+            serve(self.emulator, self._read, self._write, self._wait_readable)
+        finally:
+            self._close_master()
+
+    def _close_master(self):
+        if self._master_fd is not None:
+            os.close(self._master_fd)
+            self._master_fd = None
+
+    def _read(self):
+        # poll, so that closing stops serving even while the host still
+        # holds the slave end open
+        while not self._closed:
+            if not self._wait_readable(_CLOSE_POLL_INTERVAL):
+                continue
+            try:
+                return os.read(self._master_fd, 1024)
+            except OSError:
+                break
+        return ""
+
+    def _wait_readable(self, timeout):
+        try:
+            return bool(select.select([self._master_fd], [], [], timeout)[0])
+        except (OSError, select.error):
+            return True
+
+    def _write(self, data):
+        try:
+            while data:
+                data = data[os.write(self._master_fd, data):]
+        except OSError:
+            # the slave end is closed: nobody to answer to
+            pass
+
+    def close(self):
+        # the serving thread owns the master end and closes it when it
+        # stops, so that its file descriptor is not reused while the thread
+        # may still write. Serving in the foreground closed it already.
+        if self._closed:
+            return
+        self._closed = True
+        os.close(self._slave_fd)
+        if self._thread is None:
+            self._close_master()
+        else:
+            self._thread.join()
+
+
+class TCPSimulator(object):
+    """Simulated Wi-Fi adapter, serving one client at a time over TCP"""
+
+    _LOGGER = getLogger(__name__ + '.TCPSimulator')
+
+    def __init__(self, profile=None, latency_scale=1.0, port=0):
+        self.emulator = ELM327Emulator(profile, latency_scale)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(("127.0.0.1", port))
+        self._socket.listen(1)
+        self.port_name = "tcp://127.0.0.1:%d" % self._socket.getsockname()[1]
+        self._thread = None
+
+    def start(self):
+        """Serve in a background (daemon) thread"""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def serve_forever(self):
+        self._LOGGER.info("Serving on %s", self.port_name)
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except socket.error:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            serve_socket(self.emulator, client)
+
+    def close(self):
+        self._socket.close()
+
+
+def serve_socket(emulator, sock):
+    """Run the emulator over a connected socket, such as the peer of a
+    LoopbackTransport, until it is closed"""
+    def read():
+        try:
+            return sock.recv(1024)
+        except socket.error:
+            return ""
+    def wait_readable(timeout):
+        try:
+            return bool(select.select([sock], [], [], timeout)[0])
+        except (socket.error, select.error):
+            return True
+    try:
+        serve(emulator, read, sock.sendall, wait_readable)
+    except socket.error:
+        pass
+    finally:
+        sock.close()
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Simulated ELM327 adapter")
+    parser.add_argument("--profile", help="vehicle profile (JSON file)")
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1.0,
+        help="multiplier of the simulated delays (0 to disable them)",
+        )
+    parser.add_argument(
+        "--tcp",
+        type=int,
+        metavar="PORT",
+        help="listen on a TCP port instead of a pseudo-terminal",
+        )
+    arguments = parser.parse_args()
+
+    profile = None
+    if arguments.profile:
+        profile = VehicleProfile.load(arguments.profile)
+
+    if arguments.tcp is None:
+        simulator = PtySimulator(profile, arguments.latency_scale)
+    else:
+        simulator = TCPSimulator(
+            profile,
+            arguments.latency_scale,
+            arguments.tcp,
+            )
+    print 'ELM327 simulator listening on', simulator.port_name
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+
+
+if __name__ == '__main__':
+    _main()
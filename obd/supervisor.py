@@ -0,0 +1,448 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""Polling very large fleets of adapters from several processes.
+
+Past a few dozen adapters, decoding and logging in one process is bound by
+the CPU. A FleetSupervisor shards the adapters across worker processes, each
+polling its share with a DeviceFleet, and collects their readings::
+
+    supervisor = FleetSupervisor(4, 2, callback=store_reading)
+    for port in ports:
+        supervisor.add(port, {"rpm": 10, "speed": 10})
+    supervisor.run(60)
+    supervisor.close()
+
+Workers send readings in a compact binary form over a pipe each, in batches.
+A worker that dies is started again with the same adapters. As adapters are
+added and removed, they are moved between workers so that all poll about as
+many.
+"""
+
+from collections import Counter
+from logging import getLogger
+import multiprocessing
+import select
+import signal
+import struct
+import time
+
+import trollius as asyncio
+
+from .fleet import DeviceFleet
+from .replies import ReadTimeout
+from .replies import ReplyError
+from .scheduler import get_sensor
+from .sensors import SENSORS
+
+
+# Seconds between the batches of readings sent by a worker
+FLUSH_INTERVAL = 0.1
+
+# Seconds the supervisor waits for readings before checking on its workers
+CHECK_INTERVAL = 0.5
+
+# Seconds workers get to finish their commands when the supervisor closes
+SHUTDOWN_TIMEOUT = 5
+
+# Readings are sent as a device number, sensor index, timestamp and kind of
+# value, followed by the value
+_READING_HEADER = struct.Struct("<HHdB")
+_FLOAT = struct.Struct("<d")
+_INT = struct.Struct("<q")
+_LENGTH = struct.Struct("<H")
+
+_FLOAT_VALUE, _INT_VALUE, _STRING_VALUE, _INT_LIST_VALUE = range(4)
+_REPLY_ERROR_VALUE, _READ_TIMEOUT_VALUE = range(4, 6)
+
+# Kinds of the string values whose type is kept, most derived first
+_STRING_TYPES = [
+    (_READ_TIMEOUT_VALUE, ReadTimeout),
+    (_REPLY_ERROR_VALUE, ReplyError),
+    ]
+
+_MIN_INT = -2 ** 63
+_MAX_INT = 2 ** 63 - 1
+
+# Messages of workers start with their kind: readings, or the device number
+# of an adapter whose link the worker closed after it was taken away
+_READINGS_MESSAGE, _RELEASED_MESSAGE = "R", "X"
+_DEVICE_NUMBER = struct.Struct("<H")
+
+
+def encode_reading(device_number, sensor_index, timestamp, value):
+    """Return the bytes of the reading of the sensor (by index in SENSORS)
+    of the device.
+
+    Values are numbers, lists of integers or strings, and keep their type
+    when they are a ReplyError or ReadTimeout. Others are sent as their
+    string representation.
+    """
+    if isinstance(value, float):
+        kind = _FLOAT_VALUE
+        data = _FLOAT.pack(value)
+    elif isinstance(value, (int, long)) and _MIN_INT <= value <= _MAX_INT:
+        kind = _INT_VALUE
+        data = _INT.pack(value)
+    elif isinstance(value, list) and \
+            all(isinstance(item, (int, long)) for item in value):
+        kind = _INT_LIST_VALUE
+        data = _LENGTH.pack(len(value)) + \
+            struct.pack("<%dq" % len(value), *value)
+    else:
+        for kind, string_type in _STRING_TYPES:
+            if isinstance(value, string_type):
+                break
+        else:
+            kind = _STRING_VALUE
+        value = str(value)
+        data = _LENGTH.pack(len(value)) + value
+    return _READING_HEADER.pack(device_number, sensor_index, timestamp, kind) \
+        + data
+
+
+def decode_readings(data):
+    """Generate the (device number, sensor index, timestamp, value) of each
+    reading in the bytes"""
+    offset = 0
+    while offset < len(data):
+        device_number, sensor_index, timestamp, kind = \
+            _READING_HEADER.unpack_from(data, offset)
+        offset += _READING_HEADER.size
+        if kind == _FLOAT_VALUE:
+            value, = _FLOAT.unpack_from(data, offset)
+            offset += _FLOAT.size
+        elif kind == _INT_VALUE:
+            value, = _INT.unpack_from(data, offset)
+            offset += _INT.size
+        else:
+            length, = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            if kind == _INT_LIST_VALUE:
+                value = list(struct.unpack_from("<%dq" % length, data, offset))
+                offset += length * _INT.size
+            else:
+                value = data[offset:offset + length]
+                offset += length
+                if kind == _REPLY_ERROR_VALUE:
+                    value = ReplyError(value)
+                elif kind == _READ_TIMEOUT_VALUE:
+                    value = ReadTimeout(value)
+        yield device_number, sensor_index, timestamp, value
+
+
+def _run_worker(connection, timeout, assignments):
+    """Poll the adapters assigned to a worker process and send their readings
+    to the supervisor, until it asks to stop or goes away.
+
+    Assignments are (device number, port, rates) 3-tuples. The supervisor
+    sends more as ("add", device number, port, rates) and takes adapters
+    away with ("remove", port), which the worker confirms once it closed
+    the link.
+    """
+    # interrupting is up to the supervisor, which closes the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    fleet = DeviceFleet(timeout, loop)
+    device_numbers = {}
+    sensor_indexes = {}
+    readings = []
+
+    def add(device_number, port, rates):
+        device_numbers[port] = device_number
+        fleet.add(port, rates)
+
+    def record(port, shortname, value, timestamp):
+        sensor_index = sensor_indexes.get(shortname)
+        if sensor_index is None:
+            sensor_index = SENSORS.index(get_sensor(shortname))
+            sensor_indexes[shortname] = sensor_index
+        readings.append(
+            encode_reading(device_numbers[port], sensor_index, timestamp, value),
+            )
+
+    def flush():
+        if readings:
+            connection.send_bytes(_READINGS_MESSAGE + "".join(readings))
+            del readings[:]
+
+    def release(port):
+        connection.send_bytes(
+            _RELEASED_MESSAGE + _DEVICE_NUMBER.pack(device_numbers[port]))
+
+    def flush_periodically():
+        flush()
+        loop.call_later(FLUSH_INTERVAL, flush_periodically)
+
+    def receive():
+        try:
+            message = connection.recv()
+        except EOFError:
+            message = None
+        if message is None:
+            loop.remove_reader(connection.fileno())
+            fleet.stop()
+        elif message[0] == "add":
+            add(*message[1:])
+        elif message[0] == "remove":
+            port = message[1]
+            fleet.remove(port).add_done_callback(
+                lambda _future: release(port))
+
+    for assignment in assignments:
+        add(*assignment)
+    loop.add_reader(connection.fileno(), receive)
+    loop.call_later(FLUSH_INTERVAL, flush_periodically)
+    try:
+        loop.run_until_complete(fleet.poll(None, record))
+        flush()
+    except IOError:
+        # the supervisor went away
+        pass
+    finally:
+        fleet.close()
+        loop.close()
+
+
+class _Worker(object):
+
+    def __init__(self, number):
+        self.number = number
+        self.ports = set()
+        self.process = None
+        self.connection = None
+
+
+class FleetSupervisor(object):
+    """Adapters polled by a pool of worker processes.
+
+    The callback is passed the port, sensor short name, value and time of
+    each reading, in the supervisor process.
+    """
+
+    _LOGGER = getLogger(__name__ + '.FleetSupervisor')
+
+    def __init__(self, worker_count, timeout, callback=None):
+        if worker_count < 1:
+            raise ValueError("At least one worker is needed")
+        self.timeout = timeout
+        self.callback = callback
+        self._workers = [_Worker(number) for number in range(worker_count)]
+        self._rates = {}
+        # devices are numbered in the readings of the workers, never reusing
+        # a number, so that late readings still tell their port
+        self._device_numbers = {}
+        self._ports = {}
+        # workers taken adapters away from, by port, until they confirm
+        # they closed the links
+        self._releasing = {}
+        self._started = False
+        self.reading_counts = Counter()
+        self.restart_count = 0
+
+    def add(self, port, rates):
+        """Poll the adapter on the port with the rates, in reads per second
+        by sensor short name"""
+        if port in self._rates:
+            raise ValueError("%s is already supervised" % port)
+        if not rates:
+            raise ValueError("No sensors to poll on %s" % port)
+        for shortname in rates:
+            get_sensor(shortname)
+        self._rates[port] = dict(rates)
+        if port not in self._device_numbers:
+            device_number = len(self._ports)
+            self._device_numbers[port] = device_number
+            self._ports[device_number] = port
+        self._assign(port, min(self._workers, key=self._get_load))
+
+    def remove(self, port):
+        """Stop polling the adapter on the port"""
+        del self._rates[port]
+        for worker in self._workers:
+            if port in worker.ports:
+                self._release(port, worker)
+        self._rebalance()
+
+    @property
+    def ports(self):
+        return sorted(self._rates)
+
+    @staticmethod
+    def _get_load(worker):
+        return len(worker.ports)
+
+    def _assign(self, port, worker):
+        worker.ports.add(port)
+        # a worker still polling the adapter must let it go first, so that
+        # two never open it at once
+        if port not in self._releasing:
+            self._send_add(port, worker)
+
+    def _send_add(self, port, worker):
+        self._send(
+            worker,
+            ("add", self._device_numbers[port], port, self._rates[port]),
+            )
+
+    def _release(self, port, worker):
+        worker.ports.remove(port)
+        if worker.process is not None:
+            self._releasing[port] = worker
+            self._send(worker, ("remove", port))
+
+    def _released(self, port, worker):
+        """The worker closed the link to the adapter: hand it to the worker
+        it was assigned to meanwhile, if any"""
+        if self._releasing.get(port) is not worker:
+            return
+        del self._releasing[port]
+        for other_worker in self._workers:
+            if port in other_worker.ports:
+                self._send_add(port, other_worker)
+
+    def _rebalance(self):
+        """Move adapters from the busiest workers to the idlest ones until
+        they poll as many, give or take one"""
+        while True:
+            busiest = max(self._workers, key=self._get_load)
+            idlest = min(self._workers, key=self._get_load)
+            if self._get_load(busiest) - self._get_load(idlest) <= 1:
+                return
+            port = next(iter(busiest.ports))
+            self._LOGGER.info(
+                "Moving %s from worker %d to worker %d",
+                port,
+                busiest.number,
+                idlest.number,
+                )
+            self._release(port, busiest)
+            self._assign(port, idlest)
+
+    def _send(self, worker, message):
+        if worker.process is None:
+            return
+        try:
+            worker.connection.send(message)
+        except (IOError, OSError) as e:
+            # the worker is restarted with all its adapters anyway
+            self._LOGGER.warning(
+                "Cannot reach worker %d: %s", worker.number, e)
+
+    def start(self):
+        """Start the worker processes"""
+        for worker in self._workers:
+            self._start_worker(worker)
+        self._started = True
+
+    def _start_worker(self, worker):
+        connection, worker_connection = multiprocessing.Pipe()
+        assignments = [
+            (self._device_numbers[port], port, self._rates[port])
+            for port in worker.ports
+            if port not in self._releasing
+            ]
+        worker.process = multiprocessing.Process(
+            target=_run_worker,
+            args=(worker_connection, self.timeout, assignments),
+            name="obd-worker-%d" % worker.number,
+            )
+        worker.process.daemon = True
+        worker.process.start()
+        worker_connection.close()
+        worker.connection = connection
+
+    def _restart_worker(self, worker):
+        self._LOGGER.warning(
+            "Worker %d stopped (exit code %s), restarting it",
+            worker.number,
+            worker.process.exitcode,
+            )
+        worker.connection.close()
+        if worker.process.is_alive():
+            worker.process.terminate()
+        worker.process.join()
+        self.restart_count += 1
+        self._start_worker(worker)
+        # the links of the stopped worker are closed
+        for port, releasing_worker in self._releasing.items():
+            if releasing_worker is worker:
+                self._released(port, worker)
+
+    def run(self, duration=None):
+        """Collect readings for `duration` seconds, or for ever without a
+        duration, starting the workers if need be"""
+        if not self._started:
+            self.start()
+        end_time = time.time() + duration if duration is not None else None
+        while True:
+            wait_time = CHECK_INTERVAL
+            if end_time is not None:
+                remaining_time = end_time - time.time()
+                if remaining_time <= 0:
+                    return
+                wait_time = min(wait_time, remaining_time)
+            workers = dict(
+                (worker.connection.fileno(), worker) for worker in self._workers
+                )
+            readable, _, _ = select.select(list(workers), [], [], wait_time)
+            for fileno in readable:
+                self._receive(workers[fileno])
+            for worker in self._workers:
+                if not worker.process.is_alive():
+                    self._restart_worker(worker)
+
+    def _receive(self, worker):
+        try:
+            data = worker.connection.recv_bytes()
+        except (EOFError, IOError):
+            self._restart_worker(worker)
+            return
+        if data.startswith(_RELEASED_MESSAGE):
+            device_number, = _DEVICE_NUMBER.unpack_from(data, 1)
+            self._released(self._ports[device_number], worker)
+            return
+        for device_number, sensor_index, timestamp, value in \
+                decode_readings(data[1:]):
+            port = self._ports[device_number]
+            self.reading_counts[port] += 1
+            if self.callback is not None:
+                self.callback(
+                    port,
+                    SENSORS[sensor_index].shortname,
+                    value,
+                    timestamp,
+                    )
+
+    def close(self):
+        """Stop the workers, letting them finish their commands"""
+        if not self._started:
+            return
+        for worker in self._workers:
+            self._send(worker, None)
+        for worker in self._workers:
+            worker.process.join(SHUTDOWN_TIMEOUT)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.connection.close()
+        self._started = False
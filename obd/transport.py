@@ -0,0 +1,251 @@
+###########################################################################
+#
+# Copyright 2014 Francisco Ruiz
+#
+# This file is part of pyOBD.
+#
+# pyOBD is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# pyOBD is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pyOBD; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+###########################################################################
+
+"""Links between the host and an ELM327 device.
+
+OBDDevice talks to the device through a transport, so that the same code
+drives USB/serial adapters, Wi-Fi adapters reachable over TCP and in-memory
+pipes used for testing.
+"""
+
+import errno
+import socket
+
+import serial
+
+
+TCP_URL_PREFIX = "tcp://"
+
+SERIAL_BAUDRATE = 38400
+
+
+class TransportError(IOError):
+    """The link to the device could not be opened or has failed"""
+
+
+class Transport(object):
+    """Abstract link to an ELM327 device"""
+
+    name = None
+
+    # bits per second of the link to the device, None where that does not
+    # apply (e.g. over TCP)
+    baudrate = None
+
+    def set_baudrate(self, baudrate):
+        """Change the speed of the link (not the device's)"""
+        raise NotImplementedError()
+
+    def read(self, size):
+        """Read at most `size` bytes, waiting up to the timeout for the first
+        one. Return an empty string on timeout."""
+        raise NotImplementedError()
+
+    def read_available(self, timeout=None):
+        """Read everything received so far in one go, waiting up to
+        `timeout` seconds (the transport's timeout by default) for the first
+        byte. Return an empty string on timeout."""
+        raise NotImplementedError()
+
+    def write(self, data):
+        raise NotImplementedError()
+
+    def flush_input(self):
+        """Discard everything received and not read yet"""
+        raise NotImplementedError()
+
+    def fileno(self):
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+
+class SerialTransport(Transport):
+    """Link over a (USB-)serial port"""
+
+    def __init__(self, port_name, timeout, baudrate=SERIAL_BAUDRATE):
+        try:
+            self._port = serial.Serial(
+                port_name,
+                baudrate=baudrate,
+                timeout=timeout,
+                )
+        except serial.SerialException as e:
+            raise TransportError(str(e))
+        self.name = self._port.portstr
+        self._timeout = timeout
+
+    @property
+    def baudrate(self):
+        return self._port.baudrate
+
+    def set_baudrate(self, baudrate):
+        try:
+            self._port.baudrate = baudrate
+        except (ValueError, serial.SerialException) as e:
+            raise TransportError(str(e))
+
+    def read(self, size):
+        try:
+            self._set_timeout(self._timeout)
+            return self._port.read(size)
+        except serial.SerialException as e:
+            raise TransportError(str(e))
+
+    def read_available(self, timeout=None):
+        # block for the first byte only if nothing is waiting already
+        try:
+            waiting = self._port.inWaiting()
+            if not waiting:
+                if timeout is None:
+                    timeout = self._timeout
+                self._set_timeout(timeout)
+            return self._port.read(waiting or 1)
+        except serial.SerialException as e:
+            raise TransportError(str(e))
+
+    def _set_timeout(self, timeout):
+        # changing it reconfigures the port: only do so when it differs
+        if self._port.timeout != timeout:
+            self._port.timeout = timeout
+
+    def write(self, data):
+        try:
+            self._port.write(data)
+        except serial.SerialException as e:
+            raise TransportError(str(e))
+
+    def flush_input(self):
+        self._port.flushInput()
+
+    def fileno(self):
+        return self._port.fileno()
+
+    def close(self):
+        self._port.close()
+
+
+class _SocketTransport(Transport):
+    """Link over a connected stream socket"""
+
+    # Large enough for the longest reply the device sends in one go
+    CHUNK_SIZE = 4096
+
+    def __init__(self, sock, timeout):
+        self._socket = sock
+        self._socket.settimeout(timeout)
+        self._timeout = timeout
+
+    def read(self, size):
+        return self._receive(size, self._timeout)
+
+    def _receive(self, size, timeout):
+        try:
+            self._socket.settimeout(timeout)
+            data = self._socket.recv(size)
+        except socket.timeout:
+            return ""
+        except socket.error as e:
+            raise TransportError(str(e))
+        if not data:
+            raise TransportError("Connection closed by the device")
+        return data
+
+    def read_available(self, timeout=None):
+        # a single recv returns everything buffered by the kernel
+        if timeout is None:
+            timeout = self._timeout
+        return self._receive(self.CHUNK_SIZE, timeout)
+
+    def write(self, data):
+        try:
+            self._socket.sendall(data)
+        except socket.error as e:
+            raise TransportError(str(e))
+
+    def flush_input(self):
+        self._socket.setblocking(False)
+        try:
+            while self._socket.recv(self.CHUNK_SIZE):
+                pass
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise TransportError(str(e))
+        finally:
+            self._socket.settimeout(self._timeout)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def close(self):
+        self._socket.close()
+
+
+class TCPTransport(_SocketTransport):
+    """Link to a Wi-Fi (or Ethernet) adapter over TCP"""
+
+    def __init__(self, host, port, timeout):
+        try:
+            sock = socket.create_connection((host, port), timeout)
+        except socket.error as e:
+            raise TransportError(str(e))
+        # commands are a handful of bytes: do not hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super(TCPTransport, self).__init__(sock, timeout)
+        self.name = "%s%s:%s" % (TCP_URL_PREFIX, host, port)
+
+
+class LoopbackTransport(_SocketTransport):
+    """In-memory link. Whatever is written to `peer`, a plain socket, is
+    read from the transport and vice versa."""
+
+    name = "loopback"
+
+    def __init__(self, timeout):
+        sock, self.peer = socket.socketpair()
+        super(LoopbackTransport, self).__init__(sock, timeout)
+
+    def close(self):
+        super(LoopbackTransport, self).close()
+        self.peer.close()
+
+
+def parse_tcp_url(port):
+    """Return the host and port in a "tcp://host:port" URL, or None if the
+    port is not such a URL"""
+    if not port.startswith(TCP_URL_PREFIX):
+        return None
+    host, _, tcp_port = port[len(TCP_URL_PREFIX):].rpartition(":")
+    try:
+        return host, int(tcp_port)
+    except ValueError:
+        raise TransportError("Invalid TCP address: %s" % port)
+
+
+def open_transport(port, timeout):
+    """Open the transport for the given port: a "tcp://host:port" URL or
+    the name of a serial port"""
+    address = parse_tcp_url(port)
+    if address:
+        host, tcp_port = address
+        return TCPTransport(host, tcp_port, timeout)
+    return SerialTransport(port, timeout)